@@ -0,0 +1,111 @@
+"""Build AI Shell into a self-contained, precompiled bundle.
+
+    python build.py [--output DIR] [--measure]
+
+The bundle is what install_aishell.sh puts in place:
+
+    DIR/aishell.pyz   zipapp holding shell.py and its bytecode, with a shebang
+                      for the Python that built it
+    DIR/lib/          requirements.txt installed with precompiled bytecode
+
+The dependencies stay outside the zip because pydantic_core and jiter are C
+extensions, which cannot be imported from a zip file. All bytecode is written
+as unchecked-hash .pyc files, so launches neither recompile nor stat sources
+to validate caches, and nothing needs to be written next to a read-only
+install. The bytecode is specific to the Python version that built it, which
+is why the installer runs this build on the target machine.
+"""
+import argparse
+import compileall
+import os
+import py_compile
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import zipapp
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+# Runs from inside the zipapp: put the vendored dependencies on the path, then
+# start the shell as the main module
+BOOTSTRAP = '''\
+import os
+import runpy
+import sys
+
+bundle = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(1, os.path.join(bundle, "lib"))
+runpy.run_module("shell", run_name="__main__", alter_sys=True)
+'''
+
+def build(output: str) -> str:
+    """Build the bundle into `output` and return the path of the zipapp"""
+    lib = os.path.join(output, "lib")
+    shutil.rmtree(lib, ignore_errors=True)
+    os.makedirs(output, exist_ok=True)
+
+    print("Installing dependencies...")
+    subprocess.run([sys.executable, "-m", "pip", "install", "--quiet", "--disable-pip-version-check",
+                    "--no-compile", "--target", lib, "-r", os.path.join(ROOT, "requirements.txt")],
+                   check=True)
+    shutil.rmtree(os.path.join(lib, "bin"), ignore_errors=True)  # Console scripts; unused
+
+    print("Compiling bytecode...")
+    if not compileall.compile_dir(lib, quiet=1, workers=0,
+                                  invalidation_mode=py_compile.PycInvalidationMode.UNCHECKED_HASH):
+        raise RuntimeError("could not compile the dependencies")
+
+    print("Building zipapp...")
+    target = os.path.join(output, "aishell.pyz")
+    with tempfile.TemporaryDirectory() as staging:
+        shutil.copy(os.path.join(ROOT, "shell.py"), staging)
+        with open(os.path.join(staging, "__main__.py"), "w") as f:
+            f.write(BOOTSTRAP)
+        # zipimport looks for module.pyc beside module.py rather than in __pycache__
+        for module in ("shell", "__main__"):
+            py_compile.compile(os.path.join(staging, f"{module}.py"), os.path.join(staging, f"{module}.pyc"),
+                               doraise=True, invalidation_mode=py_compile.PycInvalidationMode.UNCHECKED_HASH)
+        zipapp.create_archive(staging, target, interpreter=sys.executable)
+    print(f"Built {target}")
+    return target
+
+def time_launches(command, env=None, runs: int = 5):
+    """Seconds to first prompt for the first launch and the median of the later ones"""
+    timings = []
+    for _ in range(runs + 1):
+        start = time.perf_counter()
+        subprocess.run(command + ["--startup-check"], input=b"", stdout=subprocess.DEVNULL,
+                       stderr=subprocess.DEVNULL, env=env, check=True)
+        timings.append(time.perf_counter() - start)
+    later = sorted(timings[1:])
+    return timings[0], later[len(later) // 2]
+
+def measure(output: str):
+    """Compare launches of the bundle with running shell.py from source.
+
+    A script run directly is compiled on every launch, since Python only caches
+    bytecode for imported modules; the bundle imports shell from its .pyc.
+    """
+    env = dict(os.environ, PYTHONPATH=os.path.join(output, "lib"), AISHELL_DAEMON="0")
+    rows = [("source", time_launches([sys.executable, os.path.join(ROOT, "shell.py")], env))]
+    env.pop("PYTHONPATH")
+    rows.append(("bundle", time_launches([os.path.join(output, "aishell.pyz")], env)))
+
+    print(f"{'time to first prompt':20} {'first':>8} {'later':>8}")
+    for name, (first, later) in rows:
+        print(f"{name:20} {first * 1000:6.0f}ms {later * 1000:6.0f}ms")
+    print("(both use the bundle's precompiled lib/ for the dependencies)")
+
+def main():
+    parser = argparse.ArgumentParser(description="Build AI Shell into a precompiled zipapp bundle")
+    parser.add_argument("--output", default=os.path.join(ROOT, "dist"), help="bundle directory (default dist/)")
+    parser.add_argument("--measure", action="store_true", help="compare first and later launch times afterwards")
+    args = parser.parse_args()
+    build(args.output)
+    if args.measure:
+        measure(args.output)
+
+if __name__ == "__main__":
+    main()
@@ -16,25 +16,6 @@ echo -e "${BLUE}Installing AI Shell...${NC}"
 #     exit 1
 # fi
 
-# Create installation directory
-echo "Creating installation directory..."
-mkdir -p "$INSTALL_DIR"
-
-# Copy all necessary files
-echo "Copying files..."
-cp shell.py "$INSTALL_DIR/"
-cp requirements.txt "$INSTALL_DIR/"
-
-# Create the main shell script in the installation directory
-cat > "$INSTALL_DIR/aishell" << 'EOF'
-#!/bin/bash
-
-# Store the current directory
-CURRENT_DIR="$(pwd)"
-
-# Change to the installation directory temporarily
-cd /usr/local/bin/shell
-
 # Check if Python is installed
 if ! command -v python3 &> /dev/null; then
     echo "Python3 is not installed. Installing Python..."
@@ -50,48 +31,38 @@ if ! command -v python3 &> /dev/null; then
     fi
 fi
 
-# Create virtual environment if it doesn't exist
-if [ ! -d "venv" ]; then
-    echo "Creating virtual environment..."
-    python3 -m venv venv
-fi
-
-# Activate virtual environment
-source venv/bin/activate
-
-# Install requirements
-if [ ! -f "venv/requirements_installed" ]; then
-    echo "Installing required packages..."
-    pip install -r requirements.txt
-    touch venv/requirements_installed
+# Create installation directory
+echo "Creating installation directory..."
+mkdir -p "$INSTALL_DIR"
+# Left behind by installs that ran from a virtual environment
+rm -rf "$INSTALL_DIR/venv" "$INSTALL_DIR/aishell" "$INSTALL_DIR/shell.py" "$INSTALL_DIR/requirements.txt"
+
+# Build the precompiled zipapp and its dependencies straight into place, so
+# launching skips pip, venv activation and bytecode compilation
+echo "Building AI Shell..."
+if ! python3 build.py --output "$INSTALL_DIR"; then
+    echo "Build failed."
+    exit 1
 fi
 
 # Setup .env file if it doesn't exist
-if [ ! -f ".env" ]; then
+if [ ! -f "$INSTALL_DIR/.env" ]; then
     echo "Setting up .env file..."
     echo -n "Please enter your deepseek API key: "
     read api_key
-    echo "deepseek_api=\"$api_key\"" > .env
+    echo "deepseek_api=\"$api_key\"" > "$INSTALL_DIR/.env"
     echo ".env file created successfully!"
 fi
 
-# Change back to the user's original directory
-cd "$CURRENT_DIR"
-
-# Run the shell with the full path to shell.py
-echo "Starting AI Shell..."
-python3 /usr/local/bin/shell/shell.py
-EOF
-
-# Make the script executable
-chmod +x "$INSTALL_DIR/aishell"
-
-# Create symbolic link in /usr/local/bin
-ln -sf "$INSTALL_DIR/aishell" /usr/local/bin/aishell
+# Create symbolic link in /usr/local/bin; the zipapp runs directly
+ln -sf "$INSTALL_DIR/aishell.pyz" /usr/local/bin/aishell
 
 # Set proper permissions
 chown -R root:root "$INSTALL_DIR"
 chmod -R 755 "$INSTALL_DIR"
+# The API key is readable only by the user who installed it
+chown "${SUDO_USER:-root}" "$INSTALL_DIR/.env"
+chmod 600 "$INSTALL_DIR/.env"
 
 echo -e "${GREEN}Installation completed!${NC}"
 echo -e "${BLUE}You can now run the AI Shell from anywhere by typing:${NC} aishell"
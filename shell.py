@@ -1,62 +1,526 @@
 import os
+import sys
+import asyncio
 import threading
 import subprocess
 import time
 import json
 import glob
 import re
+import shlex
+import atexit
+import itertools
+import importlib
+import ast
+import bisect
+from collections import OrderedDict, deque
 from pathlib import Path
 from typing import Dict, List, Optional
-from openai import OpenAI, APIConnectionError
 from prompt_toolkit import PromptSession
 from prompt_toolkit.auto_suggest import AutoSuggest, Suggestion
 from prompt_toolkit.key_binding import KeyBindings
 from prompt_toolkit.formatted_text import HTML
 from prompt_toolkit.styles import Style
 from dotenv import load_dotenv
-import platform
+import select
+import signal
 
-load_dotenv()
+try:
+    import pty
+    import tty
+    import termios
+    import fcntl
+except ImportError:  # Windows has no pseudo-terminals
+    pty = None
+
+# This file, or the zipapp build.py bundled it into; .env lives next to it
+APP_PATH = os.path.realpath(__file__)
+if not os.path.isfile(APP_PATH):
+    APP_PATH = os.path.dirname(APP_PATH)
+
+load_dotenv(os.path.join(os.path.dirname(APP_PATH), ".env"))
 COMMAND_HISTORY_LIMIT = 10 
+COMMAND_OUTPUT_TAIL_BYTES = 16 * 1024  # Output kept per command for context
+CONTEXT_TOKEN_BUDGET = int(os.getenv("AISHELL_CONTEXT_TOKENS", "1500"))  # Prompt budget for command history
 # At the top of your file, add this debug print
 print("Using OpenRouter API key:", os.getenv("deepseek_api")[:8] + "..." if os.getenv("deepseek_api") else "Not found")
 
-FALLBACK_MODEL = "openai/gpt-3.5-turbo:free"
+DEFAULT_MODEL = "openai/gpt-3.5-turbo:free"
+# Any OpenAI-compatible endpoint works, e.g. a local server for testing
+AI_BASE_URL = os.getenv("AISHELL_BASE_URL", "https://openrouter.ai/api/v1")
 
-client = OpenAI(
-    base_url="https://openrouter.ai/api/v1",
-    api_key=os.getenv("deepseek_api"),
-    timeout=5.0,
-    default_headers={
-        "HTTP-Referer": "https://openrouter.ai/",  # Required for OpenRouter
-    }
-)
+# Per-user cache directory shared by the persistent caches
+CACHE_DIR = Path(os.getenv("AISHELL_CACHE_DIR", Path.home() / ".cache" / "aishell"))
+
+# Time-to-first-prompt budget (seconds) enforced by `--bench startup`
+STARTUP_BUDGET = float(os.getenv("AISHELL_STARTUP_BUDGET", "1.5"))
+
+# Import-time budget (seconds) for this module, enforced by `--bench imports`,
+# and modules that must only load on first use
+IMPORT_BUDGET = float(os.getenv("AISHELL_IMPORT_BUDGET", "0.3"))
+LAZY_MODULES = ("openai", "httpx", "pydantic", "hashlib", "platform")
+
+# The client is built by the first model call, so running plain commands never
+# pays for the AI stack. It is an async client: every model call runs as a task
+# on the REPL's event loop.
+_client = None
+
+async def get_client():
+    """Return the shared OpenRouter client, creating it on first use.
+
+    openai pulls in httpx and pydantic and takes most of a second to import,
+    so the import runs in a worker thread instead of stalling the prompt.
+    """
+    global _client
+    if _client is None:
+        if api_status == "unknown":
+            start_api_check()
+        openai = await asyncio.to_thread(importlib.import_module, "openai")
+        if _client is None:  # A concurrent first call may have built it meanwhile
+            _client = openai.AsyncOpenAI(
+                base_url=AI_BASE_URL,
+                api_key=os.getenv("deepseek_api"),
+                timeout=5.0,
+                max_retries=0,  # The router falls over to another model instead
+                default_headers={
+                    "HTTP-Referer": "https://openrouter.ai/",  # Required for OpenRouter
+                }
+            )
+    return _client
+
+# Result of the background connectivity check: "unknown" until the first model
+# call starts it, then "checking", "online" or "offline"
+api_status = "unknown"
+api_status_detail = ""
+api_status_listener = None  # Called when the check finishes, e.g. to redraw the prompt
 
 # Test the API connection
-def test_api_connection():
+async def test_api_connection():
+    global api_status, api_status_detail
+    try:
+        status = await call_daemon('status', {})
+        if status is not DAEMON_UNAVAILABLE:
+            api_status, api_status_detail = status['status'], status['detail']
+            return api_status == "online"
+    except (OSError, ValueError, RuntimeError, KeyError, TypeError):
+        pass  # A daemon that is listening but broken; check from this process instead
     try:
-        completion = client.chat.completions.create(
-            model=FALLBACK_MODEL,
+        completion = await model_router.complete(
+            'status',
             messages=[
                 {"role": "system", "content": "You are a helpful assistant."},
                 {"role": "user", "content": "Say 'API connection successful'"}
             ],
             max_tokens=10
         )
-        print("API Test Response:", completion.choices[0].message.content if completion.choices else "No response")
+        api_status = "online"
+        api_status_detail = completion.choices[0].message.content if completion.choices else "No response"
         return True
     except Exception as e:
-        print("API Test Error:", str(e))
+        api_status = "offline"
+        api_status_detail = str(e)
         return False
 
-# Call this at startup
-if test_api_connection():
-    print("OpenRouter API connection successful")
-else:
-    print("OpenRouter API connection failed")
+def start_api_check() -> asyncio.Task:
+    """Run the connectivity check in the background so the prompt shows up immediately"""
+    global api_status
+    api_status = "checking"
+
+    async def run():
+        await test_api_connection()
+        if api_status_listener:
+            api_status_listener()
+
+    return asyncio.get_running_loop().create_task(run())
+
+# Call gate in front of every model call. A token bucket keeps calls under the
+# provider's rate limit, and a circuit breaker per endpoint (model) stops calling
+# one that keeps failing, so callers fall back to local behaviour at once instead
+# of each waiting out the client timeout.
+RATE_LIMIT = float(os.getenv("AISHELL_RATE_LIMIT", "20"))  # Model calls per minute
+RATE_BURST = int(os.getenv("AISHELL_RATE_BURST", "5"))
+BREAKER_FAILURES = int(os.getenv("AISHELL_BREAKER_FAILURES", "3"))  # Consecutive failures that open a circuit
+BREAKER_BACKOFF = float(os.getenv("AISHELL_BREAKER_BACKOFF", "5"))  # Seconds open; doubles while trial calls fail
+BREAKER_MAX_BACKOFF = 300.0
+# Errors about one request rather than the endpoint; they never open a circuit
+REQUEST_ERROR_STATUSES = {400, 413, 422}
+
+class AIUnavailable(RuntimeError):
+    """Raised instead of calling the model while the gate holds calls back"""
+
+class TokenBucket:
+    """Allows `burst` calls at once and `rate_per_minute` on average"""
+
+    def __init__(self, rate_per_minute: float, burst: int):
+        self.rate = rate_per_minute / 60
+        self.capacity = max(burst, 1)
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def available(self) -> bool:
+        self._refill()
+        return self.tokens >= 1
+
+    async def take(self, max_wait: float):
+        """Take a token, waiting up to max_wait seconds for one"""
+        deadline = time.monotonic() + max_wait
+        while True:
+            self._refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            wait = (1 - self.tokens) / self.rate if self.rate > 0 else float('inf')
+            if time.monotonic() + wait > deadline:
+                raise AIUnavailable("rate limit reached")
+            await asyncio.sleep(wait)
+
+class CircuitBreaker:
+    """closed: calls go through. open: calls are refused until the backoff has passed.
+    half-open: a single trial call closes the circuit again, or reopens it for twice as long."""
+
+    def __init__(self):
+        self.state = "closed"
+        self.failures = 0  # Consecutive
+        self.backoff = BREAKER_BACKOFF
+        self.retry_at = 0.0
+        self.trial = False  # A half-open trial call is in flight
+
+    def retry_in(self) -> float:
+        return max(0.0, self.retry_at - time.monotonic())
+
+    def allow(self) -> bool:
+        if self.state == "open" and not self.retry_in():
+            self.state, self.trial = "half-open", False
+        if self.state == "half-open":
+            if self.trial:
+                return False
+            self.trial = True
+        return self.state != "open"
+
+    def release(self):
+        """The admitted call never ran to an outcome (cancelled or rate limited)"""
+        self.trial = False
+
+    def success(self):
+        self.state, self.failures, self.backoff, self.trial = "closed", 0, BREAKER_BACKOFF, False
+
+    def failure(self, retry_after: Optional[float] = None):
+        self.failures += 1
+        if self.state == "half-open":
+            self.backoff = min(self.backoff * 2, BREAKER_MAX_BACKOFF)
+        elif self.failures < BREAKER_FAILURES and retry_after is None:
+            return
+        self.state, self.trial = "open", False
+        self.retry_at = time.monotonic() + max(self.backoff, retry_after or 0)
+
+def _retry_after(error: Exception) -> Optional[float]:
+    """Seconds a rate-limited (429) response asked us to wait, if any"""
+    if getattr(error, 'status_code', None) != 429:
+        return None
+    try:
+        return float(error.response.headers.get('retry-after', BREAKER_BACKOFF))
+    except (AttributeError, TypeError, ValueError):
+        return BREAKER_BACKOFF
+
+class CallGate:
+    """Rate limiter shared by all calls plus a circuit breaker per endpoint"""
+
+    def __init__(self):
+        self.bucket = TokenBucket(RATE_LIMIT, RATE_BURST)
+        self.breakers = {}
+        self.held_back = {"rate_limit": 0, "open_circuit": 0}  # Calls refused, shown by !stats
+
+    def breaker(self, endpoint: str) -> CircuitBreaker:
+        if endpoint not in self.breakers:
+            self.breakers[endpoint] = CircuitBreaker()
+        return self.breakers[endpoint]
+
+    def _changed(self, breaker: CircuitBreaker):
+        """Redraw the prompt now and again when an open circuit may be retried"""
+        if api_status_listener:
+            api_status_listener()
+            if breaker.state == "open":
+                asyncio.get_running_loop().call_later(breaker.retry_in() + 0.1, api_status_listener)
+
+    async def call(self, endpoint: str, make_call, max_wait: float = 0.0):
+        """Await make_call() unless the endpoint's circuit is open or no call is allowed within max_wait"""
+        breaker = self.breaker(endpoint)
+        if not breaker.allow():
+            self.held_back["open_circuit"] += 1
+            raise AIUnavailable(f"{endpoint} paused for {breaker.retry_in():.0f}s after repeated failures")
+        try:
+            await self.bucket.take(max_wait)
+        except AIUnavailable:
+            self.held_back["rate_limit"] += 1
+            breaker.release()
+            raise
+        except BaseException:
+            breaker.release()
+            raise
+        state = breaker.state
+        try:
+            result = await make_call()
+        except asyncio.CancelledError:
+            breaker.release()
+            raise
+        except Exception as e:
+            if getattr(e, 'status_code', None) not in REQUEST_ERROR_STATUSES:
+                breaker.failure(_retry_after(e))
+                if breaker.state != state:
+                    self._changed(breaker)
+            raise
+        breaker.success()
+        if state != "closed":
+            self._changed(breaker)
+        return result
+
+    def status(self) -> Optional[str]:
+        """Why AI features are paused, for the prompt; None while calls go through"""
+        if self.breakers and all(breaker.state == "open" and breaker.retry_in() for breaker in self.breakers.values()):
+            return f"paused {min(breaker.retry_in() for breaker in self.breakers.values()):.0f}s"
+        if not self.bucket.available():
+            return "rate limited"
+        return None
+
+call_gate = CallGate()
+
+# Model routing: every task has an ordered list of models (overridable with
+# AISHELL_MODELS_<TASK>, comma-separated). Calls go to the healthiest, fastest
+# model by live stats; when it is slower than its usual latency percentile a
+# second model is hedged and whichever answers first wins, the other is cancelled.
+MODEL_ROUTES = {
+    'suggestion': [DEFAULT_MODEL, "mistralai/mistral-7b-instruct:free"],
+    'translation': [DEFAULT_MODEL, "meta-llama/llama-3.3-70b-instruct:free"],
+    'safety': [DEFAULT_MODEL, "meta-llama/llama-3.3-70b-instruct:free"],
+    'setup': [DEFAULT_MODEL, "deepseek/deepseek-chat:free"],
+    'error': [DEFAULT_MODEL, "deepseek/deepseek-chat:free"],
+    'status': [DEFAULT_MODEL],
+}
+for _task in MODEL_ROUTES:
+    # A value with no model names in it, such as ",", keeps the defaults
+    _models = [m.strip() for m in os.getenv(f"AISHELL_MODELS_{_task.upper()}", "").split(",") if m.strip()]
+    if _models:
+        MODEL_ROUTES[_task] = _models
+HEDGE_PERCENTILE = float(os.getenv("AISHELL_HEDGE_PERCENTILE", "0.9"))  # Hedge once slower than this share of calls
+HEDGE_DEFAULT_DELAY = float(os.getenv("AISHELL_HEDGE_DELAY", "1.0"))  # Until a model has HEDGE_MIN_SAMPLES
+HEDGE_MIN_SAMPLES = 5
+# Seconds a task may wait for the rate limiter; suggestions are dropped rather than late
+RATE_LIMIT_WAIT = {'suggestion': 0.0, 'status': 0.0}
+MODEL_RETRY_SECONDS = 30  # A failing model is tried first again after this long
+
+class ModelStats:
+    """Recent latencies and failures of one model"""
+
+    def __init__(self):
+        self.latencies = deque(maxlen=50)
+        self.calls = 0
+        self.errors = 0
+        self.error_rate = 0.0  # Exponentially weighted, so old failures fade
+        self.last_error = 0.0
+        self.hedges = 0  # Hedged calls started on this model
+        self.hedges_won = 0
+
+    def record(self, latency: float):
+        self.calls += 1
+        self.latencies.append(latency)
+        self.error_rate *= 0.7
+
+    def record_error(self):
+        self.calls += 1
+        self.errors += 1
+        self.error_rate = self.error_rate * 0.7 + 0.3
+        self.last_error = time.monotonic()
+
+    def percentile(self, p: float) -> Optional[float]:
+        if not self.latencies:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(p * len(ordered)))]
+
+    def healthy(self) -> bool:
+        return self.error_rate < 0.5 or time.monotonic() - self.last_error > MODEL_RETRY_SECONDS
 
-#something 
+class _PrefetchedStream:
+    """A response stream whose first chunk was already read to time the model"""
 
+    def __init__(self, stream, chunks, first):
+        self._stream = stream
+        self._chunks = chunks
+        self._first = first
+
+    async def __aiter__(self):
+        if self._first is not None:
+            yield self._first
+        async for chunk in self._chunks:
+            yield chunk
+
+    async def close(self):
+        await self._stream.close()
+
+def _discard_attempt(attempt: asyncio.Future):
+    """Clean up a call that lost the race: consume its error, close a stream it opened"""
+    if attempt.cancelled() or attempt.exception() is not None:
+        return
+    if isinstance(attempt.result(), _PrefetchedStream):
+        asyncio.ensure_future(attempt.result().close())
+
+class ModelRouter:
+    """Send a task's completion to the best of its models, hedging slow calls"""
+
+    def __init__(self, routes: Dict[str, List[str]]):
+        self.routes = routes
+        self.stats = {}
+
+    def model_stats(self, model: str) -> ModelStats:
+        if model not in self.stats:
+            self.stats[model] = ModelStats()
+        return self.stats[model]
+
+    def order(self, task: str) -> List[str]:
+        """Models for a task, healthy before failing and then by median latency; untried ones keep their place"""
+        def key(item):
+            index, model = item
+            stats = self.model_stats(model)
+            median = stats.percentile(0.5)
+            unhealthy = not stats.healthy() or call_gate.breaker(model).state == "open"
+            return (unhealthy, median if median is not None else HEDGE_DEFAULT_DELAY, index)
+        return [model for _, model in sorted(enumerate(self.routes[task]), key=key)]
+
+    def hedge_delay(self, model: str) -> float:
+        stats = self.model_stats(model)
+        if len(stats.latencies) < HEDGE_MIN_SAMPLES:
+            return HEDGE_DEFAULT_DELAY
+        return stats.percentile(HEDGE_PERCENTILE)
+
+    async def _attempt(self, model: str, kwargs: Dict, max_wait: float):
+        stats = self.model_stats(model)
+        client = await get_client()
+
+        async def create():
+            start = time.perf_counter()
+            response = await client.chat.completions.create(model=model, **kwargs)
+            if kwargs.get('stream'):
+                # A streamed call is only as fast as its first token
+                chunks = response.__aiter__()
+                try:
+                    first = await chunks.__anext__()
+                except StopAsyncIteration:
+                    first = None
+                except BaseException:
+                    await response.close()
+                    raise
+                response = _PrefetchedStream(response, chunks, first)
+            stats.record(time.perf_counter() - start)
+            return response
+
+        try:
+            return await call_gate.call(model, create, max_wait)
+        except (asyncio.CancelledError, AIUnavailable):
+            raise
+        except Exception:
+            stats.record_error()
+            raise
+
+    async def complete(self, task: str, **kwargs):
+        """chat.completions.create on the task's models; the first answer wins, failures fall over to the next model"""
+        models = self.order(task)
+        if not models:
+            raise ValueError(f"no models configured for {task!r}; set AISHELL_MODELS_{task.upper()} to model names")
+        started = {}  # attempt -> model
+        hedge = None  # Model started because the first one was slow
+        error = None
+
+        def launch(model, max_wait=RATE_LIMIT_WAIT.get(task, 5.0)):
+            started[asyncio.ensure_future(self._attempt(model, kwargs, max_wait))] = model
+
+        launch(models.pop(0))
+        try:
+            while started:
+                # Hedge once if the only call so far runs past its usual latency
+                timeout = None
+                if hedge is None and models and len(started) == 1:
+                    timeout = self.hedge_delay(next(iter(started.values())))
+                done, _ = await asyncio.wait(started, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    hedge = models.pop(0)
+                    self.model_stats(hedge).hedges += 1
+                    launch(hedge, max_wait=0.0)  # A hedge is not worth waiting for the rate limit
+                    continue
+                winner = None
+                for attempt in done:
+                    model = started.pop(attempt)
+                    if attempt.exception() is not None:
+                        error = attempt.exception()
+                    elif winner is None:
+                        winner = attempt
+                        if model == hedge:
+                            self.model_stats(model).hedges_won += 1
+                    else:
+                        _discard_attempt(attempt)  # Both answered at once
+                if winner:
+                    return winner.result()
+                if not started and models:
+                    launch(models.pop(0))  # Fall over to the next model
+            raise error
+        finally:
+            for attempt in started:
+                attempt.cancel()  # The losers; cancelling closes their connections
+                attempt.add_done_callback(_discard_attempt)
+
+model_router = ModelRouter(MODEL_ROUTES)
+
+async def with_spinner(aw, message: str):
+    """Await a coroutine or task while showing a spinner; Ctrl-C cancels it.
+
+    The spinner only appears if the wait is noticeable. On cancellation the
+    task is cancelled and KeyboardInterrupt is raised back to the REPL.
+    """
+    task = asyncio.ensure_future(aw)
+    loop = asyncio.get_running_loop()
+
+    async def spin():
+        await asyncio.sleep(0.15)
+        for frame in itertools.cycle("⠋⠙⠹⠸⠼⠴⠦⠧⠇⠏"):
+            sys.stdout.write(f"\r{frame} {message}")
+            sys.stdout.flush()
+            await asyncio.sleep(0.1)
+
+    spinner = loop.create_task(spin())
+    previous_handler = signal.getsignal(signal.SIGINT)
+    try:
+        loop.add_signal_handler(signal.SIGINT, task.cancel)
+        handler_installed = True
+    except (NotImplementedError, RuntimeError):  # Windows or not the main thread
+        handler_installed = False
+
+    try:
+        await asyncio.wait({task})
+    finally:
+        spinner.cancel()
+        if handler_installed:
+            loop.remove_signal_handler(signal.SIGINT)
+            signal.signal(signal.SIGINT, previous_handler)
+        sys.stdout.write("\r\x1b[K")
+        sys.stdout.flush()
+
+    if task.cancelled():
+        print("Cancelled.")
+        raise KeyboardInterrupt()
+    return task.result()
+
+_confirm_session = None
+
+async def ask(question: str) -> str:
+    """Read a line of input (e.g. a confirmation) without blocking the event loop"""
+    global _confirm_session
+    if _confirm_session is None:
+        _confirm_session = PromptSession()
+    return await _confirm_session.prompt_async(question)
 
 # Global state management
 command_history = []
@@ -65,15 +529,237 @@ suggestion_lock = threading.Lock()
 last_request_time = 0
 command_context = []  # Store command outputs and context
 
-def get_ai_suggestion(user_input):
-    """Get command completion suggestions from the AI model."""
+class PersistentLRU:
+    """Thread-safe LRU cache with TTL, persisted as JSON between sessions"""
+
+    def __init__(self, path: Path, max_entries: int = 2000, ttl: float = 7 * 24 * 3600):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # key -> (value, stored at)
+        self._lock = threading.Lock()
+        self._loaded = False
+        self._dirty = 0
+
+    def _load(self):
+        """Read the on-disk cache the first time it is needed"""
+        self._loaded = True
+        try:
+            with open(self.path, 'r') as f:
+                stored = json.load(f)
+        except (OSError, ValueError):
+            return
+        now = time.time()
+        for key, (value, stored_at) in stored.items():
+            if now - stored_at < self.ttl:
+                self._entries[key] = (value, stored_at)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def lookup(self, key: str, record: bool = True):
+        """Return the cached value for key, or None on a miss"""
+        with self._lock:
+            if not self._loaded:
+                self._load()
+            entry = self._entries.get(key)
+            if entry and time.time() - entry[1] >= self.ttl:
+                del self._entries[key]
+                entry = None
+            if record:
+                if entry:
+                    self.hits += 1
+                else:
+                    self.misses += 1
+            if not entry:
+                return None
+            self._entries.move_to_end(key)
+        return entry[0]
+
+    def store(self, key: str, value):
+        with self._lock:
+            if not self._loaded:
+                self._load()
+            self._entries[key] = (value, time.time())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            self._dirty += 1
+            flush = self._dirty >= 50
+        if flush:
+            self.save()
+
+    def save(self):
+        """Write the cache to disk atomically; the temporary file is unique, as other shells and the daemon save it too"""
+        import tempfile
+        with self._lock:
+            if not self._dirty:
+                return
+            snapshot = dict(self._entries)
+            self._dirty = 0
+        try:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=self.path.parent, prefix=self.path.stem, suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'w') as f:
+                    json.dump(snapshot, f)
+                os.replace(tmp_path, self.path)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+        except OSError:
+            pass
+
+    def stats(self) -> Dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+class SuggestionCache(PersistentLRU):
+    """LRU cache of AI completions keyed by normalized prefix and working directory, persisted between sessions"""
+
+    @staticmethod
+    def normalize(prefix: str) -> str:
+        """Collapse whitespace runs so `git  sta` and `git sta` share an entry"""
+        normalized = " ".join(prefix.split())
+        if prefix[-1:].isspace():
+            normalized += " "
+        return normalized
+
+    def _key(self, prefix: str, cwd: str) -> str:
+        return f"{cwd}\0{self.normalize(prefix)}"
+
+    def get(self, prefix: str, cwd: str, record: bool = True) -> Optional[str]:
+        """Return the cached suggestion for prefix, or None on a miss"""
+        suffix = self.lookup(self._key(prefix, cwd), record)
+        return None if suffix is None else prefix + suffix
+
+    def put(self, prefix: str, cwd: str, suggestion: str):
+        """Remember the suggestion for prefix; only the completed part is stored"""
+        if not suggestion or not suggestion.startswith(prefix):
+            return
+        self.store(self._key(prefix, cwd), suggestion[len(prefix):])
+
+suggestion_cache = SuggestionCache(
+    CACHE_DIR / "suggestions.json",
+    max_entries=int(os.getenv("AISHELL_SUGGESTION_CACHE_SIZE", "2000")),
+    ttl=float(os.getenv("AISHELL_SUGGESTION_CACHE_TTL", str(7 * 24 * 3600)))
+)
+atexit.register(suggestion_cache.save)
+
+class HistoryIndex:
+    """Sorted prefix index over previously run commands, ranked by frequency and recency"""
+
+    # Files read on startup; zsh extended history lines look like ": 1700000000:0;cmd"
+    HISTORY_FILES = ["~/.bash_history", "~/.zsh_history"]
+    MAX_SCAN = 500
+
+    def __init__(self, own_history: Path):
+        self.own_history = own_history
+        self._commands = []  # Sorted unique commands
+        self._stats = {}  # command -> [count, last sequence number]
+        self._seq = 0
+        self._best = {}  # prefix -> best match memo, cleared on every add
+        self._lock = threading.Lock()
+
+    def load(self):
+        """Index the user's shell histories plus aishell's own history file"""
+        paths = [Path(os.path.expanduser(p)) for p in self.HISTORY_FILES] + [self.own_history]
+        for path in paths:
+            try:
+                with open(path, 'r', encoding='utf-8', errors='ignore') as f:
+                    lines = f.read().splitlines()
+            except OSError:
+                continue
+            for line in lines:
+                if line.startswith(': ') and ';' in line:
+                    line = line.split(';', 1)[1]
+                self._add(line.strip())
+
+    def _add(self, command: str):
+        if not command or command.startswith('#'):
+            return
+        with self._lock:
+            self._seq += 1
+            entry = self._stats.get(command)
+            if entry:
+                entry[0] += 1
+                entry[1] = self._seq
+            else:
+                self._stats[command] = [1, self._seq]
+                bisect.insort(self._commands, command)
+            self._best.clear()
+
+    def add(self, command: str):
+        """Record a command run in this session and append it to aishell's history file"""
+        command = command.strip()
+        self._add(command)
+        try:
+            self.own_history.parent.mkdir(parents=True, exist_ok=True)
+            with open(self.own_history, 'a') as f:
+                f.write(command + "\n")
+        except OSError:
+            pass
+
+    def best_match(self, prefix: str) -> Optional[str]:
+        """Return the highest ranked previous command extending prefix, if any"""
+        with self._lock:
+            if prefix in self._best:
+                return self._best[prefix]
+            best, best_score = None, 0.0
+            i = bisect.bisect_left(self._commands, prefix)
+            end = min(i + self.MAX_SCAN, len(self._commands))
+            while i < end and self._commands[i].startswith(prefix):
+                candidate = self._commands[i]
+                i += 1
+                if candidate == prefix:
+                    continue
+                count, last_seq = self._stats[candidate]
+                # Frequency, scaled down for commands not used in a long time
+                score = count * (0.5 + 0.5 * last_seq / self._seq)
+                if score > best_score:
+                    best, best_score = candidate, score
+            self._best[prefix] = best
+            return best
+
+history_index = HistoryIndex(CACHE_DIR / "history")
+
+def _clean_suggestion(user_input, text):
+    """Trim raw model output to a single command line that extends user_input"""
+    suggestion = text.strip()
+    suggestion = suggestion.split("\n")[0].split("#")[0].strip().strip('"').strip("'")
+    
+    # Ensure suggestion starts with user input
+    if suggestion and not suggestion.startswith(user_input):
+        suggestion = user_input + suggestion
+    elif suggestion == user_input:
+        suggestion += " "
+    return suggestion
+
+async def get_ai_suggestion(user_input, on_partial=None):
+    """Get command completion suggestions from the AI model.
+
+    The completion is streamed; on_partial, if given, receives the suggestion
+    built so far after every token. Generation stops at the first newline or
+    comment since everything after it is discarded anyway. Cancelling the
+    calling task closes the stream.
+    """
     try:
         if len(user_input.strip()) < 3:
             return ""
 
+        suggestion = await call_daemon('suggest', {'user_input': user_input, 'cwd': os.getcwd()}, on_partial)
+        if suggestion is not DAEMON_UNAVAILABLE:
+            return suggestion
+
         # print(f"Requesting suggestion for: {user_input}")  # Debug print
-        completion = client.chat.completions.create(
-            model=FALLBACK_MODEL,
+        stream = await model_router.complete(
+            'suggestion',
             messages=[
                 {
                     "role": "system", 
@@ -85,43 +771,114 @@ def get_ai_suggestion(user_input):
                 }
             ],
             max_tokens=50,
-            temperature=0.1
+            temperature=0.1,
+            stream=True
         )
-        
-        if not completion or not completion.choices:
-            return ""
-            
-        suggestion = completion.choices[0].message.content.strip()
-        suggestion = suggestion.split("\n")[0].split("#")[0].strip().strip('"').strip("'")
-        
-        # Ensure suggestion starts with user input
-        if suggestion and not suggestion.startswith(user_input):
-            suggestion = user_input + suggestion
-        elif suggestion == user_input:
-            suggestion += " "
-        
+
+        text = ""
+        try:
+            async for chunk in stream:
+                if not chunk.choices or not chunk.choices[0].delta.content:
+                    continue
+                text += chunk.choices[0].delta.content
+                content = text.lstrip()
+                if "\n" in content or "#" in content:
+                    break
+                # Hold back while the model is still echoing what was typed
+                if on_partial and not user_input.startswith(content.strip('"').strip("'")):
+                    on_partial(_clean_suggestion(user_input, content))
+        finally:
+            # Closing the stream stops generation of tokens we would throw away
+            await stream.close()
+
         # print(f"Got suggestion: {suggestion}")  # Debug print
-        return suggestion
+        return _clean_suggestion(user_input, text)
         
+    except AIUnavailable:
+        return ""  # History and the cache keep suggesting meanwhile
     except Exception as e:
         print(f"[Error] AI suggestion failed: {str(e)}")
         return ""
 
-def get_shell_command(query):
+# Prompt size savings from build_context(), shown by !stats
+context_stats = {"builds": 0, "tokens_full": 0, "tokens_sent": 0}
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count (about four characters per token)"""
+    return (len(text) + 3) // 4
+
+def _excerpt(output: str, max_tokens: int) -> str:
+    """Keep the head and tail of output within max_tokens, marking what was cut"""
+    if estimate_tokens(output) <= max_tokens:
+        return output
+    max_chars = max(max_tokens * 4, 80)
+    head = output[:max_chars // 3]
+    tail = output[-(max_chars - len(head)):]
+    # Cut on line boundaries so excerpts do not start or end mid-line
+    if "\n" in head:
+        head = head[:head.rfind("\n") + 1]
+    if "\n" in tail:
+        tail = tail[tail.find("\n") + 1:]
+    omitted = output.count("\n") - head.count("\n") - tail.count("\n")
+    return f"{head}[... {max(omitted, 0)} lines omitted ...]\n{tail}"
+
+def build_context(entries: List[Dict], budget: int = CONTEXT_TOKEN_BUDGET) -> str:
+    """Render recent commands and outputs for a prompt within a token budget.
+
+    Repeated runs with identical output are kept only once (the newest), and
+    each older entry gets half the share of the one after it, with unused
+    budget flowing back to older entries. Long outputs are cut to head/tail
+    excerpts.
+    """
+    if not entries:
+        return "No previous commands"
+
+    unique = []
+    seen = set()
+    for ctx in reversed(entries):
+        key = (ctx['command'], ctx['output'])
+        if key not in seen:
+            seen.add(key)
+            unique.append(ctx)
+
+    weights = [0.5 ** age for age in range(len(unique))]
+    remaining = budget
+    rendered = []
+    for i, ctx in enumerate(unique):
+        status = f" (exit status {ctx['returncode']})" if ctx.get('returncode') else ""
+        header = f"Previous command: {ctx['command']}{status}\nOutput: "
+        output = ctx['output'] or ''
+        if ctx.get('errors'):
+            output += f"\nErrors: {ctx['errors']}"
+        share = int(remaining * weights[i] / sum(weights[i:])) - estimate_tokens(header)
+        block = f"{header}{_excerpt(output, max(share, 0))}\n"
+        remaining -= estimate_tokens(block)
+        rendered.append(block)
+    context_str = "\n".join(reversed(rendered))
+
+    context_stats["builds"] += 1
+    context_stats["tokens_full"] += sum(
+        estimate_tokens(f"Previous command: {ctx['command']}\nOutput: {ctx['output']}\n") for ctx in entries
+    )
+    context_stats["tokens_sent"] += estimate_tokens(context_str)
+    return context_str
+
+async def get_shell_command(query, context: Optional[List[Dict]] = None):
     """Convert natural language query to shell command with context awareness"""
+    if context is None:
+        context = command_context[-COMMAND_HISTORY_LIMIT:]
     try:
+        command = await call_daemon('translate', {'query': query, 'context': context})
+        if command is not DAEMON_UNAVAILABLE:
+            if command:
+                print(f"Generated command: {command}")
+            return command
+
         # Build context from recent commands
-        context_str = ""
-        if command_context:
-            context_str = "\n".join([
-                f"Previous command: {ctx['command']}\nOutput: {ctx['output']}\n"
-                for ctx in command_context[-COMMAND_HISTORY_LIMIT:]
-            ])
-        else:
-            context_str = "No previous commands"
+        context_str = build_context(context)
             
-        completion = client.chat.completions.create(
-            model="openai/gpt-3.5-turbo:free",
+        completion = await model_router.complete(
+            'translation',
             messages=[
                 {
                     "role": "system", 
@@ -150,26 +907,79 @@ def get_shell_command(query):
         print(f"Generated command: {command}")  # Debug print
         return command
         
+    except AIUnavailable as e:
+        print(f"AI is paused: {e}")
+        return None
     except Exception as e:
         print(f"Error in get_shell_command: {type(e).__name__}: {str(e)}")
         return None
-def fetch_suggestion_async(text, session):
-    """Fetch suggestions asynchronously to avoid blocking the UI."""
-    global current_suggestion
-    
-    if len(text.strip()) < 2:
+class SuggestionScheduler:
+    """Fetches AI suggestions as a single task on the prompt's event loop.
+
+    Requests are debounced on the trailing edge so the last keystroke is always
+    fetched, and every buffer change bumps a generation number and cancels the
+    task in flight (closing its stream), so results for older text are dropped.
+    """
+
+    def __init__(self, session, delay: float = 0.3):
+        self.session = session
+        self.delay = delay
+        self._generation = 0
+        self._task = None
+
+    def schedule(self, text: str):
+        """Request a suggestion for text once typing pauses for `delay` seconds"""
+        self._generation += 1
+        if self._task:
+            self._task.cancel()
+        self._task = asyncio.get_running_loop().create_task(self._run(text, self._generation))
+
+    def cancel(self):
+        """Abandon the pending or in-flight request"""
+        global current_suggestion
+        self._generation += 1
+        if self._task:
+            self._task.cancel()
+            self._task = None
         with suggestion_lock:
             current_suggestion = ""
-        return
-        
-    suggestion = get_ai_suggestion(text)
-    
-    with suggestion_lock:
-        current_suggestion = suggestion
-    
-    # Force a refresh of the UI
-    if session.app:
-        session.app.invalidate()
+
+    def _is_current(self, generation: int) -> bool:
+        return generation == self._generation
+
+    async def _run(self, text: str, generation: int):
+        await asyncio.sleep(self.delay)
+        try:
+            await self._fetch(text, generation)
+        except Exception:
+            pass
+
+    async def _fetch(self, text: str, generation: int):
+        # A previously run command answers locally; the model is only asked when there is none
+        if history_index.best_match(text):
+            return
+
+        def show(suggestion):
+            global current_suggestion
+            buffer = self.session.default_buffer
+            if not self._is_current(generation) or buffer.document.text != text:
+                return
+            with suggestion_lock:
+                current_suggestion = suggestion
+            # The buffer only asks AIAutoSuggest again after an insert, so set what it draws directly
+            if suggestion and suggestion.startswith(text) and suggestion != text:
+                buffer.suggestion = Suggestion(suggestion[len(text):])
+            if self.session.app:
+                self.session.app.invalidate()
+
+        cwd = os.getcwd()
+        # Hit rates count prefixes that would be fetched; with a daemon, it counts its own lookups
+        suggestion = suggestion_cache.get(text, cwd, record=daemon is None)
+        if suggestion is None:
+            suggestion = await get_ai_suggestion(text, on_partial=show)
+            if daemon is None:  # Otherwise the daemon caches it for every terminal
+                suggestion_cache.put(text, cwd, suggestion)
+        show(suggestion)
 
 class AIAutoSuggest(AutoSuggest):
     """Custom AutoSuggest class for AI-powered command completion."""
@@ -177,6 +987,16 @@ class AIAutoSuggest(AutoSuggest):
         typed_text = document.text
         if not typed_text.strip():
             return None
+
+        local = history_index.best_match(typed_text)
+        if local:
+            return Suggestion(local[len(typed_text):])
+
+        # Answer straight from the cache; the network is only used on a miss. Runs on
+        # every keystroke, so the scheduler's lookup is the one counted in the stats
+        cached = suggestion_cache.get(typed_text, os.getcwd(), record=False)
+        if cached and cached != typed_text:
+            return Suggestion(cached[len(typed_text):])
             
         with suggestion_lock:
             suggestion = current_suggestion
@@ -185,150 +1005,1070 @@ class AIAutoSuggest(AutoSuggest):
             return Suggestion(suggestion[len(typed_text):])
         return None
 
-def is_destructive_command(command: str) -> tuple[bool, str, list]:
+# Tokens that separate simple commands in a command line
+COMMAND_SEPARATOR_CHARS = set('|&;()')
+# Characters of redirection operator tokens (>, >>, <, >&, &>, <<, >|)
+REDIRECT_CHARS = set('<>&|')
+# Wrappers that run the rest of the line as a command
+COMMAND_WRAPPERS = {'nohup', 'time', 'command', 'exec', 'builtin', 'nice', 'ionice', 'env', 'xargs', 'watch'}
+# sudo options that take a value
+SUDO_VALUE_OPTIONS = {'-u', '-g', '-p', '-C', '-D', '-h', '-r', '-t', '-U', '-T'}
+# Device files that are fine to redirect to
+SAFE_DEVICES = {'/dev/null', '/dev/stdout', '/dev/stderr', '/dev/tty', '/dev/zero'}
+SEVERITY_RANK = {'low': 0, 'medium': 1, 'high': 2, 'critical': 3}
+
+def tokenize_command(command: str) -> List[str]:
+    """Split a command line into shell words and operator tokens (|, &&, ;, >, ...)"""
+    lexer = shlex.shlex(command, posix=True, punctuation_chars=True)
+    lexer.whitespace_split = True
+    try:
+        return list(lexer)
+    except ValueError:  # Unbalanced quotes; fall back to plain whitespace splitting
+        return command.split()
+
+def parse_command_line(command: str) -> List[Dict]:
+    """Break a command line into simple commands.
+
+    Each entry has the argv with sudo/env/nohup-style prefixes and variable
+    assignments removed, the program name, whether it runs under sudo and its
+    redirections as (operator, target) pairs.
     """
-    Analyze if a command is potentially destructive using both predefined patterns and AI analysis
-    Returns: (is_destructive, reason, affected_files)
+    simple_commands = [[]]
+    for token in tokenize_command(command):
+        if token and set(token) <= COMMAND_SEPARATOR_CHARS:
+            simple_commands.append([])
+        else:
+            simple_commands[-1].append(token)
+
+    parsed = []
+    for words in simple_commands:
+        argv, redirects = [], []
+        i = 0
+        while i < len(words):
+            # Only whole operator tokens; words such as '<title>' or 'requests>=2' are arguments
+            if set(words[i]) <= REDIRECT_CHARS and ('<' in words[i] or '>' in words[i]):
+                target = words[i + 1] if i + 1 < len(words) else ''
+                # The tokenizer splits `2>` into `2` and `>`; the number is a file descriptor
+                if argv and argv[-1].isdigit():
+                    argv.pop()
+                redirects.append((words[i], target))
+                i += 2
+            else:
+                argv.append(words[i])
+                i += 1
+
+        sudo = False
+        while argv:
+            word = argv[0]
+            if word in ('sudo', 'doas'):
+                sudo = True
+                argv = argv[1:]
+                while argv and argv[0].startswith('-'):
+                    option = argv.pop(0)
+                    if option in SUDO_VALUE_OPTIONS and argv:
+                        argv.pop(0)
+            elif word in COMMAND_WRAPPERS:
+                argv = argv[1:]
+                while argv and argv[0].startswith('-'):
+                    option = argv.pop(0)
+                    if option in ('-n', '-c', '-u') and argv:
+                        argv.pop(0)
+            elif '=' in word and word.split('=', 1)[0].isidentifier():
+                argv = argv[1:]  # Variable assignment prefix
+            else:
+                break
+
+        if argv or redirects:
+            parsed.append({
+                'argv': argv,
+                'program': os.path.basename(argv[0]) if argv else '',
+                'sudo': sudo,
+                'redirects': redirects,
+            })
+    return parsed
+
+# Findings at or above this severity need confirmation before running
+CONFIRM_SEVERITY = 'medium'
+
+# Programs that only read, build or test; anything else without a rule is unclassified
+SAFE_PROGRAMS = {
+    'ls', 'll', 'la', 'cd', 'pwd', 'echo', 'printf', 'cat', 'less', 'more', 'head', 'tail', 'grep',
+    'egrep', 'rg', 'ag', 'wc', 'sort', 'uniq', 'cut', 'tr', 'diff', 'cmp', 'file', 'stat', 'du', 'df',
+    'which', 'whereis', 'type', 'whoami', 'id', 'hostname', 'uname', 'date', 'cal', 'uptime', 'env',
+    'printenv', 'history', 'clear', 'man', 'tree', 'ps', 'top', 'htop', 'free', 'jobs', 'true', 'false',
+    'make', 'pytest', 'tox', 'nox', 'jq', 'bat', 'fd', 'ping', 'dig', 'nslookup', 'vi', 'vim', 'nvim',
+    'nano', 'code', 'mkdir', 'touch', 'zip', 'gzip', 'gunzip', 'export',
+    'alias', 'unset', 'set', 'exit', 'sleep', 'xdg-open', 'open',
+    'basename', 'dirname', 'realpath', 'readlink', 'md5sum', 'sha256sum', 'base64',
+    'netstat', 'ss', 'lsof', 'traceroute', 'ifconfig', 'ip', 'lsb_release', 'nproc', 'locale',
+}
+
+# Rule functions per program. A rule gets the parsed simple command and returns
+# a finding, None when the command is safe, or UNCLASSIFIED.
+SAFETY_RULES = {}
+UNCLASSIFIED = object()
+
+# Paths whose recursive deletion or permission change is catastrophic
+CRITICAL_PATHS = {'/', '/*', '~', '~/', '~/*', '$HOME', '/home', '/etc', '/usr', '/var', '/boot',
+                  '/bin', '/sbin', '/lib', '/opt', '/root', '.', '..', '*'}
+BLOCK_DEVICE = re.compile(r'^/dev/(sd|hd|vd|xvd|nvme|mmcblk|disk|md|dm-|loop|mapper/)')
+SQL_DESTRUCTIVE = re.compile(r'\b(drop\s+(table|database|schema)|truncate|delete\s+from|alter\s+table)\b', re.IGNORECASE)
+WORLD_WRITABLE = re.compile(r'0?[0-7]{2}[2367]|[ug]*[ao][ugo]*[+=][rwxXst]*w[rwxXst]*')
+DELETION_WORDS = {'destroy', 'delete', 'remove', 'rm', 'purge', 'uninstall', 'drop', 'wipe', 'erase', 'prune'}
+
+def safety_rule(*programs):
+    """Register a rule function for the given program names"""
+    def register(rule):
+        for program in programs:
+            SAFETY_RULES[program] = rule
+        return rule
+    return register
+
+def _finding(reason: str, severity: str, kind: str, paths: Optional[List[str]] = None) -> Dict:
+    finding = {'reason': reason, 'severity': severity, 'type': kind}
+    if paths:
+        finding['paths'] = paths
+    return finding
+
+def _split_args(argv: List[str], value_options=()) -> tuple[set, List[str]]:
+    """Split arguments into a flag set (bundled short flags separated) and operands.
+
+    value_options are options whose value is the next word, so it is not
+    mistaken for an operand such as a subcommand.
     """
-    # First check hardcoded patterns
-    destructive_patterns = {
-        r'\brm\s+-[rf]*\b': {'reason': 'File/directory deletion', 'severity': 'high', 'type': 'filesystem'},
-        r'\bsystemctl\s+(stop|restart|disable)\b': {'reason': 'Service interruption', 'severity': 'high', 'type': 'service'},
-        r'\bservice\s+\w+\s+(stop|restart)\b': {'reason': 'Service interruption', 'severity': 'high', 'type': 'service'},
-        r'\bgit\s+reset\s+--hard\b': {'reason': 'Hard reset of git changes', 'severity': 'high', 'type': 'git'},
-        r'\bgit\s+clean\s+-[fd]+\b': {'reason': 'Removal of untracked files', 'severity': 'medium', 'type': 'git'},
-        r'\bgit\s+push\s+(-f|--force)\b': {'reason': 'Force push to repository', 'severity': 'high', 'type': 'git'},
-        r'\bgit\s+revert\b': {'reason': 'Reverting commits', 'severity': 'medium', 'type': 'git'},
-        r'\bdd\b': {'reason': 'Direct disk operations', 'severity': 'critical', 'type': 'system'},
-        r'\bformat\b': {'reason': 'Formatting operations', 'severity': 'critical', 'type': 'system'},
-        r'[>|2]>\s*/dev': {'reason': 'Device file operations', 'severity': 'high', 'type': 'system'},
-        r'\bchmod\s+-[R]*\b': {'reason': 'Recursive permission changes', 'severity': 'medium', 'type': 'filesystem'},
-        r'\bsudo\s+': {'reason': 'Administrative privileges required', 'severity': 'medium', 'type': 'system'}
-    }
-    
-    affected_files = []
-    
-    # Check predefined patterns first
-    for pattern, info in destructive_patterns.items():
-        if re.search(pattern, command, re.IGNORECASE):
-            # Existing logic for getting affected files
-            if 'rm' in command:
-                try:
-                    parts = command.split()
-                    path_index = next(i for i, part in enumerate(parts) 
-                                   if not part.startswith('-') and part != 'rm')
-                    path = parts[path_index]
-                    expanded_paths = glob.glob(path)
-                    if not expanded_paths:
-                        expanded_paths = [path]
-                    
-                    for expanded_path in expanded_paths:
-                        if os.path.exists(expanded_path):
-                            if os.path.isfile(expanded_path):
-                                affected_files.append(expanded_path)
-                            else:
-                                for root, dirs, files in os.walk(expanded_path):
-                                    if files:
-                                        affected_files.append(root + '/')
-                                    for file in files:
-                                        affected_files.append(os.path.join(root, file))
-                                        
-                except Exception as e:
-                    affected_files = [f'Unable to determine affected files: {str(e)}']
-            
-            elif command.startswith('git'):
-                # Existing git file detection logic
+    flags, operands = set(), []
+    args = iter(argv[1:])
+    for arg in args:
+        if arg == '--':
+            operands.extend(args)
+        elif arg.startswith('--'):
+            flags.add(arg.split('=', 1)[0])
+            if arg in value_options:
+                next(args, None)
+        elif arg.startswith('-') and len(arg) > 1 and not arg[1].isdigit():
+            flags.update(f'-{flag}' for flag in arg[1:])
+            if arg in value_options:
+                next(args, None)
+        else:
+            operands.append(arg)
+    return flags, operands
+
+def _is_critical_path(path: str) -> bool:
+    return path.rstrip('/') in CRITICAL_PATHS or path in CRITICAL_PATHS
+
+@safety_rule('rm', 'rmdir', 'unlink', 'shred', 'truncate')
+def _removal_rule(sub):
+    flags, operands = _split_args(sub['argv'], value_options={'-s', '--size', '-n', '--iterations'})
+    program = sub['program']
+    if program == 'rmdir':
+        return _finding('Removes empty directories', 'low', 'filesystem')
+    if program == 'shred':
+        return _finding('Irrecoverably overwrites files', 'high', 'filesystem')
+    if program == 'truncate':
+        return _finding('Truncates files', 'medium', 'filesystem')
+    if program == 'unlink':
+        return _finding('File deletion', 'medium', 'filesystem')
+    recursive = flags & {'-r', '-R', '--recursive'}
+    if recursive and any(_is_critical_path(path) for path in operands):
+        return _finding('Recursive deletion of a system, home or current directory', 'critical', 'filesystem')
+    if flags & {'-i', '-I', '--interactive'} and '-f' not in flags:
+        return _finding('File deletion (rm asks before each removal)', 'low', 'filesystem')
+    if recursive:
+        return _finding('Recursive file/directory deletion', 'high', 'filesystem')
+    return _finding('File/directory deletion', 'medium', 'filesystem')
+
+@safety_rule('mv', 'cp', 'ln', 'install', 'rsync')
+def _overwrite_rule(sub):
+    flags, operands = _split_args(sub['argv'], value_options={'-t', '--target-directory', '-S', '-m', '-o', '-g', '-e'})
+    if sub['program'] == 'rsync':
+        if flags & {'--delete', '--delete-before', '--delete-after', '--delete-during', '--remove-source-files'}:
+            return _finding('Deletes files at the destination', 'high', 'filesystem')
+        return None
+    if sub['program'] == 'ln' and not flags & {'-f', '--force'}:
+        return None
+    if flags & {'-n', '--no-clobber', '-i', '--interactive', '-b', '--backup'} or len(operands) < 2:
+        return None
+    destination = os.path.expanduser(operands[-1])
+    if os.path.isdir(destination):
+        targets = [os.path.join(destination, os.path.basename(src.rstrip('/'))) for src in operands[:-1]]
+    else:
+        targets = [destination]
+    overwritten = [target for target in targets if os.path.isfile(target)]
+    if overwritten:
+        return _finding(f'Overwrites existing file {overwritten[0]}', 'medium', 'filesystem', overwritten)
+    return None
+
+@safety_rule('tee')
+def _tee_rule(sub):
+    flags, operands = _split_args(sub['argv'])
+    if flags & {'-a', '--append'}:
+        return None
+    overwritten = [path for path in operands if os.path.isfile(os.path.expanduser(path))]
+    if overwritten:
+        return _finding(f'Truncates existing file {overwritten[0]}', 'medium', 'filesystem', overwritten)
+    return None
+
+@safety_rule('sed')
+def _sed_rule(sub):
+    flags, _ = _split_args(sub['argv'], value_options={'-e', '--expression', '-f', '--file', '-l'})
+    if flags & {'-i', '--in-place'}:
+        return _finding('Edits files in place', 'medium', 'filesystem')
+    return None
+
+@safety_rule('tar')
+def _tar_rule(sub):
+    argv = sub['argv']
+    # Old-style bundled options without a dash: tar xzf archive.tgz
+    if len(argv) > 1 and not argv[1].startswith('-'):
+        argv = [argv[0], '-' + argv[1]] + argv[2:]
+    flags, _ = _split_args(argv, value_options={'-f', '--file', '-C', '--directory', '-T', '-X'})
+    if '--remove-files' in flags:
+        return _finding('Deletes files after adding them to the archive', 'high', 'filesystem')
+    if flags & {'-x', '--extract', '--get'}:
+        if flags & {'-k', '--keep-old-files', '--skip-old-files'} and '--overwrite' not in flags:
+            return None
+        return _finding('Extracts over existing files', 'medium', 'filesystem')
+    return None
+
+@safety_rule('dd')
+def _dd_rule(sub):
+    target = next((arg[3:] for arg in sub['argv'][1:] if arg.startswith('of=')), None)
+    if not target:
+        return None
+    if BLOCK_DEVICE.match(target):
+        return _finding('Direct disk operations', 'critical', 'system')
+    if target.startswith('/dev/') and target not in SAFE_DEVICES:
+        return _finding('Direct device write', 'high', 'system')
+    if os.path.exists(os.path.expanduser(target)):
+        return _finding(f'Overwrites existing file {target}', 'medium', 'filesystem', [target])
+    return None
+
+@safety_rule('mkfs', 'format', 'fdisk', 'sfdisk', 'gdisk', 'sgdisk', 'parted', 'wipefs', 'mkswap')
+def _disk_rule(sub):
+    if sub['program'] in ('fdisk', 'sfdisk', 'parted') and {'-l', '--list'} & _split_args(sub['argv'])[0]:
+        return None
+    return _finding('Formatting or partitioning a disk', 'critical', 'system')
+
+@safety_rule('chmod', 'chown', 'chgrp')
+def _permission_rule(sub):
+    flags, operands = _split_args(sub['argv'], value_options={'--reference'})
+    recursive = flags & {'-R', '--recursive'}
+    paths = operands[1:]
+    system = any(_is_critical_path(path) or path.startswith(('/etc', '/usr', '/bin', '/boot')) for path in paths)
+    if recursive and system:
+        return _finding('Recursive permission changes on system directories', 'critical', 'filesystem')
+    if recursive:
+        return _finding('Recursive permission changes', 'medium', 'filesystem')
+    if system:
+        return _finding('Permission changes on system files', 'high', 'filesystem')
+    if sub['program'] == 'chmod' and operands and WORLD_WRITABLE.fullmatch(operands[0]):
+        return _finding('Makes files world-writable', 'medium', 'filesystem')
+    return None
+
+@safety_rule('git')
+def _git_rule(sub):
+    flags, operands = _split_args(sub['argv'], value_options={'-C', '-c', '--git-dir', '--work-tree', '-m', '-b', '-B'})
+    subcommand = operands[0] if operands else ''
+    args = operands[1:]
+    if subcommand == 'reset' and '--hard' in flags:
+        return _finding('Hard reset of git changes', 'high', 'git')
+    if subcommand == 'clean' and flags & {'-f', '--force'} and not flags & {'-n', '--dry-run'}:
+        if flags & {'-x', '-X'}:
+            return _finding('Removal of untracked and ignored files', 'high', 'git')
+        return _finding('Removal of untracked files', 'medium', 'git')
+    if subcommand == 'push':
+        if flags & {'-f', '--force', '--mirror'} or any(arg.startswith('+') for arg in args):
+            return _finding('Force push to repository', 'high', 'git')
+        if flags & {'-d', '--delete'} or any(arg.startswith(':') for arg in args):
+            return _finding('Deletes a remote branch', 'high', 'git')
+        if '--force-with-lease' in flags:
+            return _finding('Force push to repository (with lease)', 'medium', 'git')
+        return None
+    if subcommand == 'revert':
+        return _finding('Reverting commits', 'medium', 'git')
+    if subcommand == 'checkout' and ('--' in sub['argv'] or '.' in args or flags & {'-f', '--force'}):
+        return _finding('Discards local changes', 'medium', 'git')
+    if subcommand == 'restore' and (not flags & {'-S', '--staged'} or flags & {'-W', '--worktree'}):
+        return _finding('Discards local changes', 'medium', 'git')
+    if subcommand == 'branch' and ('-D' in flags or ('-d' in flags and '-f' in flags)):
+        return _finding('Deletes a branch', 'medium', 'git')
+    if subcommand == 'stash' and args[:1] in (['drop'], ['clear']):
+        return _finding('Deletes stashed changes', 'medium', 'git')
+    if subcommand in ('filter-branch', 'filter-repo'):
+        return _finding('Rewrites repository history', 'high', 'git')
+    if subcommand == 'rebase':
+        return _finding('Rewrites commit history', 'low', 'git')
+    return None
+
+@safety_rule('docker', 'podman')
+def _docker_rule(sub):
+    flags, operands = _split_args(sub['argv'], value_options={'-H', '--host', '--context', '-c', '--config', '-l', '--log-level'})
+    words = operands[:3]
+    if 'prune' in words:
+        return _finding('Deletes unused containers, images or volumes', 'high', 'container')
+    if words[:2] == ['compose', 'down']:
+        if flags & {'-v', '--volumes'}:
+            return _finding('Removes containers and their volumes', 'high', 'container')
+        return _finding('Stops and removes containers', 'medium', 'container')
+    if words[:1] == ['volume'] and 'rm' in words:
+        return _finding('Deletes Docker volumes and their data', 'high', 'container')
+    if 'rm' in words[:2] or 'rmi' in words[:1]:
+        severity = 'high' if flags & {'-f', '--force'} else 'medium'
+        return _finding('Removes Docker resources', severity, 'container')
+    if words[:1] in (['kill'], ['stop']) or words[1:2] in (['kill'], ['stop']):
+        return _finding('Stops running containers', 'medium', 'container')
+    return None
+
+@safety_rule('kubectl', 'oc')
+def _kubectl_rule(sub):
+    flags, operands = _split_args(sub['argv'], value_options={
+        '-n', '--namespace', '--context', '--cluster', '--kubeconfig', '--user', '-l', '--selector',
+        '-o', '--output', '-f', '--filename', '-c', '--container', '--replicas'
+    })
+    subcommand = operands[0] if operands else ''
+    if subcommand == 'delete':
+        if flags & {'--all', '-A', '--all-namespaces'} or operands[1:2] in (['namespace'], ['ns']):
+            return _finding('Deletes Kubernetes resources across a namespace or cluster', 'critical', 'kubernetes')
+        return _finding('Deletes Kubernetes resources', 'high', 'kubernetes')
+    if subcommand == 'drain':
+        return _finding('Evicts all pods from a node', 'high', 'kubernetes')
+    if subcommand in ('cordon', 'taint', 'scale', 'patch', 'edit', 'label', 'annotate'):
+        return _finding('Changes live Kubernetes resources', 'medium', 'kubernetes')
+    if subcommand == 'rollout' and operands[1:2] in (['restart'], ['undo']):
+        return _finding('Restarts or rolls back a deployment', 'medium', 'kubernetes')
+    if subcommand in ('apply', 'replace') and flags & {'--force', '--prune'}:
+        return _finding('Force-replaces or prunes Kubernetes resources', 'high', 'kubernetes')
+    return None
+
+@safety_rule('systemctl', 'service')
+def _service_rule(sub):
+    _, operands = _split_args(sub['argv'], value_options={'-H', '--host', '-M', '--machine', '-t', '--type'})
+    if sub['program'] == 'service':
+        action = operands[1] if len(operands) > 1 else ''
+    else:
+        action = operands[0] if operands else ''
+    if action in ('reboot', 'poweroff', 'halt', 'kexec', 'suspend', 'hibernate', 'rescue', 'emergency'):
+        return _finding('Reboots, suspends or powers off the machine', 'critical', 'system')
+    if action in ('stop', 'restart', 'disable', 'mask', 'kill', 'isolate', 'try-restart', 'force-reload'):
+        return _finding('Service interruption', 'high', 'service')
+    return None
+
+@safety_rule('reboot', 'shutdown', 'poweroff', 'halt', 'init')
+def _power_rule(sub):
+    return _finding('Reboots or powers off the machine', 'critical', 'system')
+
+@safety_rule('apt', 'apt-get', 'dnf', 'yum', 'zypper', 'pacman', 'brew', 'snap', 'pip', 'pip3', 'npm',
+             'yarn', 'pnpm', 'gem', 'cargo', 'conda', 'port', 'apk')
+def _package_rule(sub):
+    flags, operands = _split_args(sub['argv'], value_options={'-n', '--name', '-p', '--prefix', '-r', '--requirement'})
+    action = operands[0] if operands else ''
+    removing = action in ('remove', 'purge', 'autoremove', 'erase', 'uninstall', 'un', 'rm', 'r', 'unlink', 'del')
+    if sub['program'] == 'pacman':
+        removing = any(flag in flags for flag in ('-R', '--remove'))
+    unattended = flags & {'-y', '--yes', '--assume-yes', '--noconfirm'}
+    if removing:
+        return _finding('Removes installed packages', 'high' if unattended else 'medium', 'package')
+    if action in ('dist-upgrade', 'full-upgrade'):
+        return _finding('Upgrades all system packages', 'medium', 'package')
+    return None
+
+@safety_rule('find')
+def _find_rule(sub):
+    argv = sub['argv']
+    if '-delete' in argv:
+        return _finding('Deletes matching files', 'high', 'filesystem')
+    for i, arg in enumerate(argv):
+        if arg in ('-exec', '-execdir', '-ok', '-okdir') and i + 1 < len(argv):
+            inner = SAFETY_RULES.get(os.path.basename(argv[i + 1]))
+            if inner in (_removal_rule, _overwrite_rule, _permission_rule):
+                return _finding('Runs a destructive command on every match', 'high', 'filesystem')
+    return None
+
+@safety_rule('kill', 'pkill', 'killall')
+def _kill_rule(sub):
+    flags, operands = _split_args(sub['argv'])
+    if flags & {'-l', '-L', '--list'} or not operands:
+        return None
+    if '-1' in sub['argv'][1:] and sub['program'] == 'kill':
+        return _finding('Kills every process you own', 'critical', 'process')
+    return _finding('Terminates processes', 'medium', 'process')
+
+@safety_rule('crontab')
+def _crontab_rule(sub):
+    if '-r' in sub['argv']:
+        return _finding('Deletes all cron jobs', 'high', 'system')
+    return None
+
+@safety_rule('psql', 'mysql', 'sqlite3', 'mongo', 'mongosh', 'redis-cli')
+def _database_rule(sub):
+    text = ' '.join(sub['argv'][1:])
+    if SQL_DESTRUCTIVE.search(text) or re.search(r'\b(flushall|flushdb|dropDatabase)\b', text, re.IGNORECASE):
+        return _finding('Destructive database statement', 'high', 'database')
+    return UNCLASSIFIED if sub['redirects'] else None
+
+@safety_rule('terraform', 'pulumi', 'helm', 'cdk')
+def _infrastructure_rule(sub):
+    flags, operands = _split_args(sub['argv'], value_options={'-var', '-var-file', '-n', '--namespace', '-s', '--stack'})
+    action = operands[0] if operands else ''
+    if action in ('destroy', 'uninstall', 'delete'):
+        return _finding('Destroys infrastructure or releases', 'high', 'infrastructure')
+    if action in ('apply', 'up', 'deploy') and flags & {'-auto-approve', '--auto-approve', '-y', '--yes'}:
+        return _finding('Applies infrastructure changes without review', 'medium', 'infrastructure')
+    return None
+
+@safety_rule('sh', 'bash', 'zsh', 'dash')
+def _shell_rule(sub):
+    argv = sub['argv']
+    if '-c' in argv and argv.index('-c') + 1 < len(argv):
+        return _most_severe(argv[argv.index('-c') + 1])
+    return UNCLASSIFIED
+
+def _most_severe(command: str):
+    """The worst finding for a nested command line, UNCLASSIFIED when part of it is unknown, else None"""
+    findings, unclassified = classify_command(command)
+    if findings:
+        return max(findings, key=lambda finding: SEVERITY_RANK[finding['severity']])
+    return UNCLASSIFIED if unclassified else None
+
+@safety_rule('ssh')
+def _ssh_rule(sub):
+    _, operands = _split_args(sub['argv'], value_options={
+        '-b', '-c', '-D', '-E', '-e', '-F', '-I', '-i', '-J', '-L', '-l', '-m', '-O', '-o', '-p', '-Q',
+        '-R', '-S', '-W', '-w', '-B'})
+    # Everything after the host is the remote command line
+    if len(operands) < 2:
+        return None
+    return _most_severe(' '.join(operands[1:]))
+
+@safety_rule('source', '.')
+def _source_rule(sub):
+    _, operands = _split_args(sub['argv'])
+    if operands and os.path.basename(operands[0]) == 'activate':
+        return None
+    return UNCLASSIFIED  # Runs whatever the file contains
+
+@safety_rule('awk', 'gawk', 'mawk', 'nawk')
+def _awk_rule(sub):
+    flags, operands = _split_args(sub['argv'], value_options={'-F', '-v', '-f', '-i', '--include'})
+    argv = sub['argv']
+    if '-f' in argv or '--file' in flags:
+        return UNCLASSIFIED  # The program is in a file
+    if any(argv[i:i + 2] in (['-i', 'inplace'], ['--include', 'inplace']) for i in range(len(argv))):
+        return _finding('Edits files in place', 'medium', 'filesystem')
+    program = operands[0] if operands else ''
+    if re.search(r'\bsystem\s*\(|\|\s*(getline|")|>\s*"|>>', program):
+        return _finding('awk program runs commands or writes files', 'medium', 'system')
+    return None
+
+def _option_value(argv: List[str], options) -> Optional[str]:
+    """Value of the last of the given options, written `-o value`, `-fso value`, `-ovalue` or `--opt=value`"""
+    value = None
+    for i, arg in enumerate(argv[1:], 1):
+        for option in options:
+            bundled = len(option) == 2 and arg[:1] == '-' and arg[1:2] != '-' and arg.endswith(option[1])
+            if (arg == option or bundled) and i + 1 < len(argv):
+                value = argv[i + 1]
+            elif arg.startswith(option + '=') and option.startswith('--'):
+                value = arg.split('=', 1)[1]
+            elif len(option) == 2 and not option.startswith('--') and arg.startswith(option) and len(arg) > 2:
+                value = arg[2:]
+    return value
+
+@safety_rule('curl', 'wget')
+def _download_rule(sub):
+    argv = sub['argv']
+    if sub['program'] == 'curl':
+        target = _option_value(argv, ('-o', '--output'))
+        if target is None and ({'-O', '--remote-name'} & _split_args(argv)[0]):
+            urls = [arg for arg in argv[1:] if '://' in arg]
+            target = os.path.basename(urls[-1].split('?')[0]) if urls else None
+    else:
+        target = _option_value(argv, ('-O', '--output-document'))
+    if target and target != '-' and os.path.isfile(os.path.expanduser(target)):
+        return _finding(f'Overwrites existing file {target}', 'medium', 'filesystem', [target])
+    return None
+
+def _redirect_finding(sub: Dict) -> Optional[Dict]:
+    """Flag redirections that write to devices or truncate existing files"""
+    for op, target in sub['redirects']:
+        if '>' not in op or op.endswith('>>') or target.isdigit() or target == '-':
+            continue
+        if target.startswith('/dev/'):
+            if target in SAFE_DEVICES:
+                continue
+            if BLOCK_DEVICE.match(target):
+                return _finding('Writes directly to a disk device', 'critical', 'system')
+            return _finding('Device file operations', 'high', 'system')
+        if os.path.isfile(os.path.expanduser(target)):
+            return _finding(f'Truncates existing file {target}', 'medium', 'filesystem', [target])
+    return None
+
+def classify_command(command: str) -> tuple[List[Dict], List[Dict]]:
+    """Classify every simple command in a command line with the local safety rules.
+
+    Returns (findings, unclassified): one finding per flagged simple command,
+    with reason, severity, type and the parsed command it came from, and the
+    simple commands no rule knows about.
+    """
+    findings, unclassified = [], []
+    previous = None
+    for sub in parse_command_line(command):
+        program = sub['program'].lower()
+        rule = SAFETY_RULES.get(program) or SAFETY_RULES.get(program.split('.', 1)[0])
+        if rule:
+            info = rule(sub)
+        elif not program or program in SAFE_PROGRAMS:
+            info = None
+        elif DELETION_WORDS.intersection([arg for arg in sub['argv'][1:] if not arg.startswith('-')][:2]):
+            info = _finding(f'`{program}` subcommand suggests deletion', 'medium', 'unknown')
+        else:
+            info = UNCLASSIFIED
+
+        # curl ... | sh runs whatever the download contains; with no script operand the shell reads stdin
+        if (program in ('sh', 'bash', 'zsh', 'dash') and previous and previous['program'] in ('curl', 'wget')
+                and not any(not arg.startswith('-') for arg in sub['argv'][1:2])):
+            info = _finding('Runs a downloaded script', 'high', 'system')
+
+        if info is None or info is UNCLASSIFIED:
+            info = _redirect_finding(sub) or info
+        if info is None and sub['sudo']:
+            info = _finding('Administrative privileges required', 'medium', 'system')
+
+        if info is UNCLASSIFIED:
+            unclassified.append(sub)
+        elif info:
+            findings.append(dict(info, command=sub))
+        previous = sub
+    return findings, unclassified
+
+# Leading words kept in the command shape, since they decide what a program does:
+# subcommands (`gcloud compute instances stop`, `heroku pg:reset`) and script names (`npm run nuke`)
+SUBCOMMAND_WORD = re.compile(r'[A-Za-z][\w:.@+-]*')
+SUBCOMMAND_DEPTH = 3
+
+# Interpreters whose script, -m module or -c/-e code decides what they do; kept in the command shape
+INTERPRETERS = {'python', 'node', 'bash', 'sh', 'zsh', 'ruby', 'perl', 'php', 'deno', 'bun'}
+INLINE_CODE_OPTIONS = {'-m', '-c', '-e', '-r'}
+
+def runs_script(program: str) -> bool:
+    """True for interpreters and path-invoked scripts, whose effect depends on code no rule can see"""
+    return '/' in program or re.sub(r'[\d.]+$', '', os.path.basename(program)) in INTERPRETERS
+
+def _script_operand(program: str, args: List[str]) -> List[str]:
+    """Words of args naming what an interpreter or a path-invoked script runs; empty for other programs"""
+    if not runs_script(program):
+        return []
+    for i, arg in enumerate(args):
+        if arg in INLINE_CODE_OPTIONS and i + 1 < len(args):
+            return args[i:i + 2]
+        if not arg.startswith('-'):
+            return [arg]
+    return []
+
+def command_shape(command: str) -> str:
+    """Abstract a command line to program + subcommands + flag set, with paths and values as <arg>.
+
+    `ls -la /tmp` and `ls -al ~/src` share the shape `ls -a -l <arg>`, so one
+    safety verdict covers both, while `heroku apps` and `heroku pg:reset DB`
+    keep their subcommand words and do not.
+    """
+    shapes = []
+    for sub in parse_command_line(command):
+        argv = sub['argv']
+        words = ['sudo'] if sub['sudo'] else []
+        if argv:
+            words.append(sub['program'])
+            rest = argv[1:]
+            script = _script_operand(argv[0], rest)
+            if script:
+                # `python drop_db.py` must not share a verdict with `python manage.py`
+                if '/' in argv[0]:
+                    words[-1] = argv[0]
+                words.extend(script)
+                i = rest.index(script[0])
+                rest = rest[:i] + rest[i + len(script):]
+            # The first run of word-like operands after any leading flags; for a script,
+            # the words after it (`python manage.py flush`)
+            start = next((i for i, arg in enumerate(rest) if not arg.startswith('-')), len(rest))
+            end = start
+            while end < len(rest) and end - start < SUBCOMMAND_DEPTH and SUBCOMMAND_WORD.fullmatch(rest[end]):
+                end += 1
+            words.extend(rest[start:end])
+            rest = rest[:start] + rest[end:]
+            flags = set()
+            has_args = False
+            for arg in rest:
+                if arg.startswith('--'):
+                    flags.add(arg.split('=', 1)[0])
+                elif arg.startswith('-') and len(arg) > 1:
+                    flags.update(f'-{flag}' for flag in arg[1:])
+                else:
+                    has_args = True
+            words.extend(sorted(flags))
+            if has_args:
+                words.append('<arg>')
+        words.extend(f'{op} <arg>' for op, _ in sub['redirects'])
+        shapes.append(' '.join(words))
+    return ' | '.join(shapes)
+
+class VerdictCache(PersistentLRU):
+    """AI safety verdicts keyed by command shape, persisted between sessions"""
+
+    def get(self, command: str) -> Optional[Dict]:
+        return self.lookup(command_shape(command))
+
+    def put(self, command: str, verdict: Dict):
+        self.store(command_shape(command), verdict)
+
+verdict_cache = VerdictCache(
+    CACHE_DIR / "verdicts.json",
+    max_entries=int(os.getenv("AISHELL_VERDICT_CACHE_SIZE", "5000")),
+    ttl=float(os.getenv("AISHELL_VERDICT_CACHE_TTL", str(30 * 24 * 3600)))
+)
+atexit.register(verdict_cache.save)
+safety_stats = {"local": 0, "background": 0}
+
+PREVIEW_MAX_ENTRIES = 10  # Paths listed in the confirmation prompt
+PREVIEW_MAX_SCAN = 200_000  # Directory entries visited before giving up
+PREVIEW_TIME_LIMIT = 1.0  # Seconds spent counting before giving up
+
+def _format_size(size: float) -> str:
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if size < 1024:
+            return f"{size:.0f} {unit}"
+        size /= 1024
+    return f"{size:.1f} TB"
+
+class FilePreview:
+    """Bounded listing of the files an operation would touch.
+
+    Only the first max_entries paths are kept; beyond that files are just
+    counted and their sizes summed. complete is False when the scan stopped
+    early at a cap or was cancelled, making count and total_size lower bounds.
+    """
+
+    def __init__(self, max_entries: int = PREVIEW_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.entries = []  # Directories end with '/'
+        self.count = 0
+        self.dirs = 0
+        self.total_size = 0
+        self.complete = True
+
+    def add(self, path: str, size: int = 0, is_dir: bool = False):
+        if is_dir:
+            self.dirs += 1
+        else:
+            self.count += 1
+            self.total_size += size
+        if len(self.entries) < self.max_entries:
+            self.entries.append(path)
+
+    def __bool__(self):
+        return bool(self.count or self.dirs or self.entries)
+
+    def summary(self) -> str:
+        at_least = "" if self.complete else "at least "
+        text = f"{at_least}{self.count} file(s), {_format_size(self.total_size)}"
+        if self.dirs:
+            text += f" in {self.dirs} director{'y' if self.dirs == 1 else 'ies'}"
+        return text
+
+def preview_paths(paths: List[str], preview: FilePreview, cancel: Optional[threading.Event] = None,
+                  max_scan: int = PREVIEW_MAX_SCAN, time_limit: float = PREVIEW_TIME_LIMIT):
+    """Walk paths with os.scandir, stopping at max_scan entries (files and directories), time_limit or cancel"""
+    deadline = time.monotonic() + time_limit
+    scanned = 0
+
+    def out_of_budget() -> bool:
+        return time.monotonic() > deadline or bool(cancel and cancel.is_set())
+
+    for pattern in paths:
+        expanded_paths = glob.glob(os.path.expanduser(pattern)) or [pattern]
+        for path in expanded_paths:
+            if not os.path.lexists(path):
+                continue
+            if not os.path.isdir(path) or os.path.islink(path):
+                preview.add(path, os.lstat(path).st_size)
+                continue
+
+            stack = [path]
+            while stack:
+                # Checked per directory and every 256 entries, which keeps the cap cheap
+                if out_of_budget():
+                    preview.complete = False
+                    return
+                directory = stack.pop()
+                preview.add(directory.rstrip('/') + '/', is_dir=True)
                 try:
-                    if 'reset' in command or 'clean' in command:
-                        result = subprocess.run(
-                            'git status --porcelain',
-                            shell=True, capture_output=True, text=True
-                        )
-                        affected_files = [line[3:] for line in result.stdout.splitlines() if line]
-                    elif 'revert' in command:
-                        commit_hash = command.split()[-1]
-                        result = subprocess.run(
-                            f'git show --name-only {commit_hash}',
-                            shell=True, capture_output=True, text=True
-                        )
-                        affected_files = [line for line in result.stdout.splitlines() 
-                                        if line.strip() and not line.startswith('commit')]
-                except Exception as e:
-                    affected_files = [f'Unable to determine affected git files: {str(e)}']
-            
-            return True, info['reason'], affected_files
+                    with os.scandir(directory) as entries:
+                        for entry in entries:
+                            scanned += 1
+                            if scanned > max_scan or (scanned % 256 == 0 and out_of_budget()):
+                                preview.complete = False
+                                return
+                            try:
+                                if entry.is_dir(follow_symlinks=False):
+                                    stack.append(entry.path)
+                                else:
+                                    preview.add(entry.path, entry.stat(follow_symlinks=False).st_size)
+                            except OSError:
+                                continue
+                except OSError:
+                    continue
 
-    # If not found in predefined patterns, use AI to analyze
-    try:
-        completion = client.chat.completions.create(
-            model=FALLBACK_MODEL,
-            messages=[
-                {
-                    "role": "system",
-                    "content": """You are a command-line security expert. Analyze the given command and determine if it's potentially destructive.
-                    Consider operations that could:
-                    - Delete or modify files/directories
-                    - Affect system configuration
-                    - Impact system stability
-                    - Modify important settings
-                    - Require elevated privileges
-                    - Have network-wide effects
-                    - Be irreversible
-                    
-                    Respond in JSON format:
-                    {
-                        "is_destructive": true/false,
-                        "reason": "Brief explanation of why it's considered destructive",
-                        "severity": "low/medium/high/critical",
-                        "type": "filesystem/system/network/database/etc"
-                    }"""
-                },
+def _affected_files(sub: Dict, preview: FilePreview, cancel: Optional[threading.Event] = None):
+    """Add the files a flagged simple command would touch to preview, where that can be worked out"""
+    argv = sub['argv']
+    if sub['program'] == 'rm':
+        # Every operand is a path; `--` ends option parsing
+        paths, options_done = [], False
+        for part in argv[1:]:
+            if part == '--' and not options_done:
+                options_done = True
+            elif options_done or not part.startswith('-'):
+                paths.append(part)
+        preview_paths(paths, preview, cancel)
+    
+    elif sub['program'] == 'git' and len(argv) > 1:
+        try:
+            if argv[1] in ('reset', 'clean'):
+                result = subprocess.run(
+                    ['git', 'status', '--porcelain'],
+                    capture_output=True, text=True
+                )
+                for line in result.stdout.splitlines():
+                    if line:
+                        preview.add(line[3:])
+            elif argv[1] == 'revert':
+                result = subprocess.run(
+                    ['git', 'show', '--name-only', '--format=', argv[-1]],
+                    capture_output=True, text=True
+                )
+                for line in result.stdout.splitlines():
+                    if line.strip():
+                        preview.add(line)
+        except Exception as e:
+            preview.entries.append(f'Unable to determine affected git files: {str(e)}')
+
+STRICT_SAFETY = os.getenv("AISHELL_STRICT_SAFETY", "1") != "0"  # Wait for the model on unclassified commands
+background_safety_checks = set()
+
+async def analyze_command_safety(command: str) -> Dict:
+    """Ask the model whether a command the local rules cannot classify is destructive; the verdict is cached by shape"""
+    verdict = await call_daemon('command_safety', {'command': command})
+    if verdict is not DAEMON_UNAVAILABLE:
+        verdict_cache.put(command, verdict)
+        return verdict
+
+    completion = await model_router.complete(
+        'safety',
+        messages=[
+            {
+                "role": "system",
+                "content": """You are a command-line security expert. Analyze the given command and determine if it's potentially destructive.
+                Consider operations that could:
+                - Delete or modify files/directories
+                - Affect system configuration
+                - Impact system stability
+                - Modify important settings
+                - Require elevated privileges
+                - Have network-wide effects
+                - Be irreversible
+                
+                Respond in JSON format:
                 {
-                    "role": "user",
-                    "content": f"Analyze this command: {command}"
-                }
-            ],
-            max_tokens=150,
-            temperature=0.1
-        )
-        
-        analysis = json.loads(completion.choices[0].message.content)
-        
-        if analysis['is_destructive']:
-            return True, f"{analysis['reason']} (Severity: {analysis['severity']}, Type: {analysis['type']})", affected_files
+                    "is_destructive": true/false,
+                    "reason": "Brief explanation of why it's considered destructive",
+                    "severity": "low/medium/high/critical",
+                    "type": "filesystem/system/network/database/etc"
+                }"""
+            },
+            {
+                "role": "user",
+                "content": f"Analyze this command: {command}"
+            }
+        ],
+        max_tokens=150,
+        temperature=0.1
+    )
+
+    analysis = json.loads(completion.choices[0].message.content)
+    reason = ''
+    if analysis['is_destructive']:
+        reason = f"{analysis['reason']} (Severity: {analysis['severity']}, Type: {analysis['type']})"
+    verdict = {'is_destructive': bool(analysis['is_destructive']), 'reason': reason}
+    verdict_cache.put(command, verdict)
+    return verdict
+
+async def _analyze_in_background(command: str):
+    try:
+        await analyze_command_safety(command)
+    except Exception:
+        pass  # Not cached, so the next run of this shape asks again
+
+async def is_destructive_command(command: str) -> tuple[bool, str, FilePreview]:
+    """
+    Analyze if a command is potentially destructive using the local safety rules
+    Returns: (is_destructive, reason, affected_files)
+
+    Commands no rule can classify are looked up in the verdict cache and
+    otherwise wait for the model, and need confirmation when it cannot answer.
+    With AISHELL_STRICT_SAFETY=0 they run straight away while the model is
+    asked in the background, except for scripts and interpreters, which
+    always wait.
+    """
+    affected_files = FilePreview()
     
+    findings, unclassified = classify_command(command)
+    findings = [f for f in findings if SEVERITY_RANK[f['severity']] >= SEVERITY_RANK[CONFIRM_SEVERITY]]
+    if findings:
+        findings.sort(key=lambda finding: SEVERITY_RANK[finding['severity']], reverse=True)
+        reasons = []
+        for finding in findings:
+            if finding['reason'] not in reasons:
+                reasons.append(finding['reason'])
+
+        # Enumerate files off the event loop; cancelling the check stops the walk
+        cancel = threading.Event()
+        def collect():
+            for finding in findings:
+                if finding.get('paths'):
+                    preview_paths(finding['paths'], affected_files, cancel)
+                else:
+                    _affected_files(finding['command'], affected_files, cancel)
+        try:
+            await asyncio.to_thread(collect)
+        except asyncio.CancelledError:
+            cancel.set()
+            raise
+        return True, '; '.join(reasons), affected_files
+
+    if not unclassified:
+        safety_stats["local"] += 1
+        return False, '', affected_files
+    verdict = verdict_cache.get(command)
+    if verdict is not None:
+        return verdict['is_destructive'], verdict['reason'], affected_files
+
+    if not STRICT_SAFETY and not any(sub['argv'] and runs_script(sub['argv'][0]) for sub in unclassified):
+        safety_stats["background"] += 1
+        task = asyncio.create_task(_analyze_in_background(command))
+        background_safety_checks.add(task)
+        task.add_done_callback(background_safety_checks.discard)
+        return False, '', affected_files
+
+    try:
+        verdict = await analyze_command_safety(command)
     except Exception as e:
         print(f"AI analysis failed: {str(e)}")
         # Fall back to safe mode - assume potentially destructive if AI fails
-        return True, "Unable to fully analyze command safety", []
-    
-    return False, '', []
+        return True, "Unable to fully analyze command safety", affected_files
+    return verdict['is_destructive'], verdict['reason'], affected_files
+
+ANSI_ESCAPE = re.compile(r'\x1b(\[[0-?]*[ -/]*[@-~]|\][^\x07\x1b]*(\x07|\x1b\\)|[@-Z\\-_])')
+
+class OutputTail:
+    """Ring buffer holding only the last max_bytes written to it"""
+
+    def __init__(self, max_bytes: int = COMMAND_OUTPUT_TAIL_BYTES):
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self._buf = bytearray()
+
+    def write(self, data: bytes):
+        self.total_bytes += len(data)
+        self._buf += data
+        if len(self._buf) > self.max_bytes:
+            del self._buf[:len(self._buf) - self.max_bytes]
+
+    def text(self) -> str:
+        """Decoded tail with terminal escape sequences and carriage returns removed"""
+        text = self._buf.decode('utf-8', errors='replace')
+        text = ANSI_ESCAPE.sub('', text).replace('\r\n', '\n')
+        if self.total_bytes > self.max_bytes:
+            text = f"[... {self.total_bytes - self.max_bytes} earlier bytes omitted ...]\n" + text
+        return text
+
+def _copy_window_size(fd: int):
+    """Give the pseudo-terminal the same size as the real one"""
+    try:
+        size = fcntl.ioctl(sys.stdout.fileno(), termios.TIOCGWINSZ, b'\0' * 8)
+        fcntl.ioctl(fd, termios.TIOCSWINSZ, size)
+    except OSError:
+        pass
+
+def _run_with_pipes(command: str) -> tuple[int, OutputTail, OutputTail]:
+    """Fallback for platforms without pty: stream both pipes through reader threads"""
+    stdout_tail, stderr_tail = OutputTail(), OutputTail()
+    proc = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    def pump(pipe, stream, tail):
+        for data in iter(lambda: pipe.read1(4096), b''):
+            tail.write(data)
+            stream.buffer.write(data)
+            stream.flush()
+
+    readers = [
+        threading.Thread(target=pump, args=(proc.stdout, sys.stdout, stdout_tail), daemon=True),
+        threading.Thread(target=pump, args=(proc.stderr, sys.stderr, stderr_tail), daemon=True),
+    ]
+    for reader in readers:
+        reader.start()
+    returncode = proc.wait()
+    for reader in readers:
+        reader.join()
+    return returncode, stdout_tail, stderr_tail
+
+def run_in_pty(command: str, loop: Optional[asyncio.AbstractEventLoop] = None) -> tuple[int, OutputTail, OutputTail]:
+    """Run command on a pseudo-terminal, passing output through as it arrives.
+
+    Interactive programs get a real terminal (keystrokes are forwarded in raw
+    mode), while only a bounded tail of stdout and stderr is kept.
+    Returns (exit code, stdout tail, stderr tail). This blocks until the
+    command exits, so the REPL runs it in a worker thread and passes its event
+    loop, which then forwards terminal resizes in place of a signal handler.
+    """
+    if pty is None or not sys.stdout.isatty():
+        return _run_with_pipes(command)
+
+    stdout_tail, stderr_tail = OutputTail(), OutputTail()
+    out_master, out_slave = pty.openpty()
+    err_master, err_slave = pty.openpty()
+    for fd in (out_slave, err_slave):
+        _copy_window_size(fd)
+
+    try:
+        proc = subprocess.Popen(
+            command, shell=True,
+            stdin=out_slave, stdout=out_slave, stderr=err_slave,
+            start_new_session=True,
+            # Make the pty the controlling terminal so Ctrl-C and job control reach the command
+            preexec_fn=lambda: fcntl.ioctl(0, termios.TIOCSCTTY, 0)
+        )
+    finally:
+        os.close(out_slave)
+        os.close(err_slave)
+
+    stdin_fd = sys.stdin.fileno()
+    saved_mode = None
+    previous_winch = None
+    if os.isatty(stdin_fd):
+        saved_mode = termios.tcgetattr(stdin_fd)
+        tty.setraw(stdin_fd)
+    masters = [out_master, err_master]  # Emptied before closing, as the loop may still deliver a resize
+    def resize(*_):
+        for fd in list(masters):
+            _copy_window_size(fd)
+    if threading.current_thread() is threading.main_thread():
+        previous_winch = signal.signal(signal.SIGWINCH, resize)
+    elif loop is not None:
+        loop.call_soon_threadsafe(loop.add_signal_handler, signal.SIGWINCH, resize)
+
+    sinks = {
+        out_master: (sys.stdout.fileno(), stdout_tail),
+        err_master: (sys.stderr.fileno(), stderr_tail),
+    }
+    readers = [stdin_fd, out_master, err_master]
+    try:
+        while out_master in readers or err_master in readers:
+            # Background jobs can keep the pty open; stop once the shell has exited and output drained
+            exited = proc.poll() is not None
+            try:
+                ready, _, _ = select.select(readers, [], [], 0.05 if exited else 0.5)
+            except InterruptedError:
+                continue
+            if exited and not ready:
+                break
+            for fd in ready:
+                try:
+                    data = os.read(fd, 4096)
+                except OSError:  # EIO once every slave end is closed
+                    data = b''
+                if fd == stdin_fd:
+                    if data:
+                        os.write(out_master, data)
+                    else:
+                        readers.remove(stdin_fd)
+                    continue
+                if not data:
+                    readers.remove(fd)
+                    continue
+                sink_fd, tail = sinks[fd]
+                os.write(sink_fd, data)
+                tail.write(data)
+    finally:
+        if saved_mode is not None:
+            termios.tcsetattr(stdin_fd, termios.TCSAFLUSH, saved_mode)
+        if previous_winch is not None:
+            signal.signal(signal.SIGWINCH, previous_winch)
+        elif loop is not None and threading.current_thread() is not threading.main_thread():
+            loop.call_soon_threadsafe(loop.remove_signal_handler, signal.SIGWINCH)
+        masters.clear()
+        os.close(out_master)
+        os.close(err_master)
+
+    return proc.wait(), stdout_tail, stderr_tail
+
+FAILURE_REPORT_TOKENS = 600  # Output of a failed command kept for !error
+last_exit_status = 0
+last_failure = None  # The latest failed command, with its diagnosis running in the background
+
+def record_failure(command: str, returncode: int, stdout: str, stderr: str):
+    """Remember a failed command and start diagnosing it while the user reads its output.
 
-def execute_command(command: str) -> bool:
-    """Execute a shell command with proper shell activation handling"""
+    Only the local diagnoses run in the background; the model is asked when
+    !error requests it, so typos and failing greps do not spend the rate
+    limit. Interrupted commands (exit 130) and failures without any output,
+    like a grep that found nothing, are recorded but not analysed until !error asks.
+    """
+    global last_failure
+    if last_failure and last_failure['analysis'] and not last_failure['analysis'].done():
+        last_failure['analysis'].cancel()
+    output = stderr.strip() or stdout.strip()
+    error_message = f"$ {command}\nexit status {returncode}\n{_excerpt(output, FAILURE_REPORT_TOKENS)}"
+    analysis = None
+    if output and returncode != 130:
+        analysis = asyncio.ensure_future(analyze_error(error_message, quiet=True, remote=False))
+    last_failure = {
+        'command': command,
+        'returncode': returncode,
+        'error_message': error_message,
+        'analysis': analysis,
+    }
+
+async def execute_command(command: str, safety: Optional[asyncio.Task] = None) -> bool:
+    """Execute a shell command with proper shell activation handling.
+
+    safety may be an is_destructive_command() task started earlier, so the
+    analysis can overlap with whatever the user was doing meanwhile.
+    """
     try:
         # Check for destructive operations
-        is_destructive, reason, affected_files = is_destructive_command(command)
+        if safety is None:
+            safety = asyncio.ensure_future(is_destructive_command(command))
+        is_destructive, reason, affected_files = await with_spinner(safety, "Checking command safety...")
         
         if is_destructive:
             print("\n⚠️  WARNING: This command may be destructive!")
             print(f"Reason: {reason}")
             
             if affected_files:
-                print("\nThis operation will affect the following files:")
-                # Show first 10 files with proper formatting
-                for i, file in enumerate(affected_files[:10], 1):
+                print(f"\nThis operation will affect {affected_files.summary()}:")
+                # Show the first few paths with proper formatting
+                for i, file in enumerate(affected_files.entries, 1):
                     if file.endswith('/'):
                         print(f"  {i}. 📁 {file}")  # Directory
                     else:
                         print(f"  {i}. 📄 {file}")  # File
                 
                 # Show count of remaining files
-                if len(affected_files) > 10:
-                    remaining = len(affected_files) - 10
-                    print(f"\n  ... and {remaining} more file(s)")
+                remaining = affected_files.count + affected_files.dirs - len(affected_files.entries)
+                if remaining > 0:
+                    more = "more" if affected_files.complete else "or more"
+                    print(f"\n  ... and {remaining} {more} file(s)")
             
-            confirm = input("\nAre you sure you want to proceed? [y/N] ")
+            confirm = await ask("\nAre you sure you want to proceed? [y/N] ")
             if confirm.lower() != 'y':
                 print("Operation cancelled.")
                 return False
@@ -345,7 +2085,7 @@ def execute_command(command: str) -> bool:
         
         # Special handling for virtual environment activation
         if "venv" in command and ("activate" in command or "source" in command):
-            if platform.system().lower() == "windows":
+            if os.name == "nt":
                 # Windows activation
                 return subprocess.run(f"venv\\Scripts\\activate", shell=True, check=True).returncode == 0
             else:
@@ -355,23 +2095,32 @@ def execute_command(command: str) -> bool:
                 return subprocess.run(modified_command, shell=True, executable='/bin/bash', check=True).returncode == 0
         
         # Regular command execution
-        # Capture command output
-        result = subprocess.run(command, shell=True, capture_output=True, text=True)
-        output = result.stdout if result.stdout else result.stderr
+        # Output is shown live; only its tail is kept for context. A worker thread
+        # waits on the command so background tasks keep running meanwhile
+        returncode, stdout_tail, stderr_tail = await asyncio.to_thread(
+            run_in_pty, command, asyncio.get_running_loop())
+        stdout = stdout_tail.text() if stdout_tail.total_bytes else ''
+        stderr = stderr_tail.text() if stderr_tail.total_bytes else ''
         
         # Store command and its output in context
         command_context.append({
             'command': command,
-            'output': output,
+            'output': stdout or stderr,
+            'errors': stderr if stdout else '',
+            'returncode': returncode,
             'timestamp': time.time()
         })
         
         # Keep only last N commands for context
         if len(command_context) > COMMAND_HISTORY_LIMIT:
             command_context.pop(0)
+
+        global last_exit_status
+        last_exit_status = returncode
+        if returncode != 0:
+            record_failure(command, returncode, stdout, stderr)
             
-        print(output)
-        return result.returncode == 0
+        return returncode == 0
     except subprocess.CalledProcessError as e:
         print(f"Command failed: {e}")
         if e.stderr:
@@ -381,6 +2130,405 @@ def execute_command(command: str) -> bool:
         print(f"Error executing command: {str(e)}")
         return False
 #added something her 
+# Directories never worth scanning for project structure
+SCAN_PRUNE_DIRS = {
+    '.git', '.hg', '.svn', 'node_modules', 'venv', '.venv', 'env', '__pycache__', 'target', 'build',
+    'dist', '.tox', '.nox', '.mypy_cache', '.pytest_cache', '.ruff_cache', '.idea', '.vscode',
+    '.next', '.nuxt', '.gradle', '.cache', 'coverage', 'site-packages', 'bower_components', '.terraform',
+}
+SCAN_MAX_ENTRIES = int(os.getenv("AISHELL_SCAN_MAX_ENTRIES", "100000"))  # Entries examined before giving up
+SCAN_TIME_LIMIT = float(os.getenv("AISHELL_SCAN_TIME_LIMIT", "2.0"))  # Seconds spent walking before giving up
+
+class GitIgnore:
+    """Patterns from one .gitignore file, matched against paths relative to its directory.
+
+    Patterns without a slash match a name at any depth; the others are
+    anchored to the .gitignore's directory. Files without negations are
+    folded into a few combined regexes; with negations the last matching
+    pattern wins, as in git.
+    """
+
+    def __init__(self, lines: List[str]):
+        self.rules = []  # (regex, negate, dir_only, anchored)
+        for line in lines:
+            line = line.rstrip('\n').rstrip()
+            if not line or line.startswith('#'):
+                continue
+            negate = line.startswith('!')
+            if negate:
+                line = line[1:]
+            dir_only = line.endswith('/')
+            line = line.rstrip('/')
+            anchored = '/' in line
+            line = line.lstrip('/')
+            if line:
+                self.rules.append((re.compile(self._translate(line)), negate, dir_only, anchored))
+
+        self.ordered = any(negate for _, negate, _, _ in self.rules)
+        if not self.ordered:
+            # One regex per (anchored, dir_only) combination
+            self.combined = {}
+            for anchored in (False, True):
+                for dir_only in (False, True):
+                    patterns = [regex.pattern for regex, _, d, a in self.rules if a == anchored and d == dir_only]
+                    if patterns:
+                        self.combined[anchored, dir_only] = re.compile('|'.join(f'(?:{p})' for p in patterns))
+
+    @staticmethod
+    def _translate(pattern: str) -> str:
+        regex, i = '', 0
+        while i < len(pattern):
+            if pattern.startswith('**/', i):
+                regex += '(?:.*/)?'
+                i += 3
+            elif pattern.startswith('/**', i) and i + 3 == len(pattern):
+                regex += '/.*'
+                i += 3
+            elif pattern[i] == '*':
+                regex += '[^/]*'
+                i += 1
+            elif pattern[i] == '?':
+                regex += '[^/]'
+                i += 1
+            elif pattern[i] == '[' and ']' in pattern[i + 1:]:
+                end = pattern.index(']', i + 1)
+                regex += '[' + pattern[i + 1:end].replace('!', '^', 1) + ']'
+                i = end + 1
+            else:
+                regex += re.escape(pattern[i])
+                i += 1
+        return regex + r'\Z'
+
+    @classmethod
+    def load(cls, directory: str) -> Optional['GitIgnore']:
+        try:
+            with open(os.path.join(directory, '.gitignore'), errors='replace') as f:
+                ignore = cls(f.readlines())
+        except OSError:
+            return None
+        return ignore if ignore.rules else None
+
+    def match(self, relpath: str, name: str, is_dir: bool) -> Optional[bool]:
+        """True if ignored, False if re-included by a negation, None if no pattern applies"""
+        if not self.ordered:
+            for (anchored, dir_only), regex in self.combined.items():
+                if (is_dir or not dir_only) and regex.match(relpath if anchored else name):
+                    return True
+            return None
+        result = None
+        for regex, negate, dir_only, anchored in self.rules:
+            if (is_dir or not dir_only) and regex.match(relpath if anchored else name):
+                result = not negate
+        return result
+
+def scan_tree(root: str, extensions: Dict[str, str], max_entries: int = SCAN_MAX_ENTRIES,
+              time_limit: float = SCAN_TIME_LIMIT, previous: Optional[Dict[str, Dict]] = None
+              ) -> tuple[Dict[str, List[str]], bool, Dict[str, Dict]]:
+    """Walk root once with os.scandir and group files by language via their extension.
+
+    Directories in SCAN_PRUNE_DIRS and paths matched by .gitignore files (the
+    root's and nested ones) are skipped. Returns ({language: [relative paths]},
+    complete, directories); complete is False when max_entries or time_limit
+    cut the walk short.
+
+    directories maps each walked directory (relative to root) to its mtime,
+    its .gitignore's mtime, its matching files and its subdirectories. Passing
+    it back as previous reuses the record of every directory whose mtime and
+    .gitignore are unchanged, so only modified directories are listed again.
+    """
+    previous = previous or {}
+    found, directories = {}, {}
+    deadline = time.monotonic() + time_limit
+    examined = 0
+    # Each entry: directory path, its path relative to root, the .gitignore files that
+    # apply as (path of their directory relative to root, rules), and whether records
+    # from previous are still valid (no .gitignore above it changed)
+    stack = [(root, '', (), True)]
+    while stack:
+        directory, rel_dir, ignores, trusted = stack.pop()
+        if time.monotonic() > deadline:
+            return found, False, directories
+        try:
+            mtime = os.stat(directory).st_mtime_ns
+        except OSError:
+            continue
+        try:
+            ignore_mtime = os.stat(os.path.join(directory, '.gitignore')).st_mtime_ns
+        except OSError:
+            ignore_mtime = None
+        ignore = GitIgnore.load(directory) if ignore_mtime is not None else None
+        if ignore:
+            ignores = ignores + ((rel_dir, ignore),)
+
+        record = previous.get(rel_dir)
+        trusted = trusted and record is not None and record['ignore'] == ignore_mtime
+        if not trusted or record['mtime'] != mtime:
+            record = {'mtime': mtime, 'ignore': ignore_mtime, 'files': {}, 'subdirs': []}
+            try:
+                with os.scandir(directory) as entries:
+                    for entry in entries:
+                        examined += 1
+                        # Checking the clock every 256 entries keeps the cap cheap
+                        if examined > max_entries or (examined % 256 == 0 and time.monotonic() > deadline):
+                            return found, False, directories
+                        name = entry.name
+                        try:
+                            is_dir = entry.is_dir(follow_symlinks=False)
+                        except OSError:
+                            continue
+                        if is_dir:
+                            if name in SCAN_PRUNE_DIRS:
+                                continue
+                        else:
+                            language = extensions.get(os.path.splitext(name)[1].lower())
+                            if not language:
+                                continue
+                        relpath = f'{rel_dir}/{name}' if rel_dir else name
+                        ignored = None
+                        for base, rules in ignores:
+                            result = rules.match(relpath[len(base) + 1:] if base else relpath, name, is_dir)
+                            if result is not None:
+                                ignored = result
+                        if ignored:
+                            continue
+                        if is_dir:
+                            record['subdirs'].append(name)
+                        else:
+                            record['files'].setdefault(language, []).append(name)
+            except OSError:
+                continue
+
+        directories[rel_dir] = record
+        prefix = f'{rel_dir}/' if rel_dir else ''
+        for language, names in record['files'].items():
+            found.setdefault(language, []).extend(prefix + name for name in names)
+        for name in record['subdirs']:
+            stack.append((os.path.join(directory, name), prefix + name, ignores, trusted))
+    return found, True, directories
+
+# Dependency parsers per config file name: (ecosystem, 'manifest' or 'lock', parser).
+# A parser reads an open text file line by line and yields (name, version) pairs.
+DEPENDENCY_PARSERS = {}
+CONFIG_CONTENT_MAX_BYTES = 64 * 1024  # Larger config files (lock files) are parsed but not kept
+PEP508_REQUIREMENT = re.compile(r'^\s*([A-Za-z0-9][A-Za-z0-9._-]*)\s*(?:\[[^\]]*\])?\s*([^;#]*)')
+TOML_HEADER = re.compile(r'^\s*\[\[?\s*([^\]]+?)\s*\]\]?\s*$')
+TOML_STRING = re.compile(r'"([^"]*)"|\'([^\']*)\'')
+TOML_KEY_VALUE = re.compile(r'^\s*"?([A-Za-z0-9][\w.-]*)"?\s*=\s*(.*)$')
+
+def dependency_parser(filename: str, ecosystem: str, kind: str):
+    """Register a parser for a config file name"""
+    def register(parser):
+        DEPENDENCY_PARSERS[filename] = (ecosystem, kind, parser)
+        return parser
+    return register
+
+def _python_name(name: str) -> str:
+    """PEP 503 normalized distribution name"""
+    return re.sub(r'[-_.]+', '-', name).lower()
+
+def _toml_version(value: str) -> str:
+    """Version from `"1.0"` or `{ version = "1.0", ... }`"""
+    if value.lstrip().startswith('{'):
+        match = re.search(r'version\s*=\s*["\']([^"\']*)', value)
+        return match.group(1) if match else ''
+    match = TOML_STRING.search(value)
+    return (match.group(1) or match.group(2) or '') if match else ''
+
+@dependency_parser('requirements.txt', 'python', 'manifest')
+def _parse_requirements(f):
+    for line in f:
+        line = line.strip()
+        if not line or line.startswith(('#', '-')):
+            continue
+        match = PEP508_REQUIREMENT.match(line)
+        if match:
+            yield _python_name(match.group(1)), match.group(2).strip()
+
+@dependency_parser('pyproject.toml', 'python', 'manifest')
+def _parse_pyproject(f):
+    section, in_array = '', False
+    for line in f:
+        if not in_array:
+            header = TOML_HEADER.match(line)
+            if header:
+                section = header.group(1)
+                continue
+            entry = TOML_KEY_VALUE.match(line)
+            if not entry:
+                continue
+            key, value = entry.groups()
+            if section.startswith('tool.poetry') and section.endswith('dependencies'):
+                if key != 'python':
+                    yield _python_name(key), _toml_version(value)
+                continue
+            if not ((section == 'project' and key == 'dependencies')
+                    or section == 'project.optional-dependencies') or not value.startswith('['):
+                continue
+            # PEP 621 arrays of requirement strings, possibly spanning several lines
+            in_array, line = True, value
+        for match in TOML_STRING.finditer(line):
+            requirement = PEP508_REQUIREMENT.match(match.group(1) or match.group(2) or '')
+            if requirement:
+                yield _python_name(requirement.group(1)), requirement.group(2).strip()
+        if ']' in TOML_STRING.sub('', line):
+            in_array = False
+
+@dependency_parser('Pipfile', 'python', 'manifest')
+def _parse_pipfile(f):
+    section = ''
+    for line in f:
+        header = TOML_HEADER.match(line)
+        if header:
+            section = header.group(1)
+        elif section in ('packages', 'dev-packages'):
+            entry = TOML_KEY_VALUE.match(line)
+            if entry:
+                version = _toml_version(entry.group(2))
+                yield _python_name(entry.group(1)), '' if version == '*' else version
+
+@dependency_parser('package.json', 'node', 'manifest')
+def _parse_package_json(f):
+    try:
+        package = json.load(f)
+    except ValueError:
+        return
+    for group in ('dependencies', 'devDependencies', 'peerDependencies', 'optionalDependencies'):
+        deps = package.get(group)
+        if isinstance(deps, dict):
+            yield from deps.items()
+
+@dependency_parser('package-lock.json', 'node', 'lock')
+def _parse_package_lock(f):
+    # npm writes one key per line with "version" first inside each package object:
+    # `"node_modules/a/node_modules/b": {` (lockfile v2/v3) or `"b": {` (v1)
+    pending = None
+    for line in f:
+        line = line.strip()
+        if pending and line.startswith('"version"'):
+            match = TOML_STRING.search(line.split(':', 1)[1])
+            if match:
+                yield pending, match.group(1)
+        pending = None
+        if line.endswith('{') and line.startswith('"'):
+            key = line[1:line.index('"', 1)]
+            name = key.rpartition('node_modules/')[2]
+            if name and name not in ('packages', 'dependencies', 'requires', 'devDependencies'):
+                pending = name
+
+@dependency_parser('yarn.lock', 'node', 'lock')
+def _parse_yarn_lock(f):
+    pending = None
+    for line in f:
+        if line[:1] not in (' ', '#', '\n', '') and line.rstrip().endswith(':'):
+            spec = line.rstrip()[:-1].split(',')[0].strip().strip('"')
+            name, at, _ = spec.rpartition('@')
+            pending = name if at and name and not spec.startswith('__metadata') else None
+        elif pending and line.startswith('  version'):
+            yield pending, line.split(None, 1)[1].strip().strip('":').strip('"')
+            pending = None
+
+@dependency_parser('Cargo.toml', 'rust', 'manifest')
+def _parse_cargo_toml(f):
+    section = ''
+    for line in f:
+        header = TOML_HEADER.match(line)
+        if header:
+            section = header.group(1)
+        elif section.endswith(('dependencies', 'dev-dependencies', 'build-dependencies')):
+            entry = TOML_KEY_VALUE.match(line)
+            if entry:
+                yield entry.group(1), _toml_version(entry.group(2))
+
+@dependency_parser('Cargo.lock', 'rust', 'lock')
+def _parse_cargo_lock(f):
+    name = None
+    for line in f:
+        if line.startswith('[['):
+            name = None
+        elif line.startswith('name = '):
+            name = line[7:].strip().strip('"')
+        elif name and line.startswith('version = '):
+            yield name, line[10:].strip().strip('"')
+            name = None
+
+@dependency_parser('go.mod', 'go', 'manifest')
+def _parse_go_mod(f):
+    in_block = False
+    for line in f:
+        words = line.split('//', 1)[0].split()
+        if words[:2] == ['require', '(']:
+            in_block = True
+        elif in_block and words == [')']:
+            in_block = False
+        elif in_block and len(words) >= 2:
+            yield words[0], words[1]
+        elif words[:1] == ['require'] and len(words) >= 3:
+            yield words[1], words[2]
+
+@dependency_parser('go.sum', 'go', 'lock')
+def _parse_go_sum(f):
+    for line in f:
+        words = line.split()
+        if len(words) >= 2:
+            yield words[0], words[1].removesuffix('/go.mod')
+
+@dependency_parser('Gemfile', 'ruby', 'manifest')
+def _parse_gemfile(f):
+    for line in f:
+        match = re.match(r'''\s*gem\s+["']([^"']+)["'](?:\s*,\s*["']([^"']+)["'])?''', line)
+        if match:
+            yield match.group(1), match.group(2) or ''
+
+@dependency_parser('Gemfile.lock', 'ruby', 'lock')
+def _parse_gemfile_lock(f):
+    # Resolved gems are indented four spaces under `specs:`; their own dependencies six
+    for line in f:
+        match = re.match(r'^ {4}([^\s(]+) \(([^)]+)\)$', line.rstrip('\n'))
+        if match:
+            yield match.group(1), match.group(2).split('-', 1)[0]
+
+@dependency_parser('composer.json', 'php', 'manifest')
+def _parse_composer_json(f):
+    try:
+        composer = json.load(f)
+    except ValueError:
+        return
+    for group in ('require', 'require-dev'):
+        deps = composer.get(group)
+        if isinstance(deps, dict):
+            yield from ((name, version) for name, version in deps.items() if '/' in name)
+
+@dependency_parser('composer.lock', 'php', 'lock')
+def _parse_composer_lock(f):
+    # Each package object lists "name" and then "version"
+    pending = None
+    for line in f:
+        line = line.strip()
+        if line.startswith('"name"'):
+            pending = TOML_STRING.findall(line)[-1][0]
+        elif pending and line.startswith('"version"'):
+            yield pending, TOML_STRING.findall(line)[-1][0]
+            pending = None
+
+def parse_dependencies(path: Path) -> Optional[Dict[str, str]]:
+    """Run the registered parser for a config file; None when there is none or the file is unreadable"""
+    parser = DEPENDENCY_PARSERS.get(path.name)
+    if not parser:
+        return None
+    try:
+        with open(path, 'r', errors='replace') as f:
+            return dict(parser[2](f))
+    except OSError:
+        return None
+
+PROJECT_SUMMARY_CHARS = int(os.getenv("AISHELL_PROJECT_SUMMARY_CHARS", "4000"))  # Cap on the project digest sent with !error
+EXCERPT_CONTEXT_LINES = 4  # Lines shown around a location named in an error
+EXCERPT_MAX_TOKENS = 150
+EXCERPT_MAX_FILES = 4
+# `File "app/main.py", line 12`, `src/index.ts:40:7` and plain `config.yaml`
+ERROR_LOCATION = re.compile(r'(?P<path>(?:~|\.{1,2})?[\w./-]*\w\.[A-Za-z]{1,5})\b(?:"?, line |:)?(?P<line>\d+)?')
+project_summary_stats = {"summaries": 0, "chars_sent": 0, "chars_full": 0}
+
 class ProjectAnalyzer:
     """Analyzes project structure and dependencies across different project types"""
     
@@ -394,60 +2542,146 @@ class ProjectAnalyzer:
         'go': ['go.mod', 'go.sum']
     }
 
+    SOURCE_EXTENSIONS = {
+        '.py': 'python',
+        '.js': 'node', '.jsx': 'node', '.ts': 'node', '.tsx': 'node',
+        '.java': 'java',
+        '.rb': 'ruby',
+        '.php': 'php',
+        '.rs': 'rust',
+        '.go': 'go',
+        '.html': 'html', '.htm': 'html',
+        '.css': 'css', '.scss': 'css', '.sass': 'css', '.less': 'css',
+    }
+
+    INDEX_DIR = CACHE_DIR / "projects"
+    _indexes = {}  # Resolved root -> index, shared by analyzers in this process
+    _root_locks = {}  # Resolved root -> lock held while a scan reads and updates its index
+    _indexes_lock = threading.Lock()
+
     def __init__(self, root_dir: str = "."):
         self.root_dir = Path(root_dir)
         self.project_type = None
         self.config_files = {}
         self.source_files = {}
+        self.scan_complete = True
+        self.index = None
+        self.index_changed = False
         
     def scan_project(self) -> Dict:
-        """Scan project directory and identify project type and structure"""
-        self._find_config_files()
-        self._find_source_files()
-        self._determine_project_type()
+        """Scan project directory and identify project type and structure.
+
+        Config contents and the directory listing are kept in a per-root index
+        under INDEX_DIR; only files and directories whose mtime changed since
+        the last scan are read again. Scans of the same root are serialized,
+        since they update one shared index.
+        """
+        root = str(self.root_dir.resolve())
+        with self._indexes_lock:
+            root_lock = self._root_locks.setdefault(root, threading.Lock())
+        with root_lock:
+            self._load_index()
+            self._find_config_files()
+            self._find_source_files()
+            self._determine_project_type()
+            if self.index_changed:
+                self._save_index()
         
         return {
             "project_type": self.project_type,
             "config_files": self.config_files,
             "source_files": self.source_files,
+            "scan_complete": self.scan_complete,
             "dependencies": self._get_dependencies()
         }
         
+    def _index_path(self) -> Path:
+        import hashlib
+        root = str(self.root_dir.resolve())
+        return self.INDEX_DIR / f"{hashlib.sha1(root.encode()).hexdigest()[:16]}.json"
+
+    def _load_index(self):
+        """Use this process's index for the root, else the one on disk, else start empty"""
+        root = str(self.root_dir.resolve())
+        with self._indexes_lock:
+            self.index = self._indexes.get(root)
+            if self.index is None:
+                try:
+                    with open(self._index_path(), 'r') as f:
+                        self.index = json.load(f)
+                except (OSError, ValueError):
+                    pass
+                if not isinstance(self.index, dict) or self.index.get('root') != root:
+                    self.index = {'root': root, 'configs': {}, 'directories': {}}
+                self._indexes[root] = self.index
+
+    def _save_index(self):
+        """Write the index to disk atomically; the temporary file is unique, as other processes save the same root"""
+        import tempfile
+        path = self._index_path()
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=path.stem, suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'w') as f:
+                    json.dump(self.index, f)
+                os.replace(tmp_path, path)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+        except OSError:
+            pass
+        self.index_changed = False
+
     def _find_config_files(self):
-        """Find all known configuration files"""
+        """Find all known configuration files, reading only those changed since the last scan.
+
+        Dependencies are parsed from each file as it is read; the contents of
+        files over CONFIG_CONTENT_MAX_BYTES (typically lock files) are not kept.
+        """
+        configs = self.index['configs']
         for lang, files in self.KNOWN_CONFIG_FILES.items():
             found_files = {}
             for file in files:
                 path = self.root_dir / file
-                if path.exists():
-                    try:
-                        with open(path, 'r') as f:
-                            found_files[file] = f.read()
-                    except Exception:
-                        found_files[file] = None
+                try:
+                    stat = path.stat()
+                except OSError:
+                    if configs.pop(file, None) is not None:
+                        self.index_changed = True
+                    continue
+                cached = configs.get(file)
+                if (not cached or 'dependencies' not in cached
+                        or cached['mtime'] != stat.st_mtime_ns or cached['size'] != stat.st_size):
+                    content = None
+                    if stat.st_size <= CONFIG_CONTENT_MAX_BYTES:
+                        try:
+                            with open(path, 'r') as f:
+                                content = f.read()
+                        except Exception:
+                            pass
+                    cached = configs[file] = {
+                        'mtime': stat.st_mtime_ns,
+                        'size': stat.st_size,
+                        'content': content,
+                        'dependencies': parse_dependencies(path),
+                    }
+                    self.index_changed = True
+                found_files[file] = cached['content']
             if found_files:
                 self.config_files[lang] = found_files
 
     def _find_source_files(self):
-        """Find source files for different languages"""
-        extensions = {
-            'python': ['*.py'],
-            'node': ['*.js', '*.jsx', '*.ts', '*.tsx'],
-            'java': ['*.java'],
-            'ruby': ['*.rb'],
-            'php': ['*.php'],
-            'rust': ['*.rs'],
-            'go': ['*.go'],
-            'html': ['*.html', '*.htm'],
-            'css': ['*.css', '*.scss', '*.sass', '*.less'],
-        }
-        
-        for lang, exts in extensions.items():
-            files = []
-            for ext in exts:
-                files.extend([str(p) for p in self.root_dir.rglob(ext)])
-            if files:
-                self.source_files[lang] = files
+        """Find source files for different languages in a single walk of the project"""
+        previous = self.index['directories']
+        self.source_files, self.scan_complete, directories = scan_tree(
+            str(self.root_dir), self.SOURCE_EXTENSIONS, previous=previous)
+        # A capped walk only refreshes the directories it reached
+        if not self.scan_complete:
+            directories = dict(previous, **directories)
+        if directories != previous:
+            self.index['directories'] = directories
+            self.index_changed = True
 
     def _determine_project_type(self):
         """Determine primary project type based on config files and source files"""
@@ -464,55 +2698,624 @@ class ProjectAnalyzer:
             # Choose the language with most source files
             self.project_type = max(self.source_files.items(), key=lambda x: len(x[1]))[0]
 
-    def _get_dependencies(self) -> Dict:
-        """Extract dependencies from config files"""
+    def _get_dependencies(self) -> Dict[str, Dict[str, str]]:
+        """Dependencies per ecosystem as {name: version}.
+
+        Names come from the manifests (requirements.txt, package.json, ...)
+        with the versions resolved in the lock files where there is one; with
+        no manifest, everything in the lock file is listed.
+        """
         deps = {}
-        
-        if 'python' in self.config_files:
-            if 'requirements.txt' in self.config_files['python']:
-                deps['python'] = self._parse_requirements_txt(self.config_files['python']['requirements.txt'])
-                
-        if 'node' in self.config_files:
-            if 'package.json' in self.config_files['node']:
-                try:
-                    package_json = json.loads(self.config_files['node']['package.json'])
-                    deps['node'] = {
-                        'dependencies': package_json.get('dependencies', {}),
-                        'devDependencies': package_json.get('devDependencies', {})
-                    }
-                except json.JSONDecodeError:
-                    pass
-                    
+        for files in self.config_files.values():
+            declared, resolved = {}, {}
+            for file in files:
+                parsed = self.index['configs'][file].get('dependencies')
+                if parsed is None or file not in DEPENDENCY_PARSERS:
+                    continue
+                ecosystem, kind, _ = DEPENDENCY_PARSERS[file]
+                (declared if kind == 'manifest' else resolved).update(parsed)
+            if declared:
+                deps[ecosystem] = {name: resolved.get(name, version) for name, version in declared.items()}
+            elif resolved:
+                deps[ecosystem] = resolved
         return deps
 
-    @staticmethod
-    def _parse_requirements_txt(content: str) -> List[str]:
-        """Parse requirements.txt content"""
-        return [line.strip() for line in content.splitlines() 
-                if line.strip() and not line.startswith('#')]
-
-def analyze_error(error_message: str) -> Dict:
-    """Analyze error message using AI and project context"""
-    # If it's a ModuleNotFoundError, handle it directly
-    if "ModuleNotFoundError: No module named" in error_message:
-        # Extract the module name from the error message
-        module_name = error_message.split("'")[1]
-        return {
-            "error_type": "import_error",
-            "project_type": "python",
-            "missing_dependencies": [module_name],
-            "commands": [f"pip install {module_name}"],
-            "explanation": f"The Python package '{module_name}' is not installed",
-            "file_changes": []
+    def summarize(self, error_message: str = '', max_chars: int = PROJECT_SUMMARY_CHARS) -> Dict:
+        """Scan the project and return a digest of it whose JSON stays within max_chars.
+
+        Sections are added in order of usefulness until the cap is reached:
+        project type and per-language file counts, excerpts of project files
+        named in the error message, declared dependencies, then the top-level
+        layout. Items that do not fit are counted in an "omitted" entry.
+        """
+        project_info = self.scan_project()
+        summary = {
+            "project_type": self.project_type,
+            "languages": {lang: len(files) for lang, files in self.source_files.items()},
         }
-    
-    # For other errors, try AI analysis
-    project_analyzer = ProjectAnalyzer()
-    project_info = project_analyzer.scan_project()
+        if not self.scan_complete:
+            summary["scan_complete"] = False
+        size = len(json.dumps(summary)) + 64  # Room for the "omitted" counts
+        omitted = {}
+
+        def fit(section: str, items: list, container: list, key_cost: int) -> int:
+            """Add items while they fit; the first one also pays for its key, `, "key": [`"""
+            nonlocal size
+            for i, item in enumerate(items):
+                cost = len(json.dumps(item)) + 2 + (0 if container else key_cost)
+                if size + cost > max_chars:
+                    omitted[section] = omitted.get(section, 0) + len(items) - i
+                    break
+                container.append(item)
+                size += cost
+
+        excerpts = []
+        fit("excerpts", self._error_excerpts(error_message), excerpts, len('"excerpts"') + 6)
+        if excerpts:
+            summary["excerpts"] = excerpts
+
+        for ecosystem, deps in self._dependency_list(project_info["dependencies"]).items():
+            declared = []
+            first = "dependencies" not in summary
+            fit("dependencies", deps, declared,
+                len(json.dumps(ecosystem)) + 6 + (len('"dependencies"') + 6 if first else 0))
+            if declared:
+                summary.setdefault("dependencies", {})[ecosystem] = declared
+
+        layout = []
+        fit("layout", self._top_level_layout(), layout, len('"layout"') + 6)
+        if layout:
+            summary["layout"] = layout
+        if omitted:
+            summary["omitted"] = omitted
+        # Guarantee the cap: the "omitted" counts can outgrow their reserve
+        while len(json.dumps(summary)) > max_chars and self._drop_last_item(summary):
+            pass
+
+        project_summary_stats["summaries"] += 1
+        project_summary_stats["chars_sent"] += len(json.dumps(summary))
+        project_summary_stats["chars_full"] += len(json.dumps(project_info))
+        return summary
+
+    @staticmethod
+    def _drop_last_item(summary: Dict) -> bool:
+        """Move the least useful item of a summary into its "omitted" counts; False when none is left"""
+        for section in ("layout", "dependencies", "excerpts"):
+            items = summary.get(section)
+            if not items:
+                continue
+            if section == "dependencies":
+                ecosystem = list(items)[-1]
+                items[ecosystem].pop()
+                if not items[ecosystem]:
+                    del items[ecosystem]
+            else:
+                items.pop()
+            if not items:
+                del summary[section]
+            omitted = summary.setdefault("omitted", {})
+            omitted[section] = omitted.get(section, 0) + 1
+            return True
+        return False
+
+    @staticmethod
+    def _dependency_list(deps: Dict[str, Dict[str, str]]) -> Dict[str, List[str]]:
+        """Flatten the parsed dependencies into "name version" strings per ecosystem"""
+        return {ecosystem: [f"{name} {version}".strip() for name, version in declared.items()]
+                for ecosystem, declared in deps.items()}
+
+    def _top_level_layout(self) -> List[str]:
+        """Top-level directories with their source file counts, then top-level files"""
+        counts = {}
+        root_files = []
+        for files in self.source_files.values():
+            for path in files:
+                top, sep, _ = path.partition('/')
+                if sep:
+                    counts[top] = counts.get(top, 0) + 1
+                else:
+                    root_files.append(top)
+        record = self.index['directories'].get('', {}) if self.index else {}
+        for name in record.get('subdirs', []):
+            counts.setdefault(name, 0)
+        configs = [file for files in self.config_files.values() for file in files]
+        layout = [f"{name}/ ({count} source files)"
+                  for name, count in sorted(counts.items(), key=lambda item: -item[1])]
+        return layout + sorted(configs) + sorted(root_files)
+
+    def _error_excerpts(self, error_message: str) -> List[Dict]:
+        """Lines around each project file location named in the error message"""
+        root = self.root_dir.resolve()
+        excerpts, seen = [], []
+        for match in ERROR_LOCATION.finditer(error_message):
+            path = Path(os.path.expanduser(match.group('path')))
+            if not path.is_absolute():
+                path = self.root_dir / path
+            try:
+                path = path.resolve()
+                relative = path.relative_to(root)
+            except (OSError, ValueError):
+                continue  # Outside the project, e.g. an installed library
+            line = int(match.group('line') or 0)
+            first = max(line - EXCERPT_CONTEXT_LINES, 1)
+            # Locations already covered by an earlier excerpt of the same file add nothing
+            if any(file == relative and start <= line <= end for file, start, end in seen) or not path.is_file():
+                continue
+            seen.append((relative, first, line + EXCERPT_CONTEXT_LINES if line else 20))
+            try:
+                with open(path, 'r', errors='replace') as f:
+                    lines = list(itertools.islice(f, first - 1, line + EXCERPT_CONTEXT_LINES if line else 20))
+            except OSError:
+                continue
+            excerpts.append({
+                "file": str(relative),
+                "lines": f"{first}-{first + len(lines) - 1}",
+                "text": _excerpt(''.join(lines), EXCERPT_MAX_TOKENS),
+            })
+            if len(excerpts) >= EXCERPT_MAX_FILES:
+                break
+        # Innermost frames come last in tracebacks and are the most relevant
+        return excerpts[::-1]
+
+# Import names that differ from the distribution that provides them
+IMPORT_PACKAGE_INDEX = {
+    'cv2': 'opencv-python', 'PIL': 'Pillow', 'sklearn': 'scikit-learn', 'skimage': 'scikit-image',
+    'yaml': 'PyYAML', 'bs4': 'beautifulsoup4', 'dateutil': 'python-dateutil', 'dotenv': 'python-dotenv',
+    'jwt': 'PyJWT', 'jose': 'python-jose', 'Crypto': 'pycryptodome', 'Cryptodome': 'pycryptodomex',
+    'OpenSSL': 'pyOpenSSL', 'serial': 'pyserial', 'usb': 'pyusb', 'magic': 'python-magic',
+    'docx': 'python-docx', 'pptx': 'python-pptx', 'gi': 'PyGObject', 'attr': 'attrs',
+    'psycopg2': 'psycopg2-binary', 'MySQLdb': 'mysqlclient', 'mysql': 'mysql-connector-python',
+    'Bio': 'biopython', 'telegram': 'python-telegram-bot', 'discord': 'discord.py',
+    'socketio': 'python-socketio', 'engineio': 'python-engineio', 'zmq': 'pyzmq', 'fitz': 'PyMuPDF',
+    'win32api': 'pywin32', 'win32con': 'pywin32', 'pythoncom': 'pywin32', 'sentry_sdk': 'sentry-sdk',
+    'multipart': 'python-multipart', 'slugify': 'python-slugify', 'Levenshtein': 'python-Levenshtein',
+    'google': 'protobuf', 'grpc': 'grpcio', 'faiss': 'faiss-cpu', 'ldap': 'python-ldap',
+    'markdown': 'Markdown', 'dns': 'dnspython', 'nacl': 'PyNaCl', 'git': 'GitPython', 'github': 'PyGithub',
+    'kafka': 'kafka-python', 'websocket': 'websocket-client', 'Xlib': 'python-xlib', 'wx': 'wxPython',
+    'pkg_resources': 'setuptools', 'mpl_toolkits': 'matplotlib', 'tensorflow_hub': 'tensorflow-hub',
+    'igraph': 'python-igraph', 'pydantic_settings': 'pydantic-settings', 'llama_cpp': 'llama-cpp-python',
+    'huggingface_hub': 'huggingface-hub', 'typing_extensions': 'typing-extensions', 'snappy': 'python-snappy',
+}
+NODE_BUILTIN_MODULES = {
+    'assert', 'async_hooks', 'buffer', 'child_process', 'cluster', 'console', 'constants', 'crypto',
+    'dgram', 'diagnostics_channel', 'dns', 'domain', 'events', 'fs', 'http', 'http2', 'https', 'inspector',
+    'module', 'net', 'os', 'path', 'perf_hooks', 'process', 'punycode', 'querystring', 'readline', 'repl',
+    'stream', 'string_decoder', 'sys', 'timers', 'tls', 'trace_events', 'tty', 'url', 'util', 'v8', 'vm',
+    'wasi', 'worker_threads', 'zlib',
+}
+JS_IMPORT = re.compile(r'''(?:\bfrom\s*|\bimport\s*\(?\s*|\brequire\s*\(\s*)["']([^"'\s]+)["']''')
+MISSING_MODULE_ERRORS = [
+    ('python', re.compile(r"No module named '([\w.]+)'")),
+    ('node', re.compile(r"Cannot find module '([^']+)'")),
+    ('node', re.compile(r"Can't resolve '([^']+)'")),
+]
+IMPORT_SCAN_MAX_FILES = 5000  # Source files read per diagnosis
+IMPORT_SCAN_POOL_MIN_FILES = 200  # Below this a thread pool costs more than it saves
+_import_cache = {}  # path -> (mtime, imports)
+
+def _python_imports(source: str) -> List[str]:
+    """Top-level names of absolute imports in Python source"""
+    try:
+        tree = ast.parse(source)
+    except (SyntaxError, ValueError):
+        return []
+    names = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            names.update(alias.name.split('.')[0] for alias in node.names)
+        elif isinstance(node, ast.ImportFrom) and node.level == 0 and node.module:
+            names.add(node.module.split('.')[0])
+    return sorted(names)
+
+def _node_package(specifier: str) -> Optional[str]:
+    """Package name of a bare import specifier; None for relative paths and builtins"""
+    if specifier.startswith(('.', '/', 'node:')) or ':' in specifier:
+        return None
+    parts = specifier.split('/')
+    name = '/'.join(parts[:2]) if specifier.startswith('@') else parts[0]
+    return None if name in NODE_BUILTIN_MODULES else name
+
+def _scan_imports(paths: List[str]) -> Dict[str, List[str]]:
+    """Imports of each file; runs in the thread pool"""
+    found = {}
+    for path in paths:
+        try:
+            with open(path, 'r', errors='replace') as f:
+                source = f.read()
+        except OSError:
+            continue
+        if path.endswith('.py'):
+            found[path] = _python_imports(source)
+        else:
+            found[path] = sorted({name for name in map(_node_package, JS_IMPORT.findall(source)) if name})
+    return found
+
+def collect_imports(paths: List[str]) -> Dict[str, List[str]]:
+    """Imports per file, reusing results for files unchanged since they were last read"""
+    imports, stale = {}, []
+    for path in paths[:IMPORT_SCAN_MAX_FILES]:
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            continue
+        cached = _import_cache.get(path)
+        if cached and cached[0] == mtime:
+            imports[path] = cached[1]
+        else:
+            stale.append((path, mtime))
+
+    stale_paths = [path for path, _ in stale]
+    if len(stale_paths) < IMPORT_SCAN_POOL_MIN_FILES:
+        scanned = _scan_imports(stale_paths)
+    else:
+        # Threads overlap the file reads. A process pool would fork this multithreaded
+        # process (a deadlock risk), and spawned workers would re-run the app on import.
+        from concurrent.futures import ThreadPoolExecutor
+        workers = min(8, os.cpu_count() or 2)
+        chunk = -(-len(stale_paths) // (workers * 4))
+        scanned = {}
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for result in pool.map(_scan_imports, [stale_paths[i:i + chunk] for i in range(0, len(stale_paths), chunk)]):
+                scanned.update(result)
+    for path, mtime in stale:
+        if path in scanned:
+            _import_cache[path] = (mtime, scanned[path])
+            imports[path] = scanned[path]
+    return imports
+
+def find_virtualenv(root: Path) -> Optional[str]:
+    """The active virtualenv, else a venv/.venv in the project"""
+    venv = os.getenv('VIRTUAL_ENV')
+    if not venv:
+        venv = next((str(root / name) for name in ('.venv', 'venv') if (root / name / 'pyvenv.cfg').exists()), None)
+    return venv
+
+def installed_python_modules(root: Path) -> set:
+    """Top-level module names importable in the project's environment.
+
+    That is the active virtualenv, else a venv/.venv in the project, else the
+    interpreter running the shell.
+    """
+    venv = find_virtualenv(root)
+    names = set(sys.builtin_module_names) | set(sys.stdlib_module_names)
+    if venv:
+        site_dirs = glob.glob(os.path.join(venv, 'lib', 'python*', 'site-packages'))
+        site_dirs += glob.glob(os.path.join(venv, 'Lib', 'site-packages'))
+    else:
+        from importlib.metadata import packages_distributions
+        names.update(packages_distributions())
+        site_dirs = [path for path in sys.path if path and os.path.isdir(path)]
+    for site_dir in site_dirs:
+        try:
+            with os.scandir(site_dir) as entries:
+                for entry in entries:
+                    name = entry.name.split('.', 1)[0] if entry.is_file() else entry.name
+                    if name.isidentifier():
+                        names.add(name)
+        except OSError:
+            continue
+    return names
+
+def diagnose_missing_dependencies(error_message: str, analyzer: 'ProjectAnalyzer') -> Optional[Dict]:
+    """Resolve a missing-module error locally.
+
+    The module named in the error, plus any other import in the project's
+    sources that is neither local, installed nor a builtin, is mapped to the
+    package that provides it (IMPORT_PACKAGE_INDEX, or the import name) and
+    pinned to the declared version when the project declares it. A Python
+    module that is one of the project's own is reported as a search path
+    problem instead. Returns an analyze_error() result, or None when the error
+    is not about a missing module.
+    """
+    reported = None
+    for ecosystem, pattern in MISSING_MODULE_ERRORS:
+        match = pattern.search(error_message)
+        if match:
+            name = match.group(1).split('.')[0] if ecosystem == 'python' else _node_package(match.group(1))
+            if name:
+                reported = (ecosystem, name)
+                break
+    if not reported:
+        return None
+    ecosystem, reported_name = reported
+
+    project_info = analyzer.scan_project()
+    declared = project_info['dependencies'].get(ecosystem, {})
+    extensions = ('.py',) if ecosystem == 'python' else ('.js', '.jsx', '.ts', '.tsx')
+    sources = [str(analyzer.root_dir / path) for path in project_info['source_files'].get(ecosystem, [])
+               if path.endswith(extensions)]
+    imported = set()
+    for names in collect_imports(sources).values():
+        imported.update(names)
+
+    if ecosystem == 'python':
+        local, parents = set(), []
+        for path in project_info['source_files'].get('python', []):
+            parts = path[:-3].split('/')
+            local.update(parts)
+            if reported_name in parts:
+                parents.append('/'.join(parts[:parts.index(reported_name)]))
+        if parents:
+            return _local_module_result(reported_name, min(parents, key=len), analyzer.root_dir)
+        candidates = imported - local - installed_python_modules(analyzer.root_dir) - {reported_name}
+        # Optional imports guarded by try/except look missing too; trust the declared list when there is one
+        if declared:
+            candidates = {name for name in candidates if _python_name(IMPORT_PACKAGE_INDEX.get(name, name)) in declared}
+        missing = [reported_name] + sorted(candidates)
+        packages = [IMPORT_PACKAGE_INDEX.get(name, name) for name in missing]
+        pinned = []
+        for package in dict.fromkeys(packages):
+            version = declared.get(_python_name(package), '')
+            pinned.append(f"{package}{version}" if version[:1] in ('=', '<', '>', '~', '!') else package)
+        commands = [f"pip install {' '.join(shlex.quote(package) for package in pinned)}"]
+    else:
+        node_modules = analyzer.root_dir / 'node_modules'
+        candidates = {name for name in imported - {reported_name} if not (node_modules / name).exists()}
+        if declared:
+            candidates &= set(declared)
+        missing = [reported_name] + sorted(candidates)
+        packages = list(dict.fromkeys(missing))
+        undeclared = [package for package in packages if package not in declared]
+        lock_files = analyzer.config_files.get('node', {})
+        manager = 'yarn' if 'yarn.lock' in lock_files else 'npm'
+        commands = [f"{manager} install"] if len(undeclared) < len(packages) else []
+        if undeclared:
+            verb = 'add' if manager == 'yarn' else 'install'
+            commands.append(f"{manager} {verb} {' '.join(undeclared)}")
+
+    return {
+        "error_type": "import_error",
+        "project_type": ecosystem,
+        "missing_dependencies": packages,
+        "commands": commands,
+        "explanation": f"The {ecosystem} package(s) {', '.join(packages)} are not installed" +
+                       (f" (`{reported_name}` is provided by {packages[0]})" if packages[0] != reported_name else ""),
+        "file_changes": []
+    }
+
+def _local_module_result(name: str, parent: str, root: Path) -> Dict:
+    """The project's own module is not importable: a search path problem, not a missing package.
+
+    The fix changes the shell's own environment or directory, which a command
+    run by apply_fixes in a child process cannot do, so it is only described.
+    """
+    location = (root / parent).resolve()
+    if parent:
+        explanation = (f"`{name}` is part of this project ({parent}/{name}), but {parent}/ is not on the "
+                       f"import path; run `export PYTHONPATH={shlex.quote(str(location))}` or install the "
+                       f"project with `pip install -e .`")
+    else:
+        explanation = (f"`{name}` is part of this project, but Python only finds it when run from "
+                       f"{location}; run `cd {shlex.quote(str(location))}` first or add it to PYTHONPATH")
+    return _signature_result("import_error", "python", explanation=explanation)
+
+# Known error signatures: (name, pattern, handler) in priority order. A handler gets
+# the pattern's named groups and the whole error message and returns the fields of
+# an analyze_error() result that differ from _signature_result's defaults.
+ERROR_SIGNATURES = []
+error_stats = {"signatures": {}, "dependencies": 0, "remote": 0}
+_error_matcher = None  # (compiled alternation, signature count it was built from)
+
+# Executables with a known system package; only these get an install suggestion
+COMMAND_PACKAGES = {
+    'node': 'nodejs', 'npm': 'npm', 'pip': 'python3-pip', 'pip3': 'python3-pip', 'python': 'python3',
+    'rg': 'ripgrep', 'fd': 'fd-find', 'convert': 'imagemagick', 'ifconfig': 'net-tools', 'dig': 'dnsutils',
+    'gcc': 'build-essential', 'make': 'build-essential', 'g++': 'build-essential', 'java': 'default-jdk',
+    'javac': 'default-jdk', 'psql': 'postgresql-client', 'mysql': 'mysql-client', 'redis-cli': 'redis-tools',
+    'git': 'git', 'curl': 'curl', 'wget': 'wget', 'jq': 'jq', 'tree': 'tree', 'htop': 'htop', 'zip': 'zip',
+    'unzip': 'unzip', 'tmux': 'tmux', 'vim': 'vim', 'sqlite3': 'sqlite3', 'go': 'golang', 'cargo': 'cargo',
+    'docker': 'docker.io', 'ruby': 'ruby', 'php': 'php', 'rsync': 'rsync', 'ssh': 'openssh-client',
+}
+PIP_COMMANDS = {'pytest': 'pytest', 'black': 'black', 'flake8': 'flake8', 'mypy': 'mypy', 'ruff': 'ruff',
+                'poetry': 'poetry', 'pipenv': 'pipenv', 'jupyter': 'jupyter', 'uvicorn': 'uvicorn',
+                'gunicorn': 'gunicorn', 'flask': 'flask', 'django-admin': 'django', 'isort': 'isort'}
+NPM_COMMANDS = {'tsc': 'typescript', 'eslint': 'eslint', 'prettier': 'prettier', 'yarn': 'yarn',
+                'pnpm': 'pnpm', 'ng': '@angular/cli', 'vue': '@vue/cli', 'nest': '@nestjs/cli',
+                'nodemon': 'nodemon', 'ts-node': 'ts-node', 'vite': 'vite', 'next': 'next'}
+LIBRARY_PACKAGES = {
+    'libGL.so': 'libgl1', 'libglib-2.0.so': 'libglib2.0-0', 'libssl.so': 'libssl-dev', 'libcrypto.so': 'libssl-dev',
+    'libffi.so': 'libffi-dev', 'libpq.so': 'libpq5', 'libsqlite3.so': 'libsqlite3-0', 'libstdc++.so': 'libstdc++6',
+    'libgomp.so': 'libgomp1', 'libSM.so': 'libsm6', 'libXext.so': 'libxext6', 'libXrender.so': 'libxrender1',
+    'libmysqlclient.so': 'libmysqlclient-dev', 'libxml2.so': 'libxml2', 'libz.so': 'zlib1g',
+}
+INSTALL_COMMANDS = {
+    'apt-get': 'sudo apt-get install -y {}', 'dnf': 'sudo dnf install -y {}', 'yum': 'sudo yum install -y {}',
+    'pacman': 'sudo pacman -S --noconfirm {}', 'brew': 'brew install {}',
+}
+
+def error_signature(name: str, pattern: str):
+    """Register a handler for errors matching pattern; earlier registrations win when several match"""
+    def register(handler):
+        ERROR_SIGNATURES.append((name, pattern, handler))
+        return handler
+    return register
+
+def _signature_result(error_type: str, project_type: str = "system", **fields) -> Dict:
+    result = {
+        "error_type": error_type,
+        "project_type": project_type,
+        "missing_dependencies": [],
+        "commands": [],
+        "explanation": "",
+        "file_changes": []
+    }
+    result.update(fields)
+    return result
+
+def _system_install(package: str) -> str:
+    template = INSTALL_COMMANDS.get(detect_package_manager(), INSTALL_COMMANDS['apt-get'])
+    return template.format(package)
+
+@error_signature('command_not_found', r'(?:command not found: (?P<zsh>[\w.+-]+)'
+                                      r'|(?:ba|z|da|k|fi)?sh: (?:line )?(?:\d+: )?(?P<shell>[\w.+-]+): (?:command )?not found'
+                                      r"|'(?P<cmd>[\w.+-]+)' is not recognized as an internal or external command)")
+def _command_not_found(groups, error_message):
+    command = groups['zsh'] or groups['shell'] or groups['cmd']
+    if command in PIP_COMMANDS:
+        package, fix = PIP_COMMANDS[command], f"pip install {PIP_COMMANDS[command]}"
+    elif command in NPM_COMMANDS:
+        package, fix = NPM_COMMANDS[command], f"npm install -g {NPM_COMMANDS[command]}"
+    elif command in COMMAND_PACKAGES:
+        package, fix = COMMAND_PACKAGES[command], _system_install(COMMAND_PACKAGES[command])
+    else:
+        return None  # Unknown commands are as likely typos as missing packages; leave them to the model
+    return _signature_result("command_not_found", missing_dependencies=[package], commands=[fix],
+                             explanation=f"`{command}` is not installed or not on PATH; it is provided by {package}")
+
+@error_signature('inotify_limit', r'ENOSPC: System limit for number of file watchers reached')
+def _inotify_limit(groups, error_message):
+    return _signature_result(
+        "system_limit", "node",
+        commands=["echo fs.inotify.max_user_watches=524288 | sudo tee -a /etc/sysctl.conf && sudo sysctl -p"],
+        explanation="The file watcher raised the kernel's inotify watch limit")
+
+@error_signature('disk_full', r'No space left on device|ENOSPC|Disk quota exceeded')
+def _disk_full(groups, error_message):
+    return _signature_result("disk_full", commands=["df -h", "du -xsh ./* 2>/dev/null | sort -h | tail -n 15"],
+                             explanation="The disk is full; free space by removing large files, caches or old build output")
+
+@error_signature('port_in_use', r'(?:EADDRINUSE|[Aa]ddress already in use|port is already allocated)'
+                                r'(?:[^\n\d]*?(?P<port>\d{2,5}))?')
+def _port_in_use(groups, error_message):
+    port = groups['port'] or next(iter(re.findall(r'(?:port |:)(\d{2,5})\b', error_message)), None)
+    if not port:
+        return _signature_result("port_in_use", explanation="Another process is already listening on the port")
+    return _signature_result("port_in_use", commands=[f"lsof -i :{port}", f"lsof -ti :{port} | xargs kill"],
+                             explanation=f"Port {port} is used by another process; stop it or pick another port")
+
+@error_signature('npm_eresolve', r'npm (?:ERR!|error) code ERESOLVE')
+def _npm_eresolve(groups, error_message):
+    return _signature_result("dependency_conflict", "node", commands=["npm install --legacy-peer-deps"],
+                             explanation="npm could not resolve conflicting peer dependency ranges")
+
+@error_signature('npm_eacces', r"EACCES: permission denied, \w+ '(?P<path>[^']+)'")
+def _npm_eacces(groups, error_message):
+    return _signature_result(
+        "permission_denied", "node",
+        commands=["mkdir -p ~/.npm-global", "npm config set prefix ~/.npm-global"],
+        explanation=f"npm cannot write to {groups['path']}; install global packages under your home directory "
+                    "and add ~/.npm-global/bin to PATH")
+
+@error_signature('externally_managed', r'externally-managed-environment')
+def _externally_managed(groups, error_message):
+    return _signature_result("environment", "python", commands=["python3 -m venv .venv"],
+                             explanation="The system Python refuses pip installs; create a virtual environment "
+                                         "with `python3 -m venv .venv`, activate it and install there")
+
+@error_signature('python_headers', r'Python\.h: No such file or directory')
+def _python_headers(groups, error_message):
+    package = 'python3-devel' if detect_package_manager() in ('dnf', 'yum') else 'python3-dev'
+    return _signature_result("build_error", "python", missing_dependencies=[package],
+                             commands=[_system_install(package)],
+                             explanation="Building a C extension needs the Python development headers")
+
+@error_signature('pip_build_failure', r'Failed building wheel for (?P<wheel>[\w.-]+)'
+                                      r'|Could not build wheels for (?P<wheels>[\w.-]+)')
+def _pip_build_failure(groups, error_message):
+    package = groups['wheel'] or groups['wheels']
+    commands = ["pip install --upgrade pip setuptools wheel", f"pip install {package}"]
+    if re.search(r"command '(?:gcc|cc|x86_64-linux-gnu-gcc)' failed|gcc: not found", error_message):
+        commands.insert(0, _system_install('build-essential'))
+    return _signature_result("build_error", "python", missing_dependencies=[package], commands=commands,
+                             explanation=f"{package} has no prebuilt wheel here and building it from source failed")
+
+@error_signature('pip_no_version', r'Could not find a version that satisfies the requirement (?P<requirement>\S+)')
+def _pip_no_version(groups, error_message):
+    name = PEP508_REQUIREMENT.match(groups['requirement']).group(1)
+    return _signature_result("dependency_error", "python", commands=[f"pip index versions {name}"],
+                             explanation=f"No release of {name} matches the requirement for this Python "
+                                         "version and platform; check the name and the versions available")
+
+@error_signature('merge_conflict', r'CONFLICT \([^)]+\): Merge conflict in (?P<file>\S+)'
+                                   r'|Automatic merge failed; fix conflicts')
+def _merge_conflict(groups, error_message):
+    files = re.findall(r'Merge conflict in (\S+)', error_message)
+    return _signature_result(
+        "merge_conflict", "git", commands=["git diff --name-only --diff-filter=U"],
+        file_changes=[{"file": file, "changes": "Resolve the <<<<<<< / ======= / >>>>>>> markers, then git add it"}
+                      for file in files],
+        explanation="The merge stopped on conflicting changes; resolve them and commit, "
+                    "or run `git merge --abort` to go back")
+
+@error_signature('push_rejected', r'\[rejected\].*\((?:fetch first|non-fast-forward)\)')
+def _push_rejected(groups, error_message):
+    return _signature_result("git_error", "git", commands=["git pull --rebase"],
+                             explanation="The remote has commits you do not have; integrate them before pushing")
+
+@error_signature('shared_library', r'error while loading shared libraries: (?P<lib>[\w.+-]+?\.so)[\d.]*'
+                                   r'|Library not loaded: \S*?(?P<dylib>[\w.+-]+\.dylib)')
+def _shared_library(groups, error_message):
+    library = groups['lib'] or groups['dylib']
+    package = LIBRARY_PACKAGES.get(library)
+    if package:
+        return _signature_result("missing_library", missing_dependencies=[package], commands=[_system_install(package)],
+                                 explanation=f"{library} is provided by the {package} package, which is not installed")
+    return _signature_result("missing_library", commands=[f"ldconfig -p | grep {library.split('.')[0]}"],
+                             explanation=f"The shared library {library} is not installed or not on the loader path")
+
+@error_signature('permission_denied', r"(?P<path>[^\s:'\"]+): Permission denied")
+def _permission_denied(groups, error_message):
+    path = groups['path']
+    if os.path.isfile(path) and not os.access(path, os.X_OK):
+        return _signature_result("permission_denied", commands=[f"chmod +x {shlex.quote(path)}"],
+                                 explanation=f"{path} is not executable")
+    return _signature_result("permission_denied", commands=[f"ls -ld {shlex.quote(path)}"],
+                             explanation=f"You do not have permission to access {path}; check its owner and mode")
+
+def match_error_signature(error_message: str) -> Optional[Dict]:
+    """Match every registered signature in one pass; the earliest registered match builds the result"""
+    global _error_matcher
+    if not _error_matcher or _error_matcher[1] != len(ERROR_SIGNATURES):
+        # Prefix each signature's group names so they stay unique in the alternation
+        pattern = '|'.join(f'(?P<s{i}>{re.sub(r"[(][?]P<", f"(?P<s{i}_", source)})'
+                           for i, (_, source, _) in enumerate(ERROR_SIGNATURES))
+        _error_matcher = (re.compile(pattern), len(ERROR_SIGNATURES))
+    best = None
+    for match in _error_matcher[0].finditer(error_message):
+        index = int(match.lastgroup[1:])
+        if best is None or index < best[0]:
+            best = (index, match)
+    if best is None:
+        return None
+
+    index, match = best
+    name, _, handler = ERROR_SIGNATURES[index]
+    prefix = f's{index}_'
+    groups = {key[len(prefix):]: value for key, value in match.groupdict().items() if key.startswith(prefix)}
+    error_stats["signatures"][name] = error_stats["signatures"].get(name, 0) + 1
+    return handler(groups, error_message)
+
+async def analyze_error(error_message: str, quiet: bool = False, root: str = ".", remote: bool = True) -> Optional[Dict]:
+    """Analyze error message using AI and project context; quiet suppresses failure messages when run in the background.
+
+    With remote=False only the local diagnoses run, and None is returned when
+    neither recognizes the error.
+    """
+    # Missing modules are resolved locally from the project's imports and environment,
+    # other known errors by their signature. Both depend on this process's cwd,
+    # virtualenv and sys.path, so they never run in the daemon.
+    project_analyzer = ProjectAnalyzer(root)
+    local = await asyncio.to_thread(diagnose_missing_dependencies, error_message, project_analyzer)
+    if local:
+        error_stats["dependencies"] += 1
+        return local
+    local = await asyncio.to_thread(match_error_signature, error_message)
+    if local or not remote:
+        return local
+
+    analysis = await call_daemon('analyze_error', {'error_message': error_message, 'quiet': quiet, 'root': os.path.abspath(root)})
+    if analysis is not DAEMON_UNAVAILABLE:
+        return analysis
+    return await analyze_error_remotely(error_message, project_analyzer, quiet)
+
+async def analyze_error_remotely(error_message: str, project_analyzer: 'ProjectAnalyzer', quiet: bool = False) -> Dict:
+    """Ask the model about an error no local diagnosis recognized"""
+    error_stats["remote"] += 1
+    project_info = await asyncio.to_thread(project_analyzer.summarize, error_message)
     
     try:
-        completion = client.chat.completions.create(
-            model=FALLBACK_MODEL,
+        completion = await model_router.complete(
+            'error',
             messages=[
                 {
                     "role": "system",
@@ -540,17 +3343,8 @@ def analyze_error(error_message: str) -> Dict:
         return json.loads(response)
         
     except Exception as e:
-        print(f"Error analysis failed: {str(e)}")
-        # Provide a meaningful fallback for ModuleNotFoundError
-        if "ModuleNotFoundError" in error_message:
-            return {
-                "error_type": "import_error",
-                "project_type": "python",
-                "missing_dependencies": ["pandas"],
-                "commands": ["pip install pandas"],
-                "explanation": "The pandas package is not installed",
-                "file_changes": []
-            }
+        if not quiet:
+            print(f"Error analysis failed: {str(e)}")
         return {
             "error_type": "unknown",
             "project_type": "python",
@@ -560,7 +3354,117 @@ def analyze_error(error_message: str) -> Dict:
             "file_changes": []
         }
 
-def apply_fixes(analysis: Dict) -> bool:
+# Install commands that can share one invocation: subcommand words and the flags
+# that may be merged. Other flags keep a command on its own.
+INSTALL_COMMANDS_MERGEABLE = {
+    'pip': (['install'], {'-U', '--upgrade', '-q', '--quiet', '--user', '--pre'}),
+    'npm': (['install', 'i', 'add'], {'-D', '--save-dev', '-g', '--global', '-E', '--save-exact', '-S', '--save'}),
+    'yarn': (['add'], {'-D', '--dev', '-E', '--exact'}),
+    'pnpm': (['add'], {'-D', '--save-dev', '-E', '--save-exact'}),
+    'apt-get': (['install'], {'-y', '--yes', '-q', '--no-install-recommends'}),
+    'dnf': (['install'], {'-y'}),
+    'yum': (['install'], {'-y'}),
+    'pacman': ([], {'-S', '--noconfirm', '--needed'}),
+    'brew': (['install'], set()),
+    'gem': (['install'], {'--user-install'}),
+}
+INSTALL_COMMAND_ALIASES = {'pip3': 'pip', 'apt': 'apt-get'}
+# Node install flags in the spelling npm, yarn and pnpm all accept; None drops --save, which is
+# their default and which yarn rejects
+NODE_INSTALL_FLAGS = {'--save-dev': '-D', '--dev': '-D', '--save-exact': '-E', '--exact': '-E',
+                      '-S': None, '--save': None}
+# Typical resolver/index startup per invocation, used to estimate time saved by batching
+RESOLVER_STARTUP_SECONDS = {'pip': 2.0, 'npm': 2.5, 'yarn': 1.5, 'pnpm': 1.0, 'apt-get': 2.0, 'dnf': 4.0,
+                            'yum': 4.0, 'pacman': 1.0, 'brew': 3.0, 'gem': 1.5}
+
+def _install_request(command: str, root: Path) -> Optional[Dict]:
+    """Recognise a single package install command.
+
+    Returns its manager, the words before the package names (launcher,
+    subcommand and sorted flags, rewritten to the project's virtualenv or
+    node package manager) and the packages; None for anything else.
+    """
+    parsed = parse_command_line(command)
+    # Expansions and globs would not survive being quoted into the merged command
+    if len(parsed) != 1 or parsed[0]['redirects'] or re.search(r'[$`*?]', command):
+        return None
+    sub = parsed[0]
+    argv = sub['argv']
+    launcher = argv[:1]
+    if sub['program'].startswith('python') and argv[1:3] == ['-m', 'pip']:
+        launcher, argv = argv[:3], ['pip'] + argv[3:]
+    manager = INSTALL_COMMAND_ALIASES.get(os.path.basename(argv[0]), os.path.basename(argv[0])) if argv else ''
+    if manager not in INSTALL_COMMANDS_MERGEABLE:
+        return None
+    subcommands, mergeable = INSTALL_COMMANDS_MERGEABLE[manager]
+    args = argv[1:]
+    if subcommands:
+        if not args or args[0] not in subcommands:
+            return None
+        args = args[1:]
+    flags = sorted({arg for arg in args if arg.startswith('-')})
+    packages = [arg for arg in args if not arg.startswith('-')]
+    # pacman has no subcommand word; -S is what makes it an install
+    if not set(flags) <= mergeable or (manager == 'pacman' and '-S' not in flags):
+        return None
+
+    if manager == 'pip':
+        venv = find_virtualenv(root)
+        if venv:
+            python = os.path.join(venv, 'Scripts' if os.name == 'nt' else 'bin', 'python')
+            launcher = [python, '-m', 'pip']
+        words = launcher + ['install']
+    elif manager in ('npm', 'yarn', 'pnpm') and not {'-g', '--global'} & set(flags):
+        # Use the manager the project is locked with
+        if (root / 'yarn.lock').exists():
+            manager = 'yarn'
+        elif (root / 'pnpm-lock.yaml').exists():
+            manager = 'pnpm'
+        flags = sorted(filter(None, (NODE_INSTALL_FLAGS.get(flag, flag) for flag in flags)))
+        words = [manager, 'install' if manager == 'npm' else 'add']
+    else:
+        words = launcher + subcommands[:1]
+    return {
+        'manager': manager,
+        'words': (['sudo'] if sub['sudo'] else []) + words,
+        'flags': flags,
+        'packages': packages,
+    }
+
+def plan_fixes(commands: List[str], root: Path = Path('.')) -> tuple[List[Dict], float]:
+    """Merge install commands for the same package manager and flags into one invocation.
+
+    Each step has the command to run and the proposed commands it replaces;
+    a merged step takes the place of its first command. Also returns the
+    estimated seconds saved by not starting each resolver separately.
+    """
+    steps, groups = [], {}
+    for command in commands:
+        request = _install_request(command, root)
+        if not request:
+            steps.append({'command': command, 'merged': [command]})
+            continue
+        # The launcher of the first command is kept: pip, pip3 and python -m pip merge
+        key = (request['words'][0] == 'sudo', request['manager'], tuple(request['flags']))
+        if key not in groups:
+            groups[key] = dict(request, packages=[], merged=[])
+            steps.append(groups[key])
+        group = groups[key]
+        group['merged'].append(command)
+        group['packages'].extend(package for package in request['packages'] if package not in group['packages'])
+
+    saved = 0.0
+    for step in steps:
+        if 'words' in step:
+            # A bare `npm install` is covered by installing packages with the same manager
+            words, packages = step.pop('words'), step.pop('packages')
+            if not packages and words[-1] == 'add':
+                words = words[:-1] + ['install']
+            step['command'] = shlex.join(words + step.pop('flags') + packages)
+            saved += RESOLVER_STARTUP_SECONDS.get(step.pop('manager'), 1.0) * (len(step['merged']) - 1)
+    return steps, saved
+
+async def apply_fixes(analysis: Dict) -> bool:
     """Apply the suggested fixes"""
     if not analysis:
         return False
@@ -574,10 +3478,16 @@ def apply_fixes(analysis: Dict) -> bool:
         for dep in analysis['missing_dependencies']:
             print(f"  - {dep}")
             
-    if analysis.get('commands'):
+    # Installs for the same package manager run as one invocation
+    steps, saved = plan_fixes(analysis.get('commands', []))
+    if steps:
         print("\nProposed commands:")
-        for cmd in analysis['commands']:
-            print(f"  - {cmd}")
+        for step in steps:
+            print(f"  - {step['command']}")
+            if len(step['merged']) > 1:
+                print(f"      (batches {len(step['merged'])} commands: {'; '.join(step['merged'])})")
+        if saved:
+            print(f"\nBatching installs saves about {saved:.0f}s of package manager startup")
             
     if analysis.get('file_changes'):
         print("\nRequired file changes:")
@@ -586,17 +3496,20 @@ def apply_fixes(analysis: Dict) -> bool:
             
     print(f"\nExplanation: {analysis['explanation']}")
     
-    # First ask for overall confirmation
-    confirm = input("\nWould you like to proceed with the fixes? [y/N] ")
-    if confirm.lower() != 'y':
+    # First ask for overall confirmation; 'a' runs every step without asking again
+    confirm = await ask("\nWould you like to proceed with the fixes? [y = confirm each / a = run all / N] ")
+    if confirm.lower() not in ('y', 'a'):
         return False
+    run_all = confirm.lower() == 'a'
         
     success = True
+    started = time.perf_counter()
     
     # Execute commands with individual confirmations
-    for cmd in analysis.get('commands', []):
+    for step in steps:
+        cmd = step['command']
         print(f"\nCommand: {cmd}")
-        cmd_confirm = input("Execute this command? [y/N] ")
+        cmd_confirm = 'y' if run_all else await ask("Execute this command? [y/N] ")
         
         if cmd_confirm.lower() == 'y':
             try:
@@ -611,12 +3524,14 @@ def apply_fixes(analysis: Dict) -> bool:
                 success = False
                 
                 # Ask if user wants to continue after a failure
-                continue_confirm = input("Command failed. Continue with remaining commands? [y/N] ")
+                continue_confirm = await ask("Command failed. Continue with remaining commands? [y/N] ")
                 if continue_confirm.lower() != 'y':
                     break
         else:
             print(f"Skipping command: {cmd}")
             
+    print(f"\nFixes took {time.perf_counter() - started:.1f}s"
+          + (f"; batching saved about {saved:.0f}s" if saved else ""))
     if success:
         print("\nAll selected fixes have been applied successfully.")
     else:
@@ -642,21 +3557,20 @@ def detect_package_manager():
             continue
     return None
 
-def get_setup_commands(setup_request: str) -> List[Dict]:
+async def get_setup_commands(setup_request: str, context: Optional[List[Dict]] = None) -> List[Dict]:
     """Get setup commands with context awareness"""
+    if context is None:
+        context = command_context[-COMMAND_HISTORY_LIMIT:]
     try:
+        steps = await call_daemon('setup', {'request': setup_request, 'context': context})
+        if steps is not DAEMON_UNAVAILABLE:
+            return steps
+
         # Build context from recent commands, handle empty context
-        context_str = ""
-        if command_context:
-            context_str = "\n".join([
-                f"Previous command: {ctx['command']}\nOutput: {ctx['output']}\n"
-                for ctx in command_context
-            ])
-        else:
-            context_str = "No previous commands"
+        context_str = build_context(context)
         
-        completion = client.chat.completions.create(
-            model=FALLBACK_MODEL,
+        completion = await model_router.complete(
+            'setup',
             messages=[
                 {
                     "role": "system",
@@ -729,7 +3643,7 @@ def get_setup_commands(setup_request: str) -> List[Dict]:
             "content": "ls -la"
         }]
 
-def execute_setup_step(step: Dict) -> bool:
+async def execute_setup_step(step: Dict) -> bool:
     """Execute a single setup step"""
     try:
         print(f"\nStep: {step['description']}")
@@ -742,11 +3656,11 @@ def execute_setup_step(step: Dict) -> bool:
                 print("Note: This step requires administrative privileges")
             
             print(f"Command to execute: {command}")
-            confirm = input("Execute this command? [y/N] ")
+            confirm = await ask("Execute this command? [y/N] ")
             
             if confirm.lower() == 'y':
                 try:
-                    return execute_command(command)
+                    return await execute_command(command)
                 except Exception as e:
                     print(f"Command failed: {str(e)}")
                     return False
@@ -763,7 +3677,7 @@ def execute_setup_step(step: Dict) -> bool:
             print(step['content'])
             print("---")
             
-            confirm = input(f"{'Create' if step['operation'] == 'file_create' else 'Edit'} this file? [y/N] ")
+            confirm = await ask(f"{'Create' if step['operation'] == 'file_create' else 'Edit'} this file? [y/N] ")
             if confirm.lower() == 'y':
                 try:
                     directory = os.path.dirname(path)
@@ -787,10 +3701,10 @@ def execute_setup_step(step: Dict) -> bool:
         print(f"Error executing step: {str(e)}")
         return False
 
-def handle_setup_request(request: str):
+async def handle_setup_request(request: str):
     """Handle a setup wizard request"""
     print(f"\nAnalyzing setup request: {request}")
-    steps = get_setup_commands(request)
+    steps = await with_spinner(get_setup_commands(request), "Generating setup steps...")
     
     if not steps:
         print("Could not generate setup steps. Please try rephrasing your request.")
@@ -803,24 +3717,325 @@ def handle_setup_request(request: str):
         if 'path' in step:
             print(f"   File: {step['path']}")
             
-    confirm = input("\nWould you like to proceed with these steps? [y/N] ")
+    confirm = await ask("\nWould you like to proceed with these steps? [y/N] ")
     if confirm.lower() != 'y':
         return
         
     for i, step in enumerate(steps, 1):
         print(f"\nExecuting step {i}/{len(steps)}")
-        if not execute_setup_step(step):
+        if not await execute_setup_step(step):
             print("Step failed. Stopping setup.")
-            confirm = input("Would you like to continue anyway? [y/N] ")
+            confirm = await ask("Would you like to continue anyway? [y/N] ")
             if confirm.lower() != 'y':
                 return
                 
     print("\nSetup completed!")
 
-def main():
+def show_stats():
+    """Print cache statistics so sizes and TTLs can be tuned"""
+    stats = suggestion_cache.stats()
+    print(f"Suggestion cache: {stats['entries']} entries, "
+          f"{stats['hits']} hits / {stats['misses']} misses "
+          f"(hit rate {stats['hit_rate']:.0%})")
+    stats = verdict_cache.stats()
+    print(f"Safety checks: {safety_stats['local']} decided locally, {safety_stats['background']} sent to the model "
+          f"in the background, {stats['entries']} cached shapes, "
+          f"{stats['hits']} hits / {stats['misses']} misses (hit rate {stats['hit_rate']:.0%})")
+    local = error_stats["dependencies"] + sum(error_stats["signatures"].values())
+    if local or error_stats["remote"]:
+        print(f"Error analysis: {local} resolved locally, {error_stats['remote']} sent to the model "
+              f"(local hit rate {local / (local + error_stats['remote']):.0%})")
+        matched = sorted(error_stats["signatures"].items(), key=lambda item: -item[1])
+        if error_stats["dependencies"]:
+            matched.insert(0, ("missing_dependency", error_stats["dependencies"]))
+        for name, count in matched:
+            print(f"  {name}: {count}")
+    if project_summary_stats["summaries"]:
+        print(f"Project summaries: {project_summary_stats['summaries']} sent, "
+              f"{project_summary_stats['chars_sent']} chars instead of {project_summary_stats['chars_full']} "
+              f"for the full scan")
+    if any(call_gate.held_back.values()) or call_gate.status():
+        print(f"Call gate: {call_gate.held_back['rate_limit']} calls held back by the rate limit, "
+              f"{call_gate.held_back['open_circuit']} by open circuits")
+        for endpoint, breaker in call_gate.breakers.items():
+            if breaker.state != "closed":
+                print(f"  {endpoint}: {breaker.state}, retry in {breaker.retry_in():.0f}s")
+    for model, stats in model_router.stats.items():
+        if not stats.calls:
+            continue
+        p50, p90 = stats.percentile(0.5), stats.percentile(0.9)
+        latency = f"p50 {p50 * 1000:.0f}ms / p90 {p90 * 1000:.0f}ms" if p50 is not None else "no answers"
+        print(f"Model {model}: {stats.calls} calls, {stats.errors} errors, {latency}, "
+              f"hedged {stats.hedges} times ({stats.hedges_won} won)")
+    if context_stats["builds"]:
+        saved = context_stats["tokens_full"] - context_stats["tokens_sent"]
+        print(f"Prompt context: {context_stats['builds']} prompts, ~{context_stats['tokens_sent']} tokens sent, "
+              f"~{saved} tokens saved by compaction")
+
+# Per-user daemon: one long-lived process keeps the model client, its HTTP
+# connections, the caches and the project indexes warm, and REPLs forward model
+# calls to it over a Unix socket. Messages are JSON lines:
+#   {"id": 1, "method": "suggest", "params": {...}}  ->  {"id": 1, "result": ...}
+# with {"id": 1, "partial": ...} while a result streams in, {"id": 1, "error": "..."}
+# on failure and {"id": 1, "cancel": true} from the client to abandon a call.
+DAEMON_SOCKET = Path(os.getenv("AISHELL_DAEMON_SOCKET") or
+                     Path(os.getenv("XDG_RUNTIME_DIR") or CACHE_DIR) / f"aishell-{os.getuid() if hasattr(os, 'getuid') else 0}.sock")
+DAEMON_METHODS = {}
+DAEMON_UNAVAILABLE = object()
+daemon = None  # DaemonClient while this REPL is connected to a daemon
+
+def daemon_method(name: str):
+    """Register a coroutine the daemon runs for method `name`; it gets the params and a partial-result callback"""
+    def register(handler):
+        DAEMON_METHODS[name] = handler
+        return handler
+    return register
+
+class DaemonClient:
+    """Connection from a REPL to the daemon; calls are multiplexed by id"""
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.reader = reader
+        self.writer = writer
+        self.closed = False
+        self._ids = itertools.count(1)
+        self._pending = {}  # id -> (future, on_partial)
+        self._reader_task = asyncio.get_running_loop().create_task(self._read())
+
+    @classmethod
+    async def connect(cls, path: Path = DAEMON_SOCKET, timeout: float = 0.2) -> Optional['DaemonClient']:
+        """Connect to a running daemon, or return None when there is none"""
+        if not hasattr(asyncio, 'open_unix_connection') or not path.exists():
+            return None
+        try:
+            reader, writer = await asyncio.wait_for(asyncio.open_unix_connection(str(path)), timeout)
+        except (OSError, asyncio.TimeoutError):
+            return None
+        return cls(reader, writer)
+
+    async def _read(self):
+        try:
+            while True:
+                line = await self.reader.readline()
+                if not line:
+                    break
+                message = json.loads(line)
+                future, on_partial = self._pending.get(message.get('id'), (None, None))
+                if future is None or future.done():
+                    continue
+                if 'partial' in message:
+                    if on_partial:
+                        on_partial(message['partial'])
+                elif 'error' in message:
+                    future.set_exception(RuntimeError(message['error']))
+                else:
+                    future.set_result(message.get('result'))
+        except (OSError, ValueError):
+            pass
+        self.closed = True
+        for future, _ in self._pending.values():
+            if not future.done():
+                future.set_exception(ConnectionError("aishell daemon went away"))
+
+    def _send(self, message: Dict):
+        self.writer.write(json.dumps(message).encode() + b'\n')
+
+    async def call(self, method: str, params: Dict, on_partial=None):
+        if self.closed:
+            raise ConnectionError("aishell daemon went away")
+        call_id = next(self._ids)
+        future = asyncio.get_running_loop().create_future()
+        self._pending[call_id] = (future, on_partial)
+        try:
+            self._send({'id': call_id, 'method': method, 'params': params})
+            await self.writer.drain()
+            return await future
+        except asyncio.CancelledError:
+            if not self.closed:
+                self._send({'id': call_id, 'cancel': True})
+            raise
+        finally:
+            self._pending.pop(call_id, None)
+
+    def close(self):
+        self._reader_task.cancel()
+        self.writer.close()
+
+async def call_daemon(method: str, params: Dict, on_partial=None):
+    """Run a method in the daemon; DAEMON_UNAVAILABLE when not connected, so the caller runs it locally"""
+    global daemon
+    if daemon is None:
+        return DAEMON_UNAVAILABLE
+    try:
+        return await daemon.call(method, params, on_partial)
+    except OSError:  # Connection reset, broken pipe or the daemon went away
+        daemon = None
+        return DAEMON_UNAVAILABLE
+
+@daemon_method('status')
+async def _daemon_status(params, partial):
+    if api_check_task and not api_check_task.done():
+        await api_check_task
+    return {'status': api_status, 'detail': api_status_detail}
+
+@daemon_method('suggest')
+async def _daemon_suggest(params, partial):
+    # The daemon's cache is shared by every connected terminal
+    cached = suggestion_cache.get(params['user_input'], params['cwd'])
+    if cached is not None:
+        return cached
+    suggestion = await get_ai_suggestion(params['user_input'], on_partial=partial)
+    suggestion_cache.put(params['user_input'], params['cwd'], suggestion)
+    return suggestion
+
+@daemon_method('translate')
+async def _daemon_translate(params, partial):
+    return await get_shell_command(params['query'], context=params['context'])
+
+@daemon_method('setup')
+async def _daemon_setup(params, partial):
+    return await get_setup_commands(params['request'], context=params['context'])
+
+@daemon_method('analyze_error')
+async def _daemon_analyze_error(params, partial):
+    # The client has already tried the local diagnoses, which depend on its own environment
+    return await analyze_error_remotely(params['error_message'], ProjectAnalyzer(params['root']),
+                                        quiet=params.get('quiet', False))
+
+@daemon_method('command_safety')
+async def _daemon_command_safety(params, partial):
+    return await analyze_command_safety(params['command'])
+
+@daemon_method('stats')
+async def _daemon_stats(params, partial):
+    return {'suggestions': suggestion_cache.stats(), 'verdicts': verdict_cache.stats(), 'clients': len(daemon_clients)}
+
+@daemon_method('shutdown')
+async def _daemon_shutdown(params, partial):
+    daemon_stop.set()
+    return True
+
+api_check_task = None
+daemon_clients = set()  # Writers of the connected REPLs
+daemon_stop = None
+
+async def _serve_client(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    """Answer one REPL's calls, each in its own task so slow model calls do not block the others"""
+    daemon_clients.add(writer)
+    tasks = {}
+
+    def send(message: Dict):
+        if not writer.is_closing():
+            writer.write(json.dumps(message).encode() + b'\n')
+
+    async def run(call_id, method: str, params: Dict):
+        try:
+            handler = DAEMON_METHODS.get(method)
+            if not handler:
+                raise ValueError(f"unknown method {method}")
+            result = await handler(params, lambda text: send({'id': call_id, 'partial': text}))
+            send({'id': call_id, 'result': result})
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            send({'id': call_id, 'error': str(e)})
+        finally:
+            tasks.pop(call_id, None)
+
+    try:
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            try:
+                message = json.loads(line)
+            except ValueError:
+                continue
+            call_id = message.get('id')
+            if message.get('cancel'):
+                if call_id in tasks:
+                    tasks[call_id].cancel()
+            else:
+                tasks[call_id] = asyncio.create_task(run(call_id, message.get('method'), message.get('params') or {}))
+    except OSError:
+        pass
+    finally:
+        daemon_clients.discard(writer)
+        for task in list(tasks.values()):
+            task.cancel()
+        writer.close()
+
+async def run_daemon():
+    """Serve REPLs on DAEMON_SOCKET until SIGTERM, Ctrl-C or a shutdown call"""
+    global api_check_task, daemon_stop
+    if await DaemonClient.connect(DAEMON_SOCKET):
+        print(f"aishell daemon already running on {DAEMON_SOCKET}")
+        return
+    try:
+        DAEMON_SOCKET.unlink()  # Left behind by a daemon that did not shut down cleanly
+    except OSError:
+        pass
+    DAEMON_SOCKET.parent.mkdir(parents=True, exist_ok=True)
+    umask = os.umask(0o077)  # The socket is for this user only
+    try:
+        server = await asyncio.start_unix_server(_serve_client, path=str(DAEMON_SOCKET))
+    finally:
+        os.umask(umask)
+
+    daemon_stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, daemon_stop.set)
+    api_check_task = start_api_check()
+    threading.Thread(target=history_index.load, daemon=True).start()
+    print(f"aishell daemon listening on {DAEMON_SOCKET}")
+    async with server:
+        await daemon_stop.wait()
+        for writer in list(daemon_clients):
+            writer.close()  # Their readers see EOF and the client handlers finish
+        await asyncio.sleep(0.1)
+    try:
+        DAEMON_SOCKET.unlink()
+    except OSError:
+        pass
+
+def spawn_daemon():
+    """Start the daemon in the background for the next shells; its output goes to CACHE_DIR/daemon.log"""
+    CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    with open(CACHE_DIR / "daemon.log", 'ab') as log:
+        subprocess.Popen([sys.executable, APP_PATH, '--daemon'], stdin=subprocess.DEVNULL,
+                         stdout=log, stderr=log, start_new_session=True)
+
+async def stop_daemon() -> int:
+    client = await DaemonClient.connect(DAEMON_SOCKET)
+    if not client:
+        print("No aishell daemon is running")
+        return 1
+    await client.call('shutdown', {})
+    client.close()
+    print("aishell daemon stopped")
+    return 0
+
+def get_prompt():
+    """Build the prompt, flagging a failed last command, AI calls held back by the call gate,
+    and the AI connection state until it is known to be up"""
+    status = f'<offline>[exit {last_exit_status}] </offline>' if last_exit_status else ''
+    paused = call_gate.status()
+    if paused:
+        status += f'<offline>[ai: {paused}] </offline>'
+    elif api_status == "checking":
+        status += '<status>[ai: connecting] </status>'
+    elif api_status == "offline":
+        status += '<offline>[ai: offline] </offline>'
+    return HTML(f'{status}<prompt>$ </prompt>')
+
+async def main_async(startup_check: bool = False):
+    global daemon, api_status_listener
     style = Style.from_dict({
         'prompt': '#00aa00 bold',  # Green prompt
         'suggestion': '#666666 italic',  # Gray suggestions
+        'status': '#888888',  # Connection check still running
+        'offline': '#aa0000',  # Connection check failed
     })
     
     session = PromptSession(
@@ -841,8 +4056,13 @@ def main():
 
     @bindings.add("c-c")
     def _(event):
-        event.app.exit(result=None)
-        raise KeyboardInterrupt()
+        event.app.exit(exception=KeyboardInterrupt())
+
+    @bindings.add("escape", "e")
+    def _(event):
+        """Alt-E: diagnose the last failed command"""
+        event.app.current_buffer.text = "!error"
+        event.app.current_buffer.validate_and_handle()
 
     # Remove the problematic % binding
     # @bindings.add("%")
@@ -855,44 +4075,54 @@ def main():
     #         buffer.delete_before_cursor(1)  # Remove the previous "%"
     #         buffer.insert_text("%%")  # Insert "%%" instead
 
-    # Debounce suggestion requests
-    last_fetch_time = 0
-    min_delay_between_fetches = 0.3  # 300ms minimum delay between fetches
+    scheduler = SuggestionScheduler(session, delay=0.3)  # Fetch once typing pauses for 300ms
     
     def on_text_changed(_):
-        nonlocal last_fetch_time
-        current_time = time.time()
-        
-        if current_time - last_fetch_time < min_delay_between_fetches:
-            return
-            
-        last_fetch_time = current_time
         buffer_text = session.default_buffer.document.text
         
         if buffer_text.startswith("?") or len(buffer_text.strip()) < 2:
+            scheduler.cancel()
             return
             
-        threading.Thread(
-            target=fetch_suggestion_async,
-            args=(buffer_text, session),
-            daemon=True
-        ).start()
+        scheduler.schedule(buffer_text)
 
     session.default_buffer.on_text_changed += on_text_changed
 
+    if os.getenv("AISHELL_DAEMON") != "0":
+        daemon = await DaemonClient.connect()
+        if daemon is None and os.getenv("AISHELL_DAEMON") == "1" and not startup_check:
+            spawn_daemon()  # Serves the shells started after this one
+
     print("=== AI Shell ===")
     print("Type commands directly or start with ? for natural language (e.g., ?how to list all files)")
     print("Special commands:")
     print("  %%  - Start setup wizard with context awareness")
     print("  ?   - Natural language command translation")
-    print("  !   - Error analysis")
+    print("  !error [message] - Error analysis; without a message (or Alt-E) diagnoses the last failed command")
+    print("  !stats - Show cache statistics")
+    if daemon:
+        print(f"  Connected to the aishell daemon at {DAEMON_SOCKET}")
     print(f"  Note: Shell maintains history of last {COMMAND_HISTORY_LIMIT} commands for context")
     print("Press TAB or RIGHT ARROW to complete suggestions, ENTER to execute")
+
+    if startup_check:
+        # Render the first prompt and leave straight away; used by `--bench startup`
+        await session.prompt_async(get_prompt, pre_run=lambda: session.app.exit(result=None))
+        return
+
+    def on_api_checked():
+        # The result is shown in the prompt; printing here would garble the input line
+        if session.app.is_running:
+            session.app.invalidate()
+
+    api_status_listener = on_api_checked
+    if daemon:
+        start_api_check()  # Answered by the daemon, which already has a client
+    threading.Thread(target=history_index.load, daemon=True).start()
     
     while True:
         try:
-            message = HTML('<prompt>$ </prompt>')
-            user_input = session.prompt(message, key_bindings=bindings)
+            user_input = await session.prompt_async(get_prompt, key_bindings=bindings)
             
             if user_input is None:
                 continue
@@ -904,26 +4134,50 @@ def main():
             if user_input.lower() in ("exit", "quit"):
                 break
 
+            safety = None
+
             # Handle %% command directly
             if user_input.startswith("%%"):
                 request = user_input[2:].strip()
                 if not request:
                     print("Please provide a setup request after %%")
                     continue
-                handle_setup_request(request)
+                await handle_setup_request(request)
+                continue
+
+            if user_input == "!stats":
+                show_stats()
+                stats = await call_daemon('stats', {})
+                if stats is not DAEMON_UNAVAILABLE:
+                    shared = stats['suggestions']
+                    print(f"Daemon: {stats['clients']} connected shells, shared suggestion cache "
+                          f"{shared['entries']} entries, {shared['hits']} hits / {shared['misses']} misses "
+                          f"(hit rate {shared['hit_rate']:.0%})")
                 continue
 
             # Handle error analysis
             if user_input.startswith("!error"):
                 error_msg = user_input[6:].strip()
-                if not error_msg:
-                    print("Usage: !error <paste error message>")
+                if error_msg:
+                    analysis = analyze_error(error_msg)
+                elif last_failure:
+                    # Usually finished in the background while the output was being read
+                    print(f"Last failure: {last_failure['command']} (exit status {last_failure['returncode']})")
+                    analysis = last_failure['analysis']
+                    # Not started, cancelled, failed or not recognized locally: analyse in the foreground,
+                    # asking the model if need be
+                    if analysis is None or analysis.cancelled() or (analysis.done() and (
+                            analysis.exception() or not analysis.result())):
+                        analysis = analyze_error(last_failure['error_message'])
+                else:
+                    print("Usage: !error <paste error message>, or run it after a command fails")
                     continue
                     
-                print("\nAnalyzing error...")
-                analysis = analyze_error(error_msg)
+                analysis = await with_spinner(analysis, "Analyzing error...")
+                if analysis is None and last_failure:  # The background diagnosis did not recognize it
+                    analysis = await with_spinner(analyze_error(last_failure['error_message']), "Analyzing error...")
                 if analysis:
-                    apply_fixes(analysis)
+                    await apply_fixes(analysis)
                 continue
 
             if user_input.startswith("?"):
@@ -932,16 +4186,18 @@ def main():
                     print("Please provide a query after ?")
                     continue
                     
-                print("Translating query...")
                 try:
-                    command = get_shell_command(query)
+                    command = await with_spinner(get_shell_command(query), "Translating query...")
                     if not command:
                         print("Could not generate a command for your query. Please try rephrasing it.")
                         continue
                         
+                    # Start the safety analysis while the user is still deciding
+                    safety = asyncio.ensure_future(is_destructive_command(command))
                     # print(f"Suggested command: {command}")
-                    confirm = session.prompt("Execute this command? [y/N] ")
+                    confirm = await ask("Execute this command? [y/N] ")
                     if confirm.lower() != 'y':
+                        safety.cancel()
                         continue
                     user_input = command
                 except Exception as e:
@@ -949,10 +4205,10 @@ def main():
                     continue
 
             command_history.append(user_input)
-            with suggestion_lock:
-                current_suggestion = ""
+            history_index.add(user_input)
+            scheduler.cancel()
             
-            execute_command(user_input)
+            await execute_command(user_input, safety=safety)
             
         except KeyboardInterrupt:
             print("\nUse 'exit' or 'quit' to exit")
@@ -960,6 +4216,439 @@ def main():
         except Exception as e:
             print(f"\nError: {e}")
 
+def main(startup_check: bool = False):
+    asyncio.run(main_async(startup_check))
+
+def bench_startup(runs: int = 5) -> int:
+    """Time launch-to-first-prompt of a fresh interpreter against STARTUP_BUDGET"""
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(
+            [sys.executable, APP_PATH, "--startup-check"],
+            input=b"", stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+            check=True
+        )
+        timings.append(time.perf_counter() - start)
+
+    timings.sort()
+    median = timings[len(timings) // 2]
+    print(f"time to first prompt: median {median * 1000:.0f}ms, "
+          f"best {timings[0] * 1000:.0f}ms, worst {timings[-1] * 1000:.0f}ms "
+          f"(budget {STARTUP_BUDGET * 1000:.0f}ms)")
+    if median > STARTUP_BUDGET:
+        print("FAIL: startup is over budget")
+        return 1
+    print("OK")
+    return 0
+
+def bench_imports(runs: int = 5) -> int:
+    """Time `import shell` with -X importtime against IMPORT_BUDGET and check LAZY_MODULES stay unloaded"""
+    directory, module = os.path.split(os.path.abspath(__file__))
+    code = f"import sys; sys.path.insert(0, {directory!r}); import {module[:-3]}"
+    timings = []
+    for _ in range(runs):
+        result = subprocess.run([sys.executable, "-X", "importtime", "-c", code],
+                                capture_output=True, text=True, check=True)
+        # Lines are "import time: self [us] | cumulative | imported package", with
+        # nesting shown by indentation and each package listed after its imports
+        modules, direct, pending = {}, {}, {}
+        for line in result.stderr.splitlines():
+            parts = line.split('|')
+            if len(parts) != 3 or not parts[1].strip().isdigit():
+                continue
+            name, seconds = parts[2].strip(), int(parts[1]) / 1e6
+            modules[name] = seconds
+            depth = (len(parts[2]) - len(parts[2].lstrip()) - 1) // 2
+            if depth == 1:
+                pending[name] = seconds
+            elif depth == 0:
+                if name == module[:-3]:
+                    direct = pending
+                pending = {}
+        timings.append(modules[module[:-3]])
+
+    timings.sort()
+    median = timings[len(timings) // 2]
+    print(f"import {module[:-3]}: median {median * 1000:.0f}ms, best {timings[0] * 1000:.0f}ms, "
+          f"worst {timings[-1] * 1000:.0f}ms (budget {IMPORT_BUDGET * 1000:.0f}ms)")
+    print("slowest imports: " + ", ".join(
+        f"{name} {seconds * 1000:.0f}ms" for name, seconds in sorted(direct.items(), key=lambda item: -item[1])[:5]))
+    eager = [name for name in LAZY_MODULES if name in modules]
+    if eager:
+        print(f"FAIL: imported at startup: {', '.join(eager)}")
+        return 1
+    if median > IMPORT_BUDGET:
+        print("FAIL: import is over budget")
+        return 1
+    print("OK")
+    return 0
+
+# Command lines as typed in day-to-day use, labelled with whether they should ask for
+# confirmation. out.txt, notes.txt and config.yaml exist in the benchmark directory.
+SAFETY_CORPUS = [
+    ("ls -la", "safe"), ("ls", "safe"), ("cd ..", "safe"), ("pwd", "safe"),
+    ("git status", "safe"), ("git diff --stat", "safe"), ("git log --oneline -n 20", "safe"),
+    ("git add -A && git commit -m 'wip'", "safe"), ("git push origin main", "safe"),
+    ("git push -f origin main", "confirm"), ("git push --force-with-lease", "confirm"),
+    ("git push origin :old-branch", "confirm"), ("git reset --hard HEAD~1", "confirm"),
+    ("git reset HEAD~1", "safe"), ("git clean -fd", "confirm"), ("git clean -n", "safe"),
+    ("git revert abc123", "confirm"), ("git checkout -b feature/x", "safe"),
+    ("git checkout -- src/app.py", "confirm"), ("git checkout main", "safe"),
+    ("git restore --staged app.py", "safe"), ("git restore app.py", "confirm"),
+    ("git branch -D feature/x", "confirm"), ("git stash drop", "confirm"), ("git stash", "safe"),
+    ("git rebase -i HEAD~3", "safe"), ("git -C ../other status", "safe"),
+    ("npm run format", "safe"), ("npm install", "safe"), ("npm run build && npm test", "safe"),
+    ("npm uninstall lodash", "confirm"), ("pip install -r requirements.txt", "safe"),
+    ("pip uninstall -y requests", "confirm"), ("pytest -q tests/", "safe"), ("python manage.py migrate", "safe"), ("./deploy.sh staging", "confirm"), ("make -j8", "safe"),
+    ("cargo build --release", "safe"), ("docker ps -a", "safe"), ("docker compose up -d", "safe"),
+    ("docker compose down -v", "confirm"), ("docker system prune -af", "confirm"),
+    ("docker rm -f web", "confirm"), ("docker run --rm -it ubuntu bash", "safe"),
+    ("docker volume rm pgdata", "confirm"), ("docker stop web", "confirm"),
+    ("kubectl get pods -n kube-system", "safe"), ("kubectl delete pod web-1 -n prod", "confirm"),
+    ("kubectl -n prod delete deployment api", "confirm"), ("kubectl logs -f web-1", "safe"),
+    ("kubectl drain node-3 --ignore-daemonsets", "confirm"), ("kubectl scale deploy api --replicas 0", "confirm"),
+    ("cat README.md | grep -i install", "safe"), ("grep -rn TODO src | wc -l", "safe"),
+    ("find . -name '*.pyc' -delete", "confirm"), ("find . -name '*.log' -exec rm {} +", "confirm"),
+    ("find . -type f -name '*.py'", "safe"), ("tail -f /var/log/syslog", "safe"),
+    ("echo hello > out.txt", "confirm"), ("echo hello >> out.txt", "safe"),
+    ("echo hello > new-file.txt", "safe"), ("ls missing 2>/dev/null", "safe"),
+    ("make 2>&1 | tee build.log", "safe"), ("cat image.iso > /dev/sdb", "confirm"),
+    ("rm -rf build/", "confirm"), ("rm notes.txt", "confirm"), ("rm -i *.log", "safe"),
+    ("rm -rf /", "confirm"), ("rmdir empty-dir", "safe"), ("mv draft.txt notes.txt", "confirm"),
+    ("mv -n draft.txt notes.txt", "safe"), ("mv src/a.py src/b.py", "safe"),
+    ("cp config.example.yaml config.yaml", "confirm"), ("cp -r src dist", "safe"),
+    ("sudo apt-get update && sudo apt-get upgrade -y", "confirm"), ("sudo apt remove -y nginx", "confirm"),
+    ("sudo systemctl restart nginx", "confirm"), ("systemctl status sshd", "safe"),
+    ("sudo systemctl reboot", "confirm"), ("service nginx stop", "confirm"),
+    ("chmod -R 755 public", "confirm"), ("chmod +x run.sh", "safe"), ("chmod 777 upload", "confirm"),
+    ("sudo chown -R root:root /etc", "confirm"), ("chown me:me notes.txt", "safe"),
+    ("dd if=/dev/zero of=disk.img bs=1M count=100", "safe"), ("dd if=ubuntu.iso of=/dev/sdb bs=4M", "confirm"),
+    ("mkfs.ext4 /dev/sdb1", "confirm"), ("shred -u secrets.txt", "confirm"),
+    ("tar -czf backup.tgz ~/projects", "safe"), ("tar -tzf release.tgz", "safe"),
+    ("tar xzf release.tgz", "confirm"), ("tar -czf src.tgz --remove-files src", "confirm"),
+    ("sed -n '1,20p' app.py", "safe"), ("sed -i 's/foo/bar/' app.py", "confirm"),
+    ("watch -n 2 kubectl get pods", "safe"), ("watch -n 5 rm -rf build", "confirm"), ("curl -fsSL https://example.com/install.sh | sh", "confirm"),
+    ("curl -s https://api.example.com/status | jq .", "safe"), ("ssh user@host 'uptime'", "safe"),
+    ("ssh host rm -rf /", "confirm"), ("ssh -p 2222 host 'sudo reboot'", "confirm"),
+    ("awk '{print $1}' access.log", "safe"), ("awk 'BEGIN{system(\"rm -rf /\")}'", "confirm"),
+    ("wget -O- https://example.com/install.sh | bash -s", "confirm"),
+    ("curl -o notes.txt https://example.com/notes.txt", "confirm"), ("wget https://example.com/a.tgz", "safe"),
+    ("source venv/bin/activate", "safe"),
+    ("history | tail -n 20", "safe"), ("bash -c 'rm -rf node_modules'", "confirm"),
+    ("kill -9 4242", "confirm"), ("pkill -f server.py", "confirm"), ("crontab -l", "safe"),
+    ("crontab -r", "confirm"), ("psql -c 'DROP TABLE users'", "confirm"), ("psql -c 'select 1'", "safe"),
+    ("terraform plan", "safe"), ("terraform destroy", "confirm"), ("helm uninstall web", "confirm"),
+    ("sudo reboot", "confirm"), ("mkdir -p src/utils && touch src/utils/__init__.py", "safe"),
+    ("firebase projects delete my-app", "confirm"), ("rsync -av --delete src/ backup/", "confirm"),
+]
+
+def bench_safety(rounds: int = 200) -> int:
+    """Accuracy and per-call cost of the local safety rules over SAFETY_CORPUS"""
+    import tempfile
+    previous_cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as workdir:
+        os.chdir(workdir)
+        try:
+            for name in ('out.txt', 'notes.txt', 'config.yaml'):
+                Path(name).write_text("existing\n")
+
+            timings = []
+            for _ in range(rounds):
+                for command, _ in SAFETY_CORPUS:
+                    start = time.perf_counter()
+                    classify_command(command)
+                    timings.append(time.perf_counter() - start)
+
+            wrong, unclassified = [], []
+            for command, expected in SAFETY_CORPUS:
+                findings, unknown = classify_command(command)
+                confirm = any(SEVERITY_RANK[f['severity']] >= SEVERITY_RANK[CONFIRM_SEVERITY] for f in findings)
+                if unknown and not confirm:
+                    unclassified.append(command)
+                elif ('confirm' if confirm else 'safe') != expected:
+                    wrong.append((command, expected))
+        finally:
+            os.chdir(previous_cwd)
+
+    timings.sort()
+    total = len(SAFETY_CORPUS)
+    print(f"classify_command: {total} commands x {rounds} rounds, "
+          f"mean {sum(timings) / len(timings) * 1e6:.1f}us, "
+          f"p50 {timings[len(timings) // 2] * 1e6:.1f}us, "
+          f"p99 {timings[int(len(timings) * 0.99)] * 1e6:.1f}us")
+    classified = total - len(unclassified)
+    print(f"{classified}/{total} classified locally, accuracy {(classified - len(wrong)) / classified:.1%} "
+          f"({len(wrong)} misclassified); {len(unclassified)} left to the model")
+    for command, expected in wrong:
+        print(f"  expected {expected}: {command}")
+    for command in unclassified:
+        print(f"  unclassified: {command}")
+    return 1 if wrong else 0
+
+def _make_synthetic_project(root: str, files: int = 200_000):
+    """Lay out a project tree of about `files` files: sources, dependencies, build output and ignored files"""
+    layout = [
+        ('src/pkg{}', 200, ['.py'] * 5 + ['.js'], 0.3),
+        ('node_modules/dep{}/lib', 500, ['.js', '.json', '.ts'], 0.5),
+        ('build/out{}', 100, ['.js', '.css', '.html'], 0.1),
+        ('generated/gen{}', 100, ['.py', '.go'], 0.1),
+    ]
+    Path(root, '.gitignore').write_text("# build output\ngenerated/\n*.tmp\n")
+    for pattern, dirs, exts, share in layout:
+        per_dir = int(files * share / dirs)
+        for d in range(dirs):
+            directory = os.path.join(root, pattern.format(d))
+            os.makedirs(directory, exist_ok=True)
+            for f in range(per_dir):
+                open(os.path.join(directory, f'file{f}{exts[f % len(exts)]}'), 'w').close()
+
+def bench_scan() -> int:
+    """Single-pass project scan against one rglob per extension on a synthetic 200k-file tree"""
+    import tempfile
+    with tempfile.TemporaryDirectory() as root:
+        start = time.perf_counter()
+        _make_synthetic_project(root)
+        print(f"built synthetic tree in {time.perf_counter() - start:.1f}s")
+
+        start = time.perf_counter()
+        found, complete, directories = scan_tree(root, ProjectAnalyzer.SOURCE_EXTENSIONS)
+        elapsed = time.perf_counter() - start
+        counts = ', '.join(f"{lang} {len(paths)}" for lang, paths in sorted(found.items()))
+        print(f"scan_tree: {elapsed * 1000:.0f}ms, {'complete' if complete else 'capped'} ({counts})")
+
+        start = time.perf_counter()
+        scan_tree(root, ProjectAnalyzer.SOURCE_EXTENSIONS, previous=directories)
+        print(f"scan_tree, unchanged tree: {(time.perf_counter() - start) * 1000:.0f}ms")
+        Path(root, 'src/pkg7/new_module.py').touch()
+        start = time.perf_counter()
+        found, _, _ = scan_tree(root, ProjectAnalyzer.SOURCE_EXTENSIONS, previous=directories)
+        print(f"scan_tree, one directory changed: {(time.perf_counter() - start) * 1000:.0f}ms "
+              f"(python {len(found['python'])})")
+
+        start = time.perf_counter()
+        legacy = 0
+        for ext in {f'*{ext}' for ext in ProjectAnalyzer.SOURCE_EXTENSIONS}:
+            legacy += sum(1 for _ in Path(root).rglob(ext))
+        legacy_elapsed = time.perf_counter() - start
+        print(f"rglob per extension: {legacy_elapsed * 1000:.0f}ms ({legacy} files, "
+              f"{legacy_elapsed / elapsed:.0f}x slower)")
+    return 0 if complete else 1
+
+def bench_deps(packages: int = 20_000) -> int:
+    """Parse time of each lock file format with `packages` entries"""
+    import tempfile
+    writers = {
+        'package-lock.json': lambda i: f'    "node_modules/pkg{i}": {{\n      "version": "1.0.{i}",\n'
+                                       f'      "resolved": "https://registry.npmjs.org/pkg{i}/-/pkg{i}-1.0.{i}.tgz"\n    }},\n',
+        'yarn.lock': lambda i: f'pkg{i}@^1.0.0:\n  version "1.0.{i}"\n  resolved "https://example.com/pkg{i}.tgz"\n\n',
+        'Cargo.lock': lambda i: f'[[package]]\nname = "pkg{i}"\nversion = "1.0.{i}"\nsource = "registry"\n\n',
+        'go.sum': lambda i: f'example.com/pkg{i} v1.0.{i} h1:abc=\nexample.com/pkg{i} v1.0.{i}/go.mod h1:def=\n',
+        'Gemfile.lock': lambda i: f'    pkg{i} (1.0.{i})\n      dep{i} (>= 1.0)\n',
+        'composer.lock': lambda i: f'        {{\n            "name": "vendor/pkg{i}",\n            "version": "1.0.{i}"\n        }},\n',
+    }
+    failed = False
+    with tempfile.TemporaryDirectory() as root:
+        for name, entry in writers.items():
+            path = Path(root, name)
+            with open(path, 'w') as f:
+                f.writelines(entry(i) for i in range(packages))
+            start = time.perf_counter()
+            deps = parse_dependencies(path)
+            elapsed = time.perf_counter() - start
+            failed = failed or len(deps) != packages
+            print(f"{name:18} {path.stat().st_size / 1e6:5.1f} MB  {elapsed * 1000:6.0f}ms  {len(deps)} packages")
+    return 1 if failed else 0
+
+# Models served by the `--bench router` stub: (latency, share of calls queued, queued latency, share of errors)
+ROUTER_STUB_MODELS = {
+    'stub/queued': (0.05, 0.05, 1.0, 0.0),  # Free tier: usually quick, now and then queued for a second
+    'stub/steady': (0.12, 0.0, 0.0, 0.0),
+    'stub/down': (0.01, 0.0, 0.0, 1.0),
+    'stub/flapping': (0.02, 0.0, 0.0, 0.0),  # Taken down and back up by `--bench gate`
+}
+
+def _stub_server():
+    """Serve OpenAI-compatible chat completions for ROUTER_STUB_MODELS on a background thread"""
+    import http.server
+    import random
+    rng = random.Random(42)
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_POST(self):
+            request = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+            model = request['model']
+            latency, queued_share, queued_latency, error_share = ROUTER_STUB_MODELS[model]
+            time.sleep(queued_latency if rng.random() < queued_share else latency * rng.uniform(0.6, 1.4))
+            if rng.random() < error_share:
+                body = json.dumps({"error": {"message": f"{model} is unavailable"}}).encode()
+                self.send_response(503)
+            elif request.get('stream'):
+                chunk = {"id": "stub", "object": "chat.completion.chunk", "created": 0, "model": model,
+                         "choices": [{"index": 0, "delta": {"content": "ls -la"}, "finish_reason": None}]}
+                body = f"data: {json.dumps(chunk)}\n\ndata: [DONE]\n\n".encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/event-stream')
+            else:
+                body = json.dumps({"id": "stub", "object": "chat.completion", "created": 0, "model": model,
+                                   "choices": [{"index": 0, "finish_reason": "stop",
+                                                "message": {"role": "assistant", "content": "ls -la"}}]}).encode()
+                self.send_response(200)
+            self.send_header('Content-Type', self.headers.get('Accept', 'application/json'))
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            try:
+                self.wfile.write(body)
+            except OSError:
+                pass  # The router cancelled this call
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def bench_router(calls: int = 60) -> int:
+    """Tail latency of one model, hedged models and failover, against a local stub server"""
+    global AI_BASE_URL, _client, api_status, call_gate
+    call_gate = CallGate()
+    call_gate.bucket = TokenBucket(60_000, 100)  # The stub has no rate limit to respect
+    server = _stub_server()
+    AI_BASE_URL = f"http://127.0.0.1:{server.server_address[1]}/v1"
+    _client = None
+    api_status = "online"  # No connectivity check against the stub
+    os.environ.setdefault("deepseek_api", "stub")
+    scenarios = [
+        ("single model", ['stub/queued'], False),
+        ("hedged", ['stub/queued', 'stub/steady'], False),
+        ("hedged, streamed", ['stub/queued', 'stub/steady'], True),
+        ("failover", ['stub/down', 'stub/steady'], False),
+    ]
+
+    async def run(models, stream):
+        router = ModelRouter({'bench': models})
+        latencies, failures = [], 0
+        for _ in range(calls):
+            start = time.perf_counter()
+            try:
+                response = await router.complete('bench', messages=[{"role": "user", "content": "list files"}],
+                                                  max_tokens=5, stream=stream)
+                if stream:
+                    async for _ in response:
+                        pass
+                latencies.append(time.perf_counter() - start)
+            except Exception:
+                failures += 1
+        return router, sorted(latencies), failures
+
+    results = {}
+    print(f"{'':18} {'p50':>7} {'p95':>7} {'max':>7}  failures  hedges won")
+    for name, models, stream in scenarios:
+        router, latencies, failures = asyncio.run(run(models, stream))
+        p50, p95 = latencies[len(latencies) // 2], latencies[int(len(latencies) * 0.95)]
+        won = sum(stats.hedges_won for stats in router.stats.values())
+        hedges = sum(stats.hedges for stats in router.stats.values())
+        print(f"{name:18} {p50 * 1000:5.0f}ms {p95 * 1000:5.0f}ms {latencies[-1] * 1000:5.0f}ms  "
+              f"{failures:8}  {won}/{hedges}")
+        results[name] = (p95, failures)
+    server.shutdown()
+
+    if results["hedged"][0] >= results["single model"][0] or any(failures for _, failures in results.values()):
+        print("FAIL: hedging did not cut tail latency or calls failed")
+        return 1
+    print("OK")
+    return 0
+
+def bench_gate(calls: int = 20) -> int:
+    """Calls refused by the circuit breaker during an outage, its recovery, and the rate limiter, against the stub"""
+    global AI_BASE_URL, _client, api_status, BREAKER_BACKOFF
+    server = _stub_server()
+    AI_BASE_URL = f"http://127.0.0.1:{server.server_address[1]}/v1"
+    _client = None
+    api_status = "online"  # No connectivity check against the stub
+    os.environ.setdefault("deepseek_api", "stub")
+    BREAKER_BACKOFF = 0.5  # Read by each new CircuitBreaker
+    router = ModelRouter({'bench': ['stub/flapping'], 'suggestion': ['stub/flapping']})
+    request = {'messages': [{"role": "user", "content": "list files"}], 'max_tokens': 5}
+
+    async def run_calls(task, count):
+        sent, refused, slowest_refusal = 0, 0, 0.0
+        for _ in range(count):
+            start = time.perf_counter()
+            try:
+                await router.complete(task, **request)
+                sent += 1
+            except AIUnavailable:
+                refused += 1
+                slowest_refusal = max(slowest_refusal, time.perf_counter() - start)
+            except Exception:
+                sent += 1
+        return sent, refused, slowest_refusal
+
+    async def run():
+        global call_gate
+        failed = False
+        call_gate = CallGate()
+        call_gate.bucket = TokenBucket(60_000, 100)  # Only the breaker is under test here
+        ROUTER_STUB_MODELS['stub/flapping'] = (0.02, 0.0, 0.0, 1.0)
+        sent, refused, slowest = await run_calls('bench', calls)
+        print(f"outage:     {sent} calls reached the endpoint, {refused} refused at once "
+              f"(slowest refusal {slowest * 1e6:.0f}us), circuit {call_gate.breaker('stub/flapping').state}")
+        failed |= sent != BREAKER_FAILURES
+
+        await asyncio.sleep(BREAKER_BACKOFF)
+        sent, refused, _ = await run_calls('bench', 1)
+        breaker = call_gate.breaker('stub/flapping')
+        print(f"still down: trial call after {BREAKER_BACKOFF}s failed, circuit {breaker.state} "
+              f"for {breaker.retry_in():.1f}s")
+        failed |= breaker.state != "open" or breaker.backoff != BREAKER_BACKOFF * 2
+
+        ROUTER_STUB_MODELS['stub/flapping'] = (0.02, 0.0, 0.0, 0.0)
+        await asyncio.sleep(breaker.retry_in())
+        sent, refused, _ = await run_calls('bench', calls)
+        print(f"recovered:  {sent} calls reached the endpoint, {refused} refused, circuit {breaker.state}")
+        failed |= refused != 0 or breaker.state != "closed"
+
+        call_gate = CallGate()
+        call_gate.bucket = TokenBucket(60, RATE_BURST)
+        sent, refused, _ = await run_calls('suggestion', calls)
+        print(f"keystrokes: {sent} suggestions sent, {refused} dropped by the rate limit (burst {RATE_BURST}, 60/min)")
+        failed |= sent != RATE_BURST
+        return failed
+
+    failed = asyncio.run(run())
+    server.shutdown()
+    print("FAIL" if failed else "OK")
+    return 1 if failed else 0
+
+# Benchmarks runnable as `python shell.py --bench <name>`
+BENCHMARKS = {
+    'startup': bench_startup,
+    'imports': bench_imports,
+    'safety': bench_safety,
+    'scan': bench_scan,
+    'deps': bench_deps,
+    'router': bench_router,
+    'gate': bench_gate,
+}
+
+def run_benchmark(name: str) -> int:
+    """Run a named benchmark and return its exit status"""
+    bench = BENCHMARKS.get(name)
+    if not bench:
+        print(f"Unknown benchmark: {name}. Available: {', '.join(BENCHMARKS)}")
+        return 2
+    return bench()
+
 if __name__ == "__main__":
-    main()
+    if len(sys.argv) > 2 and sys.argv[1] == "--bench":
+        sys.exit(run_benchmark(sys.argv[2]))
+    if "--daemon" in sys.argv:
+        asyncio.run(run_daemon())
+        sys.exit(0)
+    if "--daemon-stop" in sys.argv:
+        sys.exit(asyncio.run(stop_daemon()))
+    main(startup_check="--startup-check" in sys.argv)
 
@@ -15,26 +15,43 @@ from prompt_toolkit.formatted_text import HTML
 from prompt_toolkit.styles import Style
 from dotenv import load_dotenv
 import platform
+# The safety rules and the verdict cache are shared with shell.py, so both shells classify alike
+from shell import CONFIRM_SEVERITY, SEVERITY_RANK, classify_command, verdict_cache
 
 load_dotenv()
 COMMAND_HISTORY_LIMIT = 10 
-print("Using OpenRouter API key:", os.getenv("deepseek_api")[:8] + "..." if os.getenv("deepseek_api") else "Not found")
 
 FALLBACK_MODEL = "openai/gpt-3.5-turbo:free"
 
-client = OpenAI(
-    base_url="https://openrouter.ai/api/v1",
-    api_key=os.getenv("deepseek_api"),
-    timeout=5.0,
-    default_headers={
-        "HTTP-Referer": "https://openrouter.ai/",  # Required for OpenRouter
-    }
-)
+# The client is built on first use so startup never waits on it
+_client = None
+_client_lock = threading.Lock()
+
+def get_client():
+    """Return the shared OpenRouter client, creating it on first use"""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = OpenAI(
+                    base_url="https://openrouter.ai/api/v1",
+                    api_key=os.getenv("deepseek_api"),
+                    timeout=5.0,
+                    default_headers={
+                        "HTTP-Referer": "https://openrouter.ai/",  # Required for OpenRouter
+                    }
+                )
+    return _client
+
+# Result of the background connectivity check: "checking", "online" or "offline"
+api_status = "checking"
+api_status_detail = ""
 
 # Test the API connection
 def test_api_connection():
+    global api_status, api_status_detail
     try:
-        completion = client.chat.completions.create(
+        completion = get_client().chat.completions.create(
             model=FALLBACK_MODEL,
             messages=[
                 {"role": "system", "content": "You are a helpful assistant."},
@@ -42,17 +59,22 @@ def test_api_connection():
             ],
             max_tokens=10
         )
-        print("API Test Response:", completion.choices[0].message.content if completion.choices else "No response")
+        api_status = "online"
+        api_status_detail = completion.choices[0].message.content if completion.choices else "No response"
         return True
     except Exception as e:
-        print("API Test Error:", str(e))
+        api_status = "offline"
+        api_status_detail = str(e)
         return False
 
-# Call this at startup
-if test_api_connection():
-    print("OpenRouter API connection successful")
-else:
-    print("OpenRouter API connection failed")
+def start_api_check(on_done=None):
+    """Run the connectivity check in the background so the prompt shows up immediately"""
+    def run():
+        test_api_connection()
+        if on_done:
+            on_done()
+
+    threading.Thread(target=run, daemon=True).start()
 
 #something 
 
@@ -71,7 +93,7 @@ def get_ai_suggestion(user_input):
             return ""
 
         # print(f"Requesting suggestion for: {user_input}")  # Debug print
-        completion = client.chat.completions.create(
+        completion = get_client().chat.completions.create(
             model=FALLBACK_MODEL,
             messages=[
                 {
@@ -119,7 +141,7 @@ def get_shell_command(query):
         else:
             context_str = "No previous commands"
             
-        completion = client.chat.completions.create(
+        completion = get_client().chat.completions.create(
             model="openai/gpt-3.5-turbo:free",
             messages=[
                 {
@@ -257,9 +279,20 @@ def is_destructive_command(command: str) -> tuple[bool, str, list]:
             
             return True, info['reason'], affected_files
 
+    # Commands the local rules settle and previously analysed command shapes skip the model
+    findings, unclassified = classify_command(command)
+    findings = [f for f in findings if SEVERITY_RANK[f['severity']] >= SEVERITY_RANK[CONFIRM_SEVERITY]]
+    if findings:
+        return True, findings[0]['reason'], affected_files
+    if not unclassified:
+        return False, '', []
+    verdict = verdict_cache.get(command)
+    if verdict is not None:
+        return verdict['is_destructive'], verdict['reason'], affected_files
+
     # If not found in predefined patterns, use AI to analyze
     try:
-        completion = client.chat.completions.create(
+        completion = get_client().chat.completions.create(
             model=FALLBACK_MODEL,
             messages=[
                 {
@@ -293,8 +326,12 @@ def is_destructive_command(command: str) -> tuple[bool, str, list]:
         
         analysis = json.loads(completion.choices[0].message.content)
         
+        reason = ''
         if analysis['is_destructive']:
-            return True, f"{analysis['reason']} (Severity: {analysis['severity']}, Type: {analysis['type']})", affected_files
+            reason = f"{analysis['reason']} (Severity: {analysis['severity']}, Type: {analysis['type']})"
+        verdict_cache.put(command, {'is_destructive': bool(analysis['is_destructive']), 'reason': reason})
+        if analysis['is_destructive']:
+            return True, reason, affected_files
     
     except Exception as e:
         print(f"AI analysis failed: {str(e)}")
@@ -393,7 +430,7 @@ def get_setup_commands(setup_request: str) -> List[Dict]:
         else:
             context_str = "No previous commands"
         
-        completion = client.chat.completions.create(
+        completion = get_client().chat.completions.create(
             model=FALLBACK_MODEL,
             messages=[
                 {
@@ -559,6 +596,8 @@ def main():
     style = Style.from_dict({
         'prompt': '#00aa00 bold',
         'suggestion': '#666666 italic',
+        'status': '#888888',
+        'offline': '#aa0000',
     })
     
     def get_prompt():
@@ -566,6 +605,10 @@ def main():
         home = os.path.expanduser("~")
         if cwd.startswith(home):
             cwd = "~" + cwd[len(home):]
+        if api_status == "checking":
+            return HTML(f'<status>[ai: connecting] </status><prompt>{cwd} $ </prompt>')
+        if api_status == "offline":
+            return HTML(f'<offline>[ai: offline] </offline><prompt>{cwd} $ </prompt>')
         return HTML(f'<prompt>{cwd} $ </prompt>')
 
     session = PromptSession(
@@ -622,11 +665,17 @@ def main():
     print("  ?   - Natural language command translation")
     print(f"  Note: Shell maintains history of last {COMMAND_HISTORY_LIMIT} commands for context")
     print("Press TAB or RIGHT ARROW to complete suggestions, ENTER to execute")
+
+    def on_api_checked():
+        # The result is shown in the prompt; printing here would garble the input line
+        if session.app.is_running:
+            session.app.invalidate()
+
+    start_api_check(on_done=on_api_checked)
     
     while True:
         try:
-            message = HTML('<prompt>$ </prompt>')
-            user_input = session.prompt(message, key_bindings=bindings)
+            user_input = session.prompt(get_prompt, key_bindings=bindings)
             
             if user_input is None:
                 continue